@@ -11,7 +11,6 @@ import threading
 import select
 from tkinter import *
 import winsound # Windows Sound
-import ast # For parsing user list
 import customtkinter as ctk # Modern UI
 from chat_utils import *
 import json
@@ -25,11 +24,15 @@ import base64
 import io
 from tkinter import filedialog
 import traceback
+from collections import OrderedDict
+from attachments import digest_of
 
 # Setup CustomTkinter Theme to match "shadcn" (Dark, Blue/Slate)
 ctk.set_appearance_mode("Dark")  # Modes: "System" (standard), "Dark", "Light"
 ctk.set_default_color_theme("dark-blue")  # Themes: "blue" (standard), "green", "dark-blue"
 
+ATTACH_CACHE_ITEMS = 64 # images kept in memory, by hash
+
 # GUI class for the chat
 class GUI:
     # constructor method
@@ -51,12 +54,21 @@ class GUI:
         self.input_history = []
         self.history_index = 0
         self.online_users = []
-        self.after_id = None # For polling
-        self.commands = ["/time", "/who", "/quit", "/poem", "/connect", "/search", "/aipic", "/clear"]
+        self.presence = {} # name -> "alone"/"talking", kept up to date by presence deltas
+        self.presence_seq = 0
+        self.presence_resyncing = False # a snapshot was asked for: deltas wait for it
+        self.commands = ["/time", "/who", "/quit", "/poem", "/connect", "/search", "/more", "/aipic", "/clear", "/rooms", "/join", "/leave"]
         
         # State for Date Display
         self.last_print_date = None
         self.loaded_images = [] # Keep references to prevent GC
+        
+        # Incoming binary uploads (v1 framing), filled by myrecv chunk by chunk
+        self.uploads = UploadAssembler()
+        set_chunk_handler(self.socket, self.uploads)
+        # Images by hash: image_ref messages are shown from here, fetched on a miss
+        self.attachment_cache = OrderedDict()
+        self.pending_offers = {} # hash -> bytes, until the server says if it needs them
 
     def login(self):
         # login/signup window
@@ -180,8 +192,8 @@ class GUI:
                     process.daemon = True
                     process.start()
                     
-                    # Start polling logic (Wait a bit for connection to settle)
-                    self.Window.after(2000, self.update_user_list)
+                    # Online users: one snapshot, then the server pushes the changes
+                    self.subscribe_presence()
                 else:
                     self.status_label.configure(text=response.get("message", "Login failed"), text_color="red")
         else:
@@ -285,15 +297,42 @@ class GUI:
         self.btn_image = ctk.CTkButton(self.entry_frame, text="📷", width=40, height=30, fg_color="transparent", border_width=1, command=self.send_image)
         self.btn_image.grid(row=1, column=3, padx=5, pady=(0, 10))
         
-    def update_user_list(self):
-        # Poll for user list every 10 seconds
+    def subscribe_presence(self):
+        self.presence_resyncing = True
         try:
-            msg = json.dumps({"action": "list"})
-            self.send(msg)
+            self.send(json.dumps({"action": "presence_subscribe"}))
         except Exception as e:
-            print(f"Error polling user list: {e}")
-            # Continue anyway, will retry on next poll
-        self.Window.after(10000, self.update_user_list)
+            self.presence_resyncing = False
+            print(f"Error subscribing to presence: {e}")
+
+    def update_presence(self, msg):
+        # snapshot replaces everything, deltas patch it; a gap in seq means we
+        # missed one: one new snapshot is asked for, the deltas before it are dropped
+        event = msg.get("event")
+        if event == "snapshot":
+            self.presence = dict(msg["users"])
+            self.presence_resyncing = False
+        elif self.presence_resyncing:
+            return
+        elif msg.get("seq", 0) != self.presence_seq + 1:
+            self.subscribe_presence()
+            return
+        elif event == "leave":
+            self.presence.pop(msg["name"], None)
+        else:
+            self.presence[msg["name"]] = msg.get("state", "alone")
+        self.presence_seq = msg.get("seq", 0)
+        self.online_users = list(self.presence.keys())
+        self.Window.after(0, self.render_user_list)
+
+    def render_user_list(self):
+        for widget in self.user_list_frame.winfo_children():
+            widget.destroy()
+        for u, state in sorted(self.presence.items()):
+            status = "💬" if state == "talking" else "🟢"
+            if u == self.name: status = "👤"
+            u_btn = ctk.CTkLabel(self.user_list_frame, text=f"{status} {u}", anchor="w", font=("Arial", 12))
+            u_btn.pack(fill="x", pady=2)
         
     def navigate_history_up(self, event):
         if self.input_history:
@@ -490,13 +529,19 @@ class GUI:
                  self._display_system_message("Image too large. Please use a smaller image (max ~1.5MB).", "system")
                  return
              
-             # Encode to base64
-             base64_str = base64.b64encode(img_bytes).decode('utf-8')
-             
              # Send with error handling
              try:
-                 msg = json.dumps({"action": "image", "from": self.name, "data": base64_str})
-                 self.send(msg)
+                 if get_framing(self.socket) == FRAMING_V1:
+                     # Offer the hash first, the bytes only go out if the server does not have them
+                     digest = digest_of(img_bytes)
+                     self.cache_image(digest, img_bytes)
+                     self.pending_offers[digest] = img_bytes
+                     self.send(json.dumps({"action": "image_offer", "hash": digest, "kind": "image", "size": len(img_bytes)}))
+                 else:
+                     # Old servers: base64 in one json message
+                     base64_str = base64.b64encode(img_bytes).decode('utf-8')
+                     msg = json.dumps({"action": "image", "from": self.name, "data": base64_str})
+                     self.send(msg)
                  
                  # Local Echo with timestamp
                  self._display_image(img, self.name, is_me=True)
@@ -515,6 +560,23 @@ class GUI:
             traceback.print_exc()
             self._display_system_message(f"Failed to process image: {str(e)[:50]}", "system")
 
+    def cache_image(self, digest, img_bytes):
+        self.attachment_cache[digest] = img_bytes
+        self.attachment_cache.move_to_end(digest)
+        while len(self.attachment_cache) > ATTACH_CACHE_ITEMS:
+            self.attachment_cache.popitem(last=False)
+
+    def upload_offered(self, digest):
+        # server answered our image_offer: it needs the bytes, raw binary chunks
+        img_bytes = self.pending_offers.pop(digest, None)
+        if img_bytes is None:
+            return
+        upload_id = new_upload_id()
+        self.send(json.dumps({"action": "upload_begin", "upload": upload_id, "kind": "image",
+                              "size": len(img_bytes), "hash": digest}))
+        if not send_upload(self.socket, upload_id, img_bytes):
+            raise ConnectionError("upload interrupted")
+
     def _display_image(self, pil_image, user, is_me=False):
         if threading.current_thread() is not threading.main_thread():
              # We can't pass the PIL image effectively if we delay too long? 
@@ -668,6 +730,9 @@ class GUI:
                  self._display_system_message("Usage: /search <term>", "system")
                  self.my_msg = ""
 
+        elif msg.startswith("/more"):
+            self.my_msg = "?"
+
         elif msg.startswith("/poem"):
             parts = msg.split(" ", 1)
             if len(parts) > 1 and parts[1].strip().isdigit():
@@ -680,6 +745,15 @@ class GUI:
             
         elif msg.startswith("/who"): 
             self.my_msg = "who"
+        elif msg.startswith("/rooms"):
+            self.my_msg = "rooms"
+        elif msg.startswith("/join") or msg.startswith("/leave"):
+            parts = msg[1:].split(" ", 1)
+            if len(parts) > 1 and parts[1].strip():
+                self.my_msg = f"{parts[0]} {parts[1].strip()}"
+            else:
+                self._display_system_message(f"Usage: /{parts[0]} <room>", "system")
+                self.my_msg = ""
         elif msg.startswith("/time"): 
             self.my_msg = "time"
         
@@ -744,15 +818,21 @@ class GUI:
 
     def proc(self):
         while True:
-            try:
-                read, write, error = select.select([self.socket], [], [], 0)
-            except Exception as e:
-                print(f"Select error: {e}")
-                time.sleep(0.1)
-                continue
+            # pushed while the state machine waited for a reply: those first
+            if self.sm.held:
+                read = []
+            else:
+                try:
+                    read, write, error = select.select([self.socket], [], [], 0)
+                except Exception as e:
+                    print(f"Select error: {e}")
+                    time.sleep(0.1)
+                    continue
                 
             peer_msg = []
-            if self.socket in read:
+            if self.sm.held:
+                peer_msg = self.sm.held.popleft()
+            elif self.socket in read:
                 try:
                     peer_msg = self.recv()
                 except (ConnectionAbortedError, ConnectionResetError, ConnectionError) as e:
@@ -794,23 +874,65 @@ class GUI:
                                  
                              continue # Skip normal text processing
                         
-                        if pm_json.get("action") == "list":
-                            # Parse User List
-                            raw_res = pm_json["results"]
-                            start = raw_res.find("{")
-                            end = raw_res.find("}") + 1
-                            if start != -1 and end != -1:
-                                users_dict = ast.literal_eval(raw_res[start:end])
-                                self.online_users = list(users_dict.keys())
-                                # Update Sidebar UI
-                                for widget in self.user_list_frame.winfo_children():
-                                    widget.destroy()
-                                for u in self.online_users:
-                                    status = "🟢" 
-                                    if u == self.name: status = "👤"
-                                    u_btn = ctk.CTkLabel(self.user_list_frame, text=f"{status} {u}", anchor="w", font=("Arial", 12))
-                                    u_btn.pack(fill="x", pady=2)
-                            
+                        # --- BINARY UPLOADS ---
+                        if pm_json.get("action") == "upload_begin":
+                            if "status" not in pm_json:
+                                self.uploads.begin(pm_json)
+                            else:
+                                self._display_system_message("Failed to send image", "system")
+                            continue
+                        
+                        # --- IMAGES BY HASH ---
+                        if pm_json.get("action") == "image_offer":
+                            try:
+                                if pm_json.get("status") == "send":
+                                    self.upload_offered(pm_json["hash"])
+                                else:
+                                    self.pending_offers.pop(pm_json["hash"], None)
+                            except Exception as e:
+                                print(f"Upload error: {e}")
+                                self._display_system_message("Failed to send image", "system")
+                            continue
+                        
+                        if pm_json.get("action") == "image_ref":
+                            digest = pm_json["hash"]
+                            sender = pm_json.get("from", "Unknown")
+                            if digest in self.attachment_cache:
+                                self.cache_image(digest, self.attachment_cache[digest])
+                                try:
+                                    img = Image.open(io.BytesIO(self.attachment_cache[digest]))
+                                    self._display_image(img, sender, is_me=False)
+                                    try: winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
+                                    except: pass
+                                except Exception as e:
+                                    print(f"Image Reception Error: {e}")
+                                    self._display_system_message("Failed to receive image", "system")
+                            else:
+                                # Cache miss: the bytes come back as an upload with this hash
+                                self.send(json.dumps({"action": "fetch", "hash": digest, "from": sender}))
+                            continue
+                        
+                        if pm_json.get("action") == "fetch":
+                            self._display_system_message("Image no longer available", "system")
+                            continue
+                        
+                        if pm_json.get("action") == "upload_done":
+                            meta, img_bytes = self.uploads.take(pm_json["upload"])
+                            try:
+                                if img_bytes and "hash" in meta:
+                                    self.cache_image(meta["hash"], bytes(img_bytes))
+                                if img_bytes and pm_json.get("kind") == "image":
+                                    img = Image.open(io.BytesIO(img_bytes))
+                                    self._display_image(img, meta.get("from", "Unknown"), is_me=False)
+                                    try: winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
+                                    except: pass
+                            except Exception as e:
+                                print(f"Image Reception Error: {e}")
+                                self._display_system_message("Failed to receive image", "system")
+                            continue
+                        
+                        if pm_json.get("action") == "presence":
+                            self.update_presence(pm_json)
                             continue
                     except:
                         pass
@@ -3,6 +3,7 @@ import json
 import requests
 import base64
 import io
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -163,3 +164,39 @@ class AIHandler:
             
         except Exception as e:
             return f"Image Gen Error: {str(e)}"
+
+
+class FakeAIHandler:
+    """
+    Local stand-in for AIHandler, no network and no API key.
+    Answers after a fixed delay, so the server's worker pool can be
+    exercised and load tested without OpenAI (chat_server.py --ai fake).
+    """
+    # 1x1 white PNG
+    IMAGE = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4//8/AAX+Av4N70a4AAAAAElFTkSuQmCC"
+
+    def __init__(self, delay=None):
+        if delay is None:
+            delay = float(os.getenv("FAKE_AI_DELAY", "0.5"))
+        self.delay = delay
+
+    def get_chat_response(self, history, user_message, username=None):
+        time.sleep(self.delay)
+        return f"(fake AI) {username or 'you'} asked: {user_message} [{len(history or [])} lines of context]"
+
+    def extract_keywords(self, text):
+        time.sleep(self.delay)
+        return ", ".join(text.split()[:5])
+
+    def get_summary(self, text):
+        time.sleep(self.delay)
+        return text[:100]
+
+    def analyze_sentiment(self, text):
+        return "😐 Neutral (fake AI)"
+
+    def generate_image(self, prompt):
+        time.sleep(self.delay)
+        if prompt.startswith("fail"):
+            return "Error: fake image failure"
+        return self.IMAGE
@@ -0,0 +1,72 @@
+"""
+Text analysis for the indexer: message text -> index terms
+
+The same analyzer runs when a message is indexed and on every word of a
+query, so "Love", "love," and "LOVE!" all end up as the term "love".
+
+    tokenizer       words are runs of letters/digits, an inner apostrophe
+                    stays ("summer's"); with strip_punct=False the text is
+                    just split on whitespace, the old behaviour
+    case folding    str.casefold, after NFKC normalization
+    chat prefix     "(dd.mm.yy,HH:MM) user : " from chat_utils.text_proc
+                    loses its timestamp and ':', the user name is kept
+    stopwords       optional, e.g. Analyzer(stopwords=STOPWORDS)
+
+analyze() gives (position, term) pairs. Positions count every word, also
+the stopwords that are left out, so a phrase query keeps its gaps.
+pattern() normalizes a query word with * and ? wildcards the same way.
+"""
+
+import re
+import unicodedata
+
+WORD = re.compile(r"\w+(?:['\u2019]\w+)*")
+PATTERN_CHARS = re.compile(r"[\w'\u2019*?]+")
+CHAT_PREFIX = re.compile(r'^\(\d\d\.\d\d\.\d\d,\d\d:\d\d\) (.*?) : ')
+
+STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have he her his i if in is it
+its me my no not of on or so that the their them then there they this to was
+we were what when which who will with you your
+""".split())
+
+class Analyzer:
+    def __init__(self, casefold=True, strip_punct=True, stopwords=None, chat_prefix=True):
+        self.casefold = casefold
+        self.strip_punct = strip_punct
+        self.stopwords = frozenset(stopwords or ())
+        self.chat_prefix = chat_prefix
+
+    def analyze(self, text):
+        if self.chat_prefix:
+            m = CHAT_PREFIX.match(text)
+            if m:
+                text = m.group(1) + ' ' + text[m.end():]
+        if self.casefold:
+            text = unicodedata.normalize('NFKC', text).casefold()
+        words = WORD.findall(text) if self.strip_punct else text.split()
+        stop = self.stopwords
+        return [(pos, wd) for pos, wd in enumerate(words) if wd not in stop]
+
+    def terms(self, text):
+        return [wd for pos, wd in self.analyze(text)]
+
+    def pattern(self, word):
+        if self.casefold:
+            word = unicodedata.normalize('NFKC', word).casefold()
+        if self.strip_punct:
+            word = ''.join(PATTERN_CHARS.findall(word))
+        return word
+
+    def settings(self):
+        # Analyzer(**settings()) is the same analyzer; saved with the segments
+        return {"casefold": self.casefold, "strip_punct": self.strip_punct,
+                "stopwords": sorted(self.stopwords), "chat_prefix": self.chat_prefix}
+
+    def __repr__(self):
+        return (f'Analyzer(casefold={self.casefold}, strip_punct={self.strip_punct}, '
+                f'stopwords={len(self.stopwords)}, chat_prefix={self.chat_prefix})')
+
+if __name__ == "__main__":
+    a = Analyzer(stopwords=STOPWORDS)
+    print(a.analyze("(18.10.26,09:09) alice : Shall I compare thee to a Summer's day?"))
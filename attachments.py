@@ -0,0 +1,126 @@
+"""
+Content-addressed attachment store for the chat server
+
+Images are stored once, under the sha256 of their bytes, no matter how many
+rooms they are posted to. Rooms only get a small reference ("image_ref"
+with the hash); clients fetch the bytes when their own cache misses.
+
+The store lives in a directory (one file per blob, fanned out by the first
+two hex digits) and is capped in bytes: the least recently used blobs are
+evicted first.
+"""
+
+import os
+import hashlib
+from collections import OrderedDict
+
+ATTACH_DIR = 'attachments'
+ATTACH_MAX_BYTES = 512 * 1024 * 1024
+
+def digest_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+class AttachmentStore:
+    def __init__(self, path=ATTACH_DIR, max_bytes=ATTACH_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lru = OrderedDict()  # digest -> size, least recently used first
+        self.total = 0
+        # counters
+        self.puts = 0
+        self.dedup_hits = 0      # put() or offer of a blob we already had
+        self.dedup_bytes = 0     # bytes we did not have to store or upload again
+        self.fetches = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def load(self):
+        # pick up what is on disk, oldest first
+        found = []
+        for sub in os.listdir(self.path):
+            subdir = os.path.join(self.path, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for digest in os.listdir(subdir):
+                st = os.stat(os.path.join(subdir, digest))
+                found.append((st.st_mtime, digest, st.st_size))
+        for mtime, digest, size in sorted(found):
+            self.lru[digest] = size
+            self.total += size
+        self.evict()
+
+    def file_of(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def has(self, digest):
+        return digest in self.lru
+
+    def size_of(self, digest):
+        return self.lru.get(digest, 0)
+
+    def offered(self, digest):
+        # a client offered a blob we have: it does not need to upload it
+        if digest not in self.lru:
+            return False
+        self.dedup_hits += 1
+        self.dedup_bytes += self.lru[digest]
+        self.lru.move_to_end(digest)
+        return True
+
+    def put(self, data, digest=None):
+        digest = digest or digest_of(data)
+        self.puts += 1
+        if digest in self.lru:
+            self.dedup_hits += 1
+            self.dedup_bytes += len(data)
+            self.lru.move_to_end(digest)
+            return digest
+        fname = self.file_of(digest)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(fname + '.tmp', fname)
+        self.lru[digest] = len(data)
+        self.total += len(data)
+        self.evict()
+        return digest
+
+    def get(self, digest):
+        self.fetches += 1
+        if digest not in self.lru:
+            self.misses += 1
+            return None
+        try:
+            with open(self.file_of(digest), 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.misses += 1
+            self.total -= self.lru.pop(digest)
+            return None
+        self.lru.move_to_end(digest)
+        return data
+
+    def evict(self):
+        while self.total > self.max_bytes and len(self.lru) > 1:
+            digest, size = self.lru.popitem(last=False)
+            self.total -= size
+            self.evictions += 1
+            try:
+                os.remove(self.file_of(digest))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"blobs": len(self.lru), "bytes": self.total, "max_bytes": self.max_bytes,
+                "puts": self.puts, "dedup_hits": self.dedup_hits, "dedup_bytes": self.dedup_bytes,
+                "fetches": self.fetches, "misses": self.misses, "evictions": self.evictions}
+
+if __name__ == "__main__":
+    import tempfile
+    store = AttachmentStore(tempfile.mkdtemp(), max_bytes=10)
+    d = store.put(b'meme')
+    store.put(b'meme')
+    store.put(b'another one')
+    print(store.has(d), store.stats())
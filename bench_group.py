@@ -0,0 +1,58 @@
+"""
+Benchmark: who gets a message, chat_group.Group.list_me
+
+10k users in 2k groups of 5. list_me runs on every exchange, so its cost
+is the routing cost of one message. The reverse index (member -> group)
+makes it O(recipients); the old version scanned every group.
+
+    python bench_group.py [users] [groups]
+"""
+
+import io
+import sys
+import time
+import random
+import contextlib
+import chat_group as grp
+
+def scan_list_me(g, me):
+    # the old list_me: look for me in every group
+    my_list = [me]
+    for k in g.chat_grps.keys():
+        if me in g.chat_grps[k]:
+            my_list += [m for m in g.chat_grps[k] if m != me]
+            break
+    return my_list
+
+def build(users, groups):
+    g = grp.Group()
+    names = [f'user{i}' for i in range(users)]
+    for name in names:
+        g.join(name)
+    with contextlib.redirect_stdout(io.StringIO()):  # connect() talks a lot
+        for i, name in enumerate(names):
+            leader = names[i % groups]
+            if name != leader:
+                g.connect(name, leader)
+    return g, names
+
+def timeit(fn, names, calls):
+    picks = [random.choice(names) for _ in range(calls)]
+    t0 = time.perf_counter()
+    for name in picks:
+        fn(name)
+    return (time.perf_counter() - t0) / calls * 1e6
+
+if __name__ == "__main__":
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    groups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    t0 = time.perf_counter()
+    g, names = build(users, groups)
+    print(f'{users} users in {len(g.chat_grps)} groups, built in {time.perf_counter() - t0:.2f}s')
+    name = random.choice(names)
+    assert sorted(g.list_me(name)) == sorted(scan_list_me(g, name))
+    fast = timeit(g.list_me, names, 200000)
+    slow = timeit(lambda me: scan_list_me(g, me), names, 2000)
+    print(f'list_me, reverse index: {fast:8.2f} us/message')
+    print(f'list_me, group scan:    {slow:8.2f} us/message')
+    print(f'speedup: {slow / fast:.0f}x')
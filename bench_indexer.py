@@ -0,0 +1,101 @@
+"""
+Benchmark: building the chat/sonnet index, indexer.Index.indexing
+
+Three ways to grow the postings of a word, all on whitespace-split words:
+    concat  self.index[wd] = self.index.get(wd, []) + [l]   (copies, quadratic)
+    list    list.append
+    array   array('I').append, what indexer.Index does
+and indexer.Index as the server runs it, with the default analyzer
+(case folding, punctuation, chat prefix) in front:
+    analyzed
+
+Runs on AllSonnets.txt and on a synthetic chat history where every line
+starts like chat_utils.text_proc makes it: "(dd.mm.yy,HH:MM) user : ...",
+so the timestamp, the user names and ':' are very frequent words.
+The concat baseline is quadratic, it only runs on the first
+--concat-cap messages of the synthetic history.
+
+    python bench_indexer.py [--messages 1000000] [--concat-cap 20000]
+"""
+
+import sys
+import time
+import random
+import argparse
+import indexer
+from analyzer import Analyzer
+
+class ConcatIndex(indexer.Index):
+    def __init__(self, name):
+        super().__init__(name)
+        self.index = {}
+
+    def indexing(self, m, l):
+        words = m.split()
+        self.total_words += len(words)
+        for wd in words:
+            self.index[wd] = self.index.get(wd, []) + [l]
+
+class ListIndex(indexer.Index):
+    def __init__(self, name):
+        super().__init__(name)
+        self.index = {}
+
+    def indexing(self, m, l):
+        words = m.split()
+        self.total_words += len(words)
+        for wd in words:
+            if wd not in self.index:
+                self.index[wd] = [l]
+            else:
+                self.index[wd].append(l)
+
+class ArrayIndex(indexer.Index):
+    def __init__(self, name):
+        super().__init__(name, Analyzer(casefold=False, strip_punct=False, chat_prefix=False))
+
+VARIANTS = (("concat", ConcatIndex), ("list", ListIndex), ("array", ArrayIndex), ("analyzed", indexer.Index))
+
+def postings_bytes(idx):
+    # the containers only: a list also keeps an int object per line number
+    postings = idx.index.values() if isinstance(idx.index, dict) else idx.index
+    return sum(sys.getsizeof(p) for p in postings)
+
+def synthetic_history(n, seed=1):
+    rnd = random.Random(seed)
+    words = open('AllSonnets.txt').read().split()
+    users = [f'user{i}' for i in range(50)]
+    for i in range(n):
+        ctime = '(%02d.%02d.25,%02d:%02d)' % (1 + i // 40000 % 28, 1 + i // 1120000 % 12, i // 60 % 24, i % 60)
+        text = ' '.join(rnd.choice(words) for _ in range(rnd.randint(3, 12)))
+        yield ctime + ' ' + rnd.choice(users) + ' : ' + text
+
+def build(cls, lines):
+    idx = cls('bench')
+    t0 = time.perf_counter()
+    for m in lines:
+        idx.add_msg_and_index(m)
+    return idx, time.perf_counter() - t0
+
+def run(label, lines, variants):
+    print(f'\n{label}: {len(lines)} lines')
+    for name, cls in variants:
+        idx, secs = build(cls, lines)
+        words = idx.get_total_words()
+        print(f'  {name:<8} {secs:8.3f}s  {secs / max(words, 1) * 1e9:8.1f} ns/word  '
+              f'{len(idx.index):7} terms  postings containers {postings_bytes(idx) / 2**20:8.1f} MB')
+        del idx
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='indexer micro-benchmark')
+    parser.add_argument('--messages', type=int, default=1000000, help='synthetic chat history size')
+    parser.add_argument('--concat-cap', type=int, default=20000, help='history size for the quadratic baseline')
+    args = parser.parse_args()
+
+    sonnets = [l.rstrip() for l in open('AllSonnets.txt')]
+    run('AllSonnets.txt', sonnets, VARIANTS)
+
+    history = list(synthetic_history(args.messages))
+    cap = min(args.concat_cap, len(history))
+    run('synthetic history (concat baseline size)', history[:cap], VARIANTS)
+    run('synthetic history', history, VARIANTS[1:])
@@ -0,0 +1,199 @@
+"""
+Pub/sub message bus between chat server processes
+
+One chat_server process only knows its own sockets. With several of them
+(python chat_server.py --workers 4, or processes started by hand with
+--reuse-port), they share presence, room membership and room messages by
+publishing json messages on topics of a bus:
+    presence        join/leave/state of users, node_down, sync requests
+    rooms           room membership changes
+    room:<name>     messages and events of one room; a process subscribes
+                    only while it has members of that room online
+
+Backends, picked by the --bus url:
+    local://                one process, nothing to share (default)
+    tcp://host:port         the broker below, run with  python chat_bus.py
+Another backend (redis, nats, ...) only needs publish/subscribe/unsubscribe
+and to call deliver() from its reader thread; see connect().
+
+Messages are handed to the server like worker pool results: the reader
+thread queues them and calls notify(), the server loop then calls
+run_callbacks(), which calls on_message(topic, msg) on the loop thread.
+A publisher never gets its own messages back.
+"""
+
+import json
+import queue
+import socket
+import asyncio
+import threading
+from chat_utils import *
+
+BUS_PORT = 1120
+
+class Bus:
+    """local://, a bus with nobody else on it"""
+    def __init__(self, node, notify=None):
+        self.node = node
+        self.notify = notify
+        self.on_message = None     # set by the server: on_message(topic, msg)
+        self.inbox = queue.Queue()
+        self.topics = set()
+        # counters
+        self.published = 0
+        self.received = 0
+
+    def publish(self, topic, msg):
+        self.published += 1
+
+    def subscribe(self, topic):
+        self.topics.add(topic)
+
+    def unsubscribe(self, topic):
+        self.topics.discard(topic)
+
+    def deliver(self, topic, msg):
+        # reader thread: hand the message to the loop
+        self.inbox.put((topic, msg))
+        if self.notify is not None:
+            self.notify()
+
+    def run_callbacks(self):
+        # loop thread
+        while True:
+            try:
+                topic, msg = self.inbox.get_nowait()
+            except queue.Empty:
+                return
+            self.received += 1
+            try:
+                self.on_message(topic, msg)
+            except Exception as e:
+                print(f'bus message error on {topic}: {e}')
+
+    def stats(self):
+        return {"backend": self.__class__.__name__, "node": self.node, "topics": len(self.topics),
+                "published": self.published, "received": self.received}
+
+    def close(self):
+        pass
+
+
+class BrokerBus(Bus):
+    """tcp://host:port, talks to the broker of this module"""
+    def __init__(self, node, host, port=BUS_PORT, notify=None):
+        super().__init__(node, notify)
+        self.sock = socket.create_connection((host, port))
+        set_framing(self.sock, FRAMING_V1)
+        self._send({"op": "hello", "node": node})
+        reader = threading.Thread(target=self._read, daemon=True)
+        reader.start()
+
+    def _send(self, msg):
+        if not mysend(self.sock, json.dumps(msg)):
+            print('bus: broker connection lost')
+
+    def publish(self, topic, msg):
+        self.published += 1
+        self._send({"op": "pub", "topic": topic, "msg": msg})
+
+    def subscribe(self, topic):
+        if topic not in self.topics:
+            self.topics.add(topic)
+            self._send({"op": "sub", "topic": topic})
+
+    def unsubscribe(self, topic):
+        if topic in self.topics:
+            self.topics.discard(topic)
+            self._send({"op": "unsub", "topic": topic})
+
+    def _read(self):
+        while True:
+            frame = read_frame(self.sock)
+            if frame is None:
+                print('bus: broker went away')
+                return
+            msg = json.loads(frame[2])
+            self.deliver(msg["topic"], msg["msg"])
+
+    def close(self):
+        self.sock.close()
+
+
+def connect(url, node, notify=None):
+    if not url or url.startswith('local:'):
+        return Bus(node, notify)
+    if url.startswith('tcp://'):
+        host, _, port = url[len('tcp://'):].partition(':')
+        return BrokerBus(node, host or '127.0.0.1', int(port or BUS_PORT), notify)
+    raise ValueError(f'unknown bus: {url}')
+
+#==============================================================================
+# the broker: forwards every published frame, as it came in, to the other
+# subscribers of its topic. When a server process goes away, the others get
+# a node_down on "presence" so they can forget its users.
+#==============================================================================
+class Broker:
+    def __init__(self):
+        self.subs = {}     # topic -> set of writers
+        self.nodes = {}    # writer -> node name
+
+    def forward(self, topic, frame, sender=None):
+        for w in self.subs.get(topic, ()):
+            if w is not sender:
+                w.write(frame)
+
+    async def handle(self, reader, writer):
+        topics = set()
+        try:
+            while True:
+                head = await reader.readexactly(HEADER_SIZE)
+                version, kind, size = parse_header(head)
+                body = await reader.readexactly(size)
+                msg = json.loads(body)
+                op = msg.get("op")
+                if op == "pub":
+                    self.forward(msg["topic"], head + body, writer)
+                elif op == "sub":
+                    self.subs.setdefault(msg["topic"], set()).add(writer)
+                    topics.add(msg["topic"])
+                elif op == "unsub":
+                    self.subs.get(msg["topic"], set()).discard(writer)
+                    topics.discard(msg["topic"])
+                elif op == "hello":
+                    self.nodes[writer] = msg["node"]
+                    print('bus: node', msg["node"], 'connected')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            print(f'bus: error {e}')
+        for topic in topics:
+            self.subs[topic].discard(writer)
+            if not self.subs[topic]:
+                del self.subs[topic]
+        node = self.nodes.pop(writer, None)
+        if node is not None:
+            print('bus: node', node, 'gone')
+            down = {"op": "pub", "topic": "presence", "msg": {"event": "node_down", "node": node}}
+            self.forward("presence", encode_frame(json.dumps(down), FRAMING_V1))
+        writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'bus broker on {host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='chat server message bus broker')
+    parser.add_argument('--host', default=CHAT_IP)
+    parser.add_argument('--port', type=int, default=BUS_PORT)
+    args = parser.parse_args()
+    try:
+        asyncio.run(Broker().serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,9 @@ class Client:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM )
         svr = SERVER if self.args.d == None else (self.args.d, CHAT_PORT)
         self.socket.connect(svr)
+        # v1 binary framing unless asked for the old one (old servers only speak legacy)
+        if getattr(self.args, 'framing', 'v1') == 'v1':
+            set_framing(self.socket, FRAMING_V1)
         self.sm = csm.ClientSM(self.socket)
         self.gui = GUI(self.send, self.recv, self.sm, self.socket)
 
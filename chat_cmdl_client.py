@@ -5,6 +5,7 @@ def main():
     import argparse
     parser = argparse.ArgumentParser(description='chat client argument')
     parser.add_argument('-d', type=str, default=None, help='server IP addr')
+    parser.add_argument('--framing', choices=['v1', 'legacy'], default='v1', help='wire framing, legacy for old servers')
     args = parser.parse_args()
 
     client = Client(args)
@@ -6,6 +6,7 @@ Created on Sun Apr  5 09:58:31 2015
 """
 S_ALONE = 0
 S_TALKING = 1
+STATE_NAMES = {S_ALONE: "alone", S_TALKING: "talking"}
 
 #==============================================================================
 # Group class:
@@ -25,7 +26,8 @@ class Group:
 
     def __init__(self):
         self.members = {}
-        self.chat_grps = {}
+        self.chat_grps = {}     # group key -> set of member names
+        self.member_grp = {}    # member name -> group key, for members in a group
         self.grp_ever = 0
 
     def join(self, name):
@@ -33,7 +35,7 @@ class Group:
         return
 
     def is_member(self, name):
-        return name in self.members.keys()
+        return name in self.members
 
     def leave(self, name):
         self.disconnect(name)
@@ -41,31 +43,31 @@ class Group:
         return
 
     def find_group(self, name):
-        found = False
-        group_key = 0
-        for k in self.chat_grps.keys():
-            if name in self.chat_grps[k]:
-                found = True
-                group_key = k
-                break
-        return found, group_key
+        # reverse index: no scan over the groups
+        group_key = self.member_grp.get(name, 0)
+        return group_key != 0, group_key
 
     def connect(self, me, peer):
         peer_in_group = False
         #if peer is in a group, join it
         peer_in_group, group_key = self.find_group(peer)
+        if peer_in_group == True and self.member_grp.get(me) == group_key:
+            return  # talking already
+        # one group at a time: leave the old one first
+        self.disconnect(me)
         if peer_in_group == True:
             print(peer, "is talking already, connect!")
-            self.chat_grps[group_key].append(me)
+            self.chat_grps[group_key].add(me)
+            self.member_grp[me] = group_key
             self.members[me] = S_TALKING
         else:
             # otherwise, create a new group
             print(peer, "is idle as well")
             self.grp_ever += 1
             group_key = self.grp_ever
-            self.chat_grps[group_key] = []
-            self.chat_grps[group_key].append(me)
-            self.chat_grps[group_key].append(peer)
+            self.chat_grps[group_key] = {me, peer}
+            self.member_grp[me] = group_key
+            self.member_grp[peer] = group_key
             self.members[me] = S_TALKING
             self.members[peer] = S_TALKING
         print(self.list_me(me))
@@ -75,12 +77,14 @@ class Group:
         # find myself in the group, quit
         in_group, group_key = self.find_group(me)
         if in_group == True:
-            self.chat_grps[group_key].remove(me)
+            self.chat_grps[group_key].discard(me)
+            del self.member_grp[me]
             self.members[me] = S_ALONE
             # peer may be the only one left as well...
             if len(self.chat_grps[group_key]) == 1:
                 peer = self.chat_grps[group_key].pop()
                 self.members[peer] = S_ALONE
+                del self.member_grp[peer]
                 del self.chat_grps[group_key]
         return
 
@@ -103,16 +107,66 @@ class Group:
 
     def list_me(self, me):
         # return a list, "me" followed by other peers in my group
-        if me in self.members.keys():
-            my_list = []
+        # costs O(group size), whatever the number of groups
+        my_list = []
+        if me in self.members:
             my_list.append(me)
-            in_group, group_key = self.find_group(me)
-            if in_group == True:
+            group_key = self.member_grp.get(me)
+            if group_key is not None:
                 for member in self.chat_grps[group_key]:
                     if member != me:
                         my_list.append(member)
         return my_list
 
+#==============================================================================
+# Rooms class: named rooms, next to the implicit connect groups
+#   - a user can sit in many rooms at once
+#   - a room lives as long as it has members, online or not
+#   - membership is kept on both sides: room -> members, member -> rooms
+#==============================================================================
+
+MAX_ROOM_NAME = 64
+
+class Rooms:
+
+    def __init__(self):
+        self.rooms = {}         # room name -> set of member names
+        self.user_rooms = {}    # member name -> set of room names
+
+    def join(self, room, name):
+        # False if already in
+        members = self.rooms.setdefault(room, set())
+        if name in members:
+            return False
+        members.add(name)
+        self.user_rooms.setdefault(name, set()).add(room)
+        return True
+
+    def leave(self, room, name):
+        # False if not in
+        members = self.rooms.get(room)
+        if members is None or name not in members:
+            return False
+        members.discard(name)
+        if not members:
+            del self.rooms[room]
+        self.user_rooms[name].discard(room)
+        if not self.user_rooms[name]:
+            del self.user_rooms[name]
+        return True
+
+    def is_in(self, room, name):
+        return name in self.rooms.get(room, ())
+
+    def rooms_of(self, name):
+        return self.user_rooms.get(name, set())
+
+    def members(self, room):
+        return self.rooms.get(room, set())
+
+    def list_all(self):
+        return {room: len(members) for room, members in self.rooms.items()}
+
 if __name__ == "__main__":
     g = Group()
     g.join('a')
@@ -121,3 +175,8 @@ if __name__ == "__main__":
     g.list_all2('a')
     g.connect('a', 'b')
     print(g.list_all())
+    r = Rooms()
+    r.join('general', 'a')
+    r.join('general', 'b')
+    r.join('python', 'a')
+    print(r.list_all(), r.rooms_of('a'))
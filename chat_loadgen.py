@@ -0,0 +1,459 @@
+"""
+Headless load generator and latency benchmark for the chat server
+
+Thousands of simulated clients speak the real protocol over asyncio streams
+(no GUI, no threads): signup/login, connect into groups, then exchange,
+search, poem, time and image traffic at a fixed rate for a fixed time.
+
+The scenarios are fixed and checked in (loadgen_scenarios.json), so the
+numbers of two versions of the server can be compared. The report has:
+    - messages/sec sent by the clients and delivered by the server
+    - fan-out latency percentiles (sender to every receiver of an exchange
+      or image) and round trip percentiles of search/poem/time
+    - server CPU and RSS (needs /proc or psutil)
+
+Usage:
+    python chat_loadgen.py --list
+    python chat_loadgen.py smoke --spawn
+    python chat_loadgen.py chat_1k --spawn --server-args "--engine asyncio" --out chat_1k.json
+    python chat_loadgen.py chat_1k --spawn --baseline chat_1k.json
+    python chat_loadgen.py smoke --pid 1234          # server already running
+
+--spawn starts chat_server.py in a scratch directory (fresh users.db, no
+.idx files left behind) and stops it at the end.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shlex
+import hashlib
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from chat_utils import *
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = os.path.join(HERE, 'loadgen_scenarios.json')
+MARK = 'lg'  # exchange messages from the load generator start with this
+
+DEFAULTS = {
+    "users": 20,            # simulated clients
+    "group_size": 4,        # clients per chat group
+    "duration": 10,         # seconds measured
+    "warmup": 2,            # seconds of traffic before measuring
+    "rate": 1.0,            # actions per second per client
+    "legacy_fraction": 0.0, # share of clients on the legacy framing
+    "msg_size": 64,         # bytes of text per exchange
+    "image_size": 16384,    # bytes per image
+    "mix": {"exchange": 1.0},
+    "login_concurrency": 64,
+}
+
+WORDS = ('love beauty time summer rose death youth heart eyes night truth '
+         'praise verse fair sweet world day self thought art').split()
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return {"count": len(values), "p50": round(pick(0.50), 3), "p90": round(pick(0.90), 3),
+            "p99": round(pick(0.99), 3), "max": round(values[-1], 3)}
+
+#==============================================================================
+# server process counters: CPU seconds and RSS bytes
+#==============================================================================
+def proc_usage(pid):
+    try:
+        import psutil
+        p = psutil.Process(pid)
+        t = p.cpu_times()
+        return t.user + t.system, p.memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    return cpu, int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+
+class ProcSampler:
+    def __init__(self, pid, every=0.5):
+        self.pid = pid
+        self.every = every
+        self.rss = []
+        self.start = None
+        self.end = None
+
+    def mark_start(self):
+        self.start = (time.monotonic(), proc_usage(self.pid))
+
+    def mark_end(self):
+        self.end = (time.monotonic(), proc_usage(self.pid))
+
+    async def run(self):
+        while True:
+            usage = proc_usage(self.pid)
+            if usage is not None:
+                self.rss.append(usage[1])
+            await asyncio.sleep(self.every)
+
+    def report(self):
+        if not self.start or not self.end or self.start[1] is None or self.end[1] is None:
+            return {"pid": self.pid, "available": False}
+        dt = self.end[0] - self.start[0]
+        cpu = self.end[1][0] - self.start[1][0]
+        return {"pid": self.pid, "cpu_percent": round(100 * cpu / dt, 1),
+                "rss_mb_peak": round(max(self.rss or [0]) / 2**20, 1),
+                "rss_mb_end": round(self.end[1][1] / 2**20, 1)}
+
+#==============================================================================
+# one simulated client
+#==============================================================================
+class SimClient:
+    def __init__(self, lg, name, v1):
+        self.lg = lg
+        self.name = name
+        self.version = FRAMING_V1 if v1 else FRAMING_LEGACY
+        self.waiting = {}   # action -> future of the reply
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        for attempt in range(50):
+            try:
+                self.reader, self.writer = await asyncio.open_connection(*self.lg.server)
+                break
+            except OSError:
+                await asyncio.sleep(0.1 * (attempt + 1))
+        else:
+            raise ConnectionError(f'{self.name}: cannot connect')
+        asyncio.ensure_future(self.read_loop())
+
+    async def send(self, msg):
+        self.writer.write(encode_frame(json.dumps(msg).encode(), self.version))
+        await self.writer.drain()
+
+    async def rpc(self, msg, action=None):
+        action = action or msg["action"]
+        fut = asyncio.get_running_loop().create_future()
+        self.waiting[action] = fut
+        t0 = time.perf_counter()
+        await self.send(msg)
+        reply = await fut
+        return reply, (time.perf_counter() - t0) * 1000
+
+    async def read_loop(self):
+        try:
+            while True:
+                head = await self.reader.readexactly(HEADER_SIZE)
+                version, kind, size = parse_header(head)
+                body = await self.reader.readexactly(size)
+                if kind == KIND_JSON:
+                    self.on_msg(json.loads(body))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            self.lg.error(f'recv: {e}')
+        for fut in self.waiting.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError('server closed the connection'))
+
+    def on_msg(self, msg):
+        action = msg.get("action")
+        if action == "exchange":
+            text = msg.get("message", "")
+            if text.startswith(MARK + ' '):
+                sent = int(text.split(' ', 2)[1])
+                self.lg.delivered("exchange", (time.perf_counter_ns() - sent) / 1e6)
+            return
+        if action == "image_ref":
+            self.lg.image_delivered(msg.get("hash"))
+            return
+        if action == "image":
+            try:
+                self.lg.image_delivered(hashlib.sha256(base64.b64decode(msg.get("data", ""))).hexdigest())
+            except ValueError:
+                pass
+            return
+        if action == "connect" and msg.get("status") == "request":
+            return
+        fut = self.waiting.pop(action, None)
+        if fut is not None and not fut.done():
+            fut.set_result(msg)
+
+    async def login(self):
+        async with self.lg.login_gate:
+            await self.rpc({"action": "signup", "name": self.name, "password": "loadgen"})
+            for attempt in range(100):
+                reply, ms = await self.rpc({"action": "login", "name": self.name, "password": "loadgen"})
+                if reply.get("status") == "ok":
+                    self.lg.record("login", ms)
+                    return
+                await asyncio.sleep(0.05 * (attempt + 1))
+            raise ConnectionError(f'{self.name}: login failed: {reply}')
+
+    async def join_group(self, leader):
+        if leader is not self:
+            reply, ms = await self.rpc({"action": "connect", "target": leader.name})
+            self.lg.record("connect", ms)
+
+    #==========================================================================
+    # actions of the scenario mix
+    #==========================================================================
+    async def do_exchange(self):
+        filler = ' '.join(random.choice(WORDS) for _ in range(self.lg.p["msg_size"] // 6))
+        text = f'{MARK} {time.perf_counter_ns()} {filler}'
+        await self.send({"action": "exchange", "from": f"[{self.name}]", "message": text})
+        self.lg.sent("exchange")
+
+    async def do_search(self):
+        reply, ms = await self.rpc({"action": "search", "target": random.choice(WORDS)})
+        self.lg.sent("search")
+        self.lg.record("search", ms)
+
+    async def do_poem(self):
+        reply, ms = await self.rpc({"action": "poem", "target": random.randint(1, 154)})
+        self.lg.sent("poem")
+        self.lg.record("poem", ms)
+
+    async def do_time(self):
+        reply, ms = await self.rpc({"action": "time"})
+        self.lg.sent("time")
+        self.lg.record("time", ms)
+
+    async def do_image(self):
+        data = os.urandom(self.lg.p["image_size"])
+        digest = hashlib.sha256(data).hexdigest()
+        self.lg.images[digest] = time.perf_counter_ns()
+        if self.version == FRAMING_V1:
+            reply, ms = await self.rpc({"action": "image_offer", "hash": digest, "kind": "image", "size": len(data)})
+            if reply.get("status") == "send":
+                upload_id = new_upload_id()
+                await self.send({"action": "upload_begin", "upload": upload_id, "kind": "image",
+                                 "size": len(data), "hash": digest})
+                self.writer.writelines(upload_frames(upload_id, data))
+                await self.writer.drain()
+        else:
+            await self.send({"action": "image", "from": self.name, "data": base64.b64encode(data).decode()})
+        self.lg.sent("image")
+
+    async def traffic(self, until):
+        actions = list(self.lg.p["mix"].keys())
+        weights = list(self.lg.p["mix"].values())
+        interval = 1.0 / self.lg.p["rate"]
+        next_at = time.monotonic() + random.random() * interval
+        while True:
+            await asyncio.sleep(max(0, next_at - time.monotonic()))
+            if time.monotonic() >= until:
+                return
+            await getattr(self, 'do_' + random.choices(actions, weights)[0])()
+            next_at += interval
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+#==============================================================================
+# the whole run
+#==============================================================================
+class LoadGen:
+    def __init__(self, name, params, server=SERVER, pid=None):
+        self.name = name
+        self.p = dict(DEFAULTS, **params)
+        self.server = server
+        self.pid = pid
+        self.measuring = False
+        self.images = {}        # digest -> send time (ns)
+        self.counts = {}        # action -> sent while measuring
+        self.deliveries = 0
+        self.latency = {}       # kind -> list of ms
+        self.errors = {}
+        self.login_gate = None
+
+    def sent(self, action):
+        if self.measuring:
+            self.counts[action] = self.counts.get(action, 0) + 1
+
+    def record(self, kind, ms):
+        if self.measuring or kind in ("login", "connect"):
+            self.latency.setdefault(kind, []).append(ms)
+
+    def delivered(self, kind, ms):
+        if self.measuring:
+            self.deliveries += 1
+            self.latency.setdefault("fanout_" + kind, []).append(ms)
+
+    def image_delivered(self, digest):
+        sent = self.images.get(digest)
+        if sent is not None:
+            self.delivered("image", (time.perf_counter_ns() - sent) / 1e6)
+
+    def error(self, what):
+        self.errors[what] = self.errors.get(what, 0) + 1
+
+    async def run(self):
+        p = self.p
+        self.login_gate = asyncio.Semaphore(p["login_concurrency"])
+        legacy = int(p["users"] * p["legacy_fraction"])
+        clients = [SimClient(self, f'lg{i}', i >= legacy) for i in range(p["users"])]
+        sampler = ProcSampler(self.pid) if self.pid else None
+        if sampler:
+            sampler_task = asyncio.ensure_future(sampler.run())
+
+        t0 = time.monotonic()
+        await asyncio.gather(*(c.open() for c in clients))
+        await asyncio.gather(*(c.login() for c in clients))
+        for start in range(0, len(clients), p["group_size"]):
+            group = clients[start:start + p["group_size"]]
+            await asyncio.gather(*(c.join_group(group[0]) for c in group))
+        setup = time.monotonic() - t0
+        print(f'{len(clients)} clients logged in and grouped in {setup:.1f}s')
+
+        until = time.monotonic() + p["warmup"] + p["duration"]
+        traffic = asyncio.gather(*(c.traffic(until) for c in clients), return_exceptions=True)
+        await asyncio.sleep(p["warmup"])
+        self.measuring = True
+        if sampler:
+            sampler.mark_start()
+        measured = time.monotonic()
+        for result in await traffic:
+            if isinstance(result, Exception):
+                self.error(f'traffic: {result}')
+        await asyncio.sleep(0.5)  # let the last deliveries in
+        self.measuring = False
+        elapsed = time.monotonic() - measured
+        if sampler:
+            sampler.mark_end()
+            sampler_task.cancel()
+        for c in clients:
+            c.close()
+
+        sent = sum(self.counts.values())
+        return {"scenario": self.name, "params": p, "setup_s": round(setup, 2),
+                "elapsed_s": round(elapsed, 2), "sent": self.counts,
+                "sent_per_sec": round(sent / elapsed, 1),
+                "delivered": self.deliveries,
+                "delivered_per_sec": round(self.deliveries / elapsed, 1),
+                "latency_ms": {k: percentiles(v) for k, v in sorted(self.latency.items())},
+                "errors": self.errors,
+                "server": sampler.report() if sampler else None}
+
+#==============================================================================
+# server started for the run, in its own scratch directory
+#==============================================================================
+def spawn_server(server_args):
+    workdir = tempfile.mkdtemp(prefix='chat_loadgen_')
+    for fname in ('AllSonnets.txt', 'roman.txt.pk'):
+        os.symlink(os.path.join(HERE, fname), os.path.join(workdir, fname))
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'chat_server.py')] + shlex.split(server_args),
+                            cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    print(f'server pid {proc.pid}, log in {workdir}')
+    return proc
+
+def wait_for_server(server, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise SystemExit('server exited, see its log')
+        try:
+            socket.create_connection(server, timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f'no server at {server}')
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def show(report, baseline=None):
+    print(f'\n== {report["scenario"]}: {report["params"]["users"]} users, '
+          f'groups of {report["params"]["group_size"]}, {report["elapsed_s"]}s')
+    old = dict(flatten(baseline)) if baseline else {}
+    for label, value in flatten(report):
+        line = f'  {label:<24} {value:>10}'
+        if label in old and old[label]:
+            line += f'   (baseline {old[label]}, {100 * (value - old[label]) / old[label]:+.1f}%)'
+        print(line)
+    if report["errors"]:
+        print('  errors:', report["errors"])
+
+def flatten(report):
+    yield "sent/s", report["sent_per_sec"]
+    yield "delivered/s", report["delivered_per_sec"]
+    for kind, pc in report["latency_ms"].items():
+        if pc["count"]:
+            yield f'{kind} p50 ms', pc["p50"]
+            yield f'{kind} p99 ms', pc["p99"]
+    if report.get("server") and "cpu_percent" in report["server"]:
+        yield "server cpu %", report["server"]["cpu_percent"]
+        yield "server rss MB", report["server"]["rss_mb_peak"]
+
+def main():
+    parser = argparse.ArgumentParser(description='chat server load generator')
+    parser.add_argument('scenario', nargs='?', default='smoke', help='scenario name from the scenarios file')
+    parser.add_argument('--scenarios', default=SCENARIOS, help='scenarios file')
+    parser.add_argument('--list', action='store_true', help='list the scenarios and exit')
+    parser.add_argument('--host', default=SERVER[0])
+    parser.add_argument('--port', type=int, default=SERVER[1])
+    parser.add_argument('--spawn', action='store_true', help='start chat_server.py for this run')
+    parser.add_argument('--server-args', default='', help='arguments for the spawned server')
+    parser.add_argument('--pid', type=int, default=None, help='pid of a running server, for CPU/RSS')
+    parser.add_argument('--users', type=int, default=None, help='override the number of users')
+    parser.add_argument('--duration', type=float, default=None, help='override the measured seconds')
+    parser.add_argument('--out', default=None, help='write the report as json')
+    parser.add_argument('--baseline', default=None, help='report of an earlier run to compare with')
+    args = parser.parse_args()
+
+    with open(args.scenarios) as f:
+        scenarios = json.load(f)
+    if args.list:
+        for name, sc in scenarios.items():
+            print(f'{name:<14} {sc.get("description", "")}')
+        return
+    params = dict(scenarios[args.scenario])
+    params.pop("description", None)
+    if args.users:
+        params["users"] = args.users
+    if args.duration:
+        params["duration"] = args.duration
+
+    raise_fd_limit()
+    proc, pid = None, args.pid
+    if args.spawn:
+        proc = spawn_server(args.server_args)
+        pid = proc.pid
+    try:
+        wait_for_server((args.host, args.port), proc)
+        lg = LoadGen(args.scenario, params, (args.host, args.port), pid)
+        report = asyncio.run(lg.run())
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    report["server_args"] = args.server_args
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    show(report, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
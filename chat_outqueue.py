@@ -0,0 +1,130 @@
+"""
+Per-connection outbound write queue for the chat server
+
+Every connection gets an OutQueue. The server pushes framed bytes into it
+and drains it only when the socket is writable, so one slow reader never
+stalls the fan-out to everybody else.
+
+The queue is bounded (in bytes). What happens when a consumer cannot keep
+up is decided by the slow consumer policy:
+    - drop_oldest: throw away the oldest frames that have not started
+                   going out yet, until the new frame fits
+    - disconnect:  give up on the connection
+    - coalesce:    frames pushed with a key (e.g. "list" replies) replace
+                   older queued frames with the same key; if the queue is
+                   still over budget, disconnect
+A frame pushed into an empty queue is always accepted, so one big image
+does not need a limit bigger than itself.
+"""
+
+from collections import deque
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_DISCONNECT = 'disconnect'
+POLICY_COALESCE = 'coalesce'
+POLICIES = (POLICY_DROP_OLDEST, POLICY_DISCONNECT, POLICY_COALESCE)
+
+OUTQ_LIMIT = 16 * 1024 * 1024  # bytes buffered per connection
+
+class OutQueue:
+    def __init__(self, limit=OUTQ_LIMIT, policy=POLICY_DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown slow consumer policy: {policy}')
+        self.limit = limit
+        self.policy = policy
+        self.frames = deque()   # [key, frame] pairs, oldest first
+        self.head_sent = 0      # bytes of frames[0] already on the wire
+        self.buffered = 0       # bytes still to go out
+        # counters
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+
+    def pending(self):
+        return self.buffered > 0
+
+    def push(self, frame, key=None):
+        # returns False when the connection should be dropped
+        if self.policy == POLICY_COALESCE and key is not None:
+            self._coalesce(key)
+        if self.frames and self.buffered + len(frame) > self.limit:
+            if self.policy == POLICY_DROP_OLDEST:
+                self._drop_oldest(len(frame))
+            if self.buffered + len(frame) > self.limit:
+                if self.policy != POLICY_DROP_OLDEST:
+                    return False
+                self.dropped += 1   # even the new frame does not fit
+                return True
+        self.frames.append([key, frame])
+        self.buffered += len(frame)
+        self.frames_in += 1
+        self.high_water = max(self.high_water, self.buffered)
+        return True
+
+    def _coalesce(self, key):
+        # the frame being written keeps its place, the stream must stay whole
+        start = 1 if self.head_sent else 0
+        for item in list(self.frames)[start:]:
+            if item[0] == key:
+                self.frames.remove(item)
+                self.buffered -= len(item[1])
+                self.coalesced += 1
+
+    def _drop_oldest(self, need):
+        start = 1 if self.head_sent else 0
+        while len(self.frames) > start and self.buffered + need > self.limit:
+            if start:
+                item = self.frames[1]
+                del self.frames[1]
+            else:
+                item = self.frames.popleft()
+            self.buffered -= len(item[1])
+            self.dropped += 1
+
+    def pop(self):
+        # hand out the next whole frame (asyncio engine: the transport does the partial writes)
+        key, frame = self.frames.popleft()
+        frame = memoryview(frame)[self.head_sent:]
+        self.head_sent = 0
+        self.buffered -= len(frame)
+        self.frames_out += 1
+        self.bytes_out += len(frame)
+        return frame
+
+    def flush(self, send):
+        # write as much as the socket takes; send() may raise BlockingIOError
+        total = 0
+        try:
+            while self.frames:
+                frame = self.frames[0][1]
+                sent = send(memoryview(frame)[self.head_sent:])
+                if sent == 0:
+                    raise ConnectionError('socket connection broken')
+                self.head_sent += sent
+                self.buffered -= sent
+                self.bytes_out += sent
+                total += sent
+                if self.head_sent == len(frame):
+                    self.frames.popleft()
+                    self.head_sent = 0
+                    self.frames_out += 1
+        except (BlockingIOError, InterruptedError):
+            pass
+        return total
+
+    def stats(self):
+        return {"buffered": self.buffered, "frames": len(self.frames),
+                "high_water": self.high_water, "frames_in": self.frames_in,
+                "frames_out": self.frames_out, "bytes_out": self.bytes_out,
+                "dropped": self.dropped, "coalesced": self.coalesced}
+
+if __name__ == "__main__":
+    q = OutQueue(limit=10, policy=POLICY_DROP_OLDEST)
+    for f in [b'aaaa', b'bbbb', b'cccc']:
+        q.push(f)
+    print(q.stats())   # 'aaaa' was dropped to make room for 'cccc'
+    q.flush(lambda v: min(len(v), 3))
+    print(q.stats())
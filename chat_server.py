@@ -4,34 +4,90 @@ Created on Tue Jul 22 00:47:05 2014
 @author: alina, zzhang
 """
 
+import os
 import time
 import socket
 import select
 import sys
 import string
 import indexer
+import segment
+import history
+from query import QueryError
 import json
+import base64
 import pickle as pkl
 from chat_utils import *
 import chat_group as grp
 import database
 import ai_utils
+from chat_outqueue import *
+from chat_workers import WorkerPool, IndexQueue
+from attachments import AttachmentStore, digest_of, ATTACH_DIR, ATTACH_MAX_BYTES
+import chat_bus
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 from collections import deque
 
+def client_int(value, default=0):
+    #a number field of a client's message, default when it is left out,
+    #None when it is not a whole number
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
 class Server:
-    def __init__(self):
+    def __init__(self, outq_limit=OUTQ_LIMIT, slow_policy=POLICY_DROP_OLDEST,
+                 ai_backend='openai', ai_workers=4, ai_per_user=1, ai_max_pending=32,
+                 auth_workers=None, auth_max_pending=256, max_frame=MAX_FRAME_SIZE,
+                 attach_dir=ATTACH_DIR, attach_max_bytes=ATTACH_MAX_BYTES,
+                 bus=None, reuse_port=False, compact_workers=1,
+                 index_budget=history.INDEX_BUDGET, index_max_loaded=history.INDEX_MAX_LOADED):
         self.new_clients = [] #list of new sockets of which the user id is not known
         self.logged_name2sock = {} #dictionary mapping username to socket
         self.logged_sock2name = {} # dict mapping socket to user name
         self.all_sockets = []
+        # outbound write queue per socket, drained when the socket is writable
+        self.outq = {}
+        self.outq_limit = outq_limit
+        self.slow_policy = slow_policy
+        self.to_drop = set() # slow consumers, dropped at the end of the loop iteration
+        # inbound frame decoder and framing version (legacy or v1) per socket
+        self.decoders = {}
+        self.framing = {}
+        self.max_frame = max_frame
+        # several processes may listen on the same port (SO_REUSEPORT)
+        self.reuse_port = reuse_port
+        # binary uploads being relayed: upload id -> sender, recipients, progress
+        self.uploads = {}
+        # images are stored once by hash, rooms only pass references around
+        self.attachments = AttachmentStore(attach_dir, attach_max_bytes)
         self.group = grp.Group()
-        #start server
-        self.server=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind(SERVER)
-        self.server.listen(5)
-        self.all_sockets.append(self.server)
-        #initialize past chat indices
+        # presence subscribers: one snapshot on subscribe, then join/leave/state deltas
+        self.presence_subs = set()
+        self.presence_seq = 0
+        self.listen()
+        #chat history of the users online: history.HistoryView, their own
+        #index and what they saw of the shared stores
         self.indices={}
+        # room and group messages are stored once, in a shared store, see history.py
+        self.own_stores = set() # stores made by this process: the ones it writes to
+        self.room_stores = {}   # room -> its store in this process, while members are online here
+        self.store_locks = {}   # room store -> its lock, see history.claim_store
+        self.group_stores = {}  # group key -> its store
+        self.user_group = {}    # user -> group key of their open group span
+        # searches being streamed: socket -> what is left to send, see search()
+        self.search_streams = {}
+        # own indices and stores are loaded when needed, the coldest are
+        # closed when they take more than index_budget bytes or are more than
+        # index_max_loaded; stores this process does not write to go first
+        self.index_cache = history.IndexCache(self.load_index, self.index_evicted, index_budget,
+                                              index_max_loaded, self.store_idle)
+        # relaying a message only queues it, the loop indexes it after the sends
+        self.index_queue = IndexQueue(self.index_cache.get)
         # sonnet
         # self.sonnet_f = open('AllSonnets.txt.idx', 'rb')
         # self.sonnet = pkl.load(self.sonnet_f)
@@ -39,95 +95,555 @@ class Server:
         self.sonnet = indexer.PIndex("AllSonnets.txt")
         # Database for authentication
         self.db = database.Database()
+        # named rooms: membership is persistent (database), the fan-out lists
+        # only hold the members online: room -> framing -> {sock: name}
+        self.rooms = grp.Rooms()
+        for room, name in self.db.get_room_members():
+            self.rooms.join(room, name)
+        self.room_socks = {}
+        # bcrypt checks run in other processes, one in flight per connection
+        auth_ctx = multiprocessing.get_context('spawn')
+        self.auth_pool = WorkerPool(ProcessPoolExecutor(auth_workers, mp_context=auth_ctx),
+                                    auth_max_pending, 1, self.wake)
+        # message logs are folded into the history segments in other processes
+        self.compact_pool = WorkerPool(ProcessPoolExecutor(compact_workers, mp_context=auth_ctx),
+                                       1024, 1, self.wake)
+        self.compacting = set()
         # AI handler for processing AI queries
-        self.ai = ai_utils.AIHandler()
+        if ai_backend == 'fake':
+            self.ai = ai_utils.FakeAIHandler()
+        else:
+            self.ai = ai_utils.AIHandler()
+        # AI calls are slow: they run on a worker pool and come back through wake()
+        self.ai_pool = WorkerPool(ThreadPoolExecutor(ai_workers), ai_max_pending, ai_per_user, self.wake)
         # Chat history per user (for AI context) - stores last 20 messages
         self.chat_history = {}  # {username: deque([msg1, msg2, ...], maxlen=20)}
+        # other server processes: presence, rooms and room messages go over the bus
+        self.node = f'{socket.gethostname()}:{os.getpid()}'
+        self.remote_users = {}  # name -> (node, state name), users logged in elsewhere
+        self.bus = chat_bus.connect(bus, self.node, self.wake)
+        self.bus.on_message = self.on_bus
+        self.bus.subscribe("presence")
+        self.bus.subscribe("rooms")
+        self.bus.publish("presence", {"event":"sync", "node":self.node})
+    def listen(self):
+        #start server
+        self.server=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.reuse_port:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server.bind(SERVER)
+        self.server.listen(5)
+        self.all_sockets.append(self.server)
+        #worker threads poke this socket pair when a job is done
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(0)
+        self.wakeup_w.setblocking(0)
+        self.all_sockets.append(self.wakeup_r)
+
+    def wake(self):
+        #called from worker threads
+        try:
+            self.wakeup_w.send(b'x')
+        except (BlockingIOError, InterruptedError):
+            pass #a wakeup is already pending
+
+    def run_callbacks(self):
+        #finished worker jobs, on the loop thread
+        self.auth_pool.run_callbacks()
+        self.ai_pool.run_callbacks()
+        self.compact_pool.run_callbacks()
+        self.bus.run_callbacks()
+
+    def send(self, sock, msg, key=None):
+        #frame msg in the framing of this socket and queue it
+        try:
+            frame = encode_frame(msg, self.framing.get(sock, FRAMING_LEGACY))
+        except FrameError as e:
+            print(f'send error: {e}')
+            return False
+        return self.push(sock, frame, key)
+
+    def broadcast(self, names, msg, key=None):
+        #one json.dumps and one frame per framing version for the whole room;
+        #every member of the room gets the very same bytes object
+        payload = json.dumps(msg).encode()
+        frames = {}
+        for name in names:
+            sock = self.logged_name2sock.get(name)
+            if sock is None:
+                continue
+            version = self.framing.get(sock, FRAMING_LEGACY)
+            if version not in frames:
+                try:
+                    frames[version] = encode_frame(payload, version)
+                except FrameError as e:
+                    print(f'send error: {e}')
+                    frames[version] = None
+            if frames[version] is not None:
+                self.push(sock, frames[version], key)
+
+    def push(self, sock, frame, key=None):
+        #every outgoing frame goes through here, so other engines can override it
+        #frames are queued and written when the socket can take them
+        q = self.outq.get(sock)
+        if q is None:
+            return False
+        if not q.push(frame, key):
+            print('slow consumer', self.logged_sock2name.get(sock, sock), 'dropped')
+            self.kick(sock)
+            return False
+        self.flush(sock)
+        return True
+
+    def flush(self, sock):
+        try:
+            self.outq[sock].flush(sock.send)
+        except OSError as e:
+            print(f'send error: {e}')
+            self.kick(sock)
+
+    def kick(self, sock):
+        #we may be in the middle of a fan-out, drop the socket later
+        self.to_drop.add(sock)
+
+    def drop(self, sock):
+        if sock in self.logged_sock2name:
+            self.logout(sock)
+        else:
+            self.close(sock)
+
+    def close(self, sock):
+        #forget the socket and close it
+        if sock in self.all_sockets:
+            self.all_sockets.remove(sock)
+        if sock in self.new_clients:
+            self.new_clients.remove(sock)
+        self.forget(sock)
+        sock.close()
+
+    def forget(self, sock):
+        #per connection state, whatever the engine
+        self.outq.pop(sock, None)
+        self.decoders.pop(sock, None)
+        self.framing.pop(sock, None)
+        for upload_id in [u for u in self.uploads if self.uploads[u]["sender"] is sock]:
+            del self.uploads[upload_id]
+        self.search_streams.pop(sock, None)
+
+    def recv_frames(self, sock):
+        #whatever the socket has for us: a list of (kind, frame, payload);
+        #kind None at the end means the peer is gone
+        decoder = self.decoders[sock]
+        try:
+            frames, alive = decoder.recv_from(sock)
+        except (FrameError, OSError) as e:
+            print(f'recv error: {e}')
+            frames, alive = [], False
+        if decoder.version is not None:
+            self.framing[sock] = decoder.version
+        if not alive:
+            frames.append((None, None, None))
+        return frames
+
+    def handle_frame(self, sock, kind, frame, body):
+        #one frame from a client, both engines come through here
+        if kind is None: #client died unexpectedly
+            self.drop(sock)
+        elif kind == KIND_CHUNK:
+            if sock in self.logged_sock2name:
+                self.relay_chunk(sock, frame, body)
+        elif kind == KIND_JSON and len(body) > 0:
+            msg = str(body, 'utf-8', 'replace')
+            if sock in self.logged_sock2name:
+                self.dispatch(sock, msg)
+            else:
+                self.do_login(sock, msg)
+
+    def stats(self):
+        #outbound buffer counters per logged in user
+        outq = {}
+        for name, sock in self.logged_name2sock.items():
+            if sock in self.outq:
+                outq[name] = self.outq[sock].stats()
+        return {"outq": outq, "ai_pool": self.ai_pool.stats(),
+                "auth_pool": self.auth_pool.stats(), "compact_pool": self.compact_pool.stats(),
+                "uploads": len(self.uploads), "index_cache": self.index_cache.stats(),
+                "index_queue": self.index_queue.stats(),
+                "attachments": self.attachments.stats(), "presence_subs": len(self.presence_subs),
+                "rooms": len(self.rooms.rooms), "rooms_online": len(self.room_socks),
+                "bus": self.bus.stats(), "remote_users": len(self.remote_users)}
+
     def new_client(self, sock):
         #add to all sockets and to new clients
         print('new client...')
         sock.setblocking(0)
+        self.outq[sock] = OutQueue(self.outq_limit, self.slow_policy)
+        self.decoders[sock] = FrameDecoder(self.max_frame)
         self.new_clients.append(sock)
         self.all_sockets.append(sock)
 
     def login(self, sock):
         #read the msg that should have login code plus username and password
+        self.handle_msg(sock)
+
+    def do_login(self, sock, msg):
         try:
-            msg = json.loads(myrecv(sock))
+            if len(msg) == 0: #client died unexpectedly
+                self.close(sock)
+                return
+            msg = json.loads(msg)
             print("login/signup:", msg)
             if len(msg) > 0:
 
+                # bcrypt is slow on purpose: check passwords on the auth process pool
                 if msg["action"] == "signup":
                     name = msg["name"]
                     password = msg["password"]
                     
-                    success, message = self.db.signup(name, password)
-                    if success:
-                        mysend(sock, json.dumps({"action":"signup", "status":"ok", "message":message}))
-                        print(f'{name} signed up successfully')
-                    else:
-                        mysend(sock, json.dumps({"action":"signup", "status":"error", "message":message}))
-                        print(f'Signup failed for {name}: {message}')
+                    done = lambda result, err: self.signup_done(sock, name, result, err)
+                    if not self.auth_pool.submit(sock, done, self.db.signup, name, password):
+                        self.send(sock, json.dumps({"action":"signup", "status":"error", "message":"Server busy, please try again"}))
                 
                 elif msg["action"] == "login":
                     name = msg["name"]
                     password = msg["password"]
                     
                     # Authenticate with database
-                    success, message = self.db.login(name, password)
-                    
-                    if success and self.group.is_member(name) != True:
-                        #move socket from new clients list to logged clients
-                        self.new_clients.remove(sock)
-                        #add into the name to sock mapping
-                        self.logged_name2sock[name] = sock
-                        self.logged_sock2name[sock] = name
-                        #load chat history of that user
-                        if name not in self.indices.keys():
-                            try:
-                                self.indices[name]=pkl.load(open(name+'.idx','rb'))
-                            except IOError: #chat index does not exist, then create one
-                                self.indices[name] = indexer.Index(name)
-                        # Initialize chat history for AI context
-                        if name not in self.chat_history:
-                            self.chat_history[name] = deque(maxlen=20)
-                        print(name + ' logged in')
-                        self.group.join(name)
-                        mysend(sock, json.dumps({"action":"login", "status":"ok"}))
-                    elif success and self.group.is_member(name):
-                        mysend(sock, json.dumps({"action":"login", "status":"duplicate"}))
-                        print(name + ' duplicate login attempt')
-                    else:
-                        mysend(sock, json.dumps({"action":"login", "status":"error", "message":message}))
-                        print(f'Login failed for {name}: {message}')
+                    done = lambda result, err: self.login_done(sock, name, result, err)
+                    if not self.auth_pool.submit(sock, done, self.db.login, name, password):
+                        self.send(sock, json.dumps({"action":"login", "status":"error", "message":"Server busy, please try again"}))
                 else:
                     print ('wrong code received')
-            else: #client died unexpectedly
-                self.logout(sock)
         except Exception as e:
             print(f"Login error: {e}")
             try:
-                self.all_sockets.remove(sock)
+                self.close(sock)
             except:
                 pass
 
+    def signup_done(self, sock, name, result, err):
+        if sock not in self.outq: #gave up waiting
+            return
+        success, message = result if err is None else (False, f"Signup failed: {err}")
+        if success:
+            self.send(sock, json.dumps({"action":"signup", "status":"ok", "message":message}))
+            print(f'{name} signed up successfully')
+        else:
+            self.send(sock, json.dumps({"action":"signup", "status":"error", "message":message}))
+            print(f'Signup failed for {name}: {message}')
+
+    def login_done(self, sock, name, result, err):
+        if sock not in self.outq or sock in self.logged_sock2name:
+            return
+        success, message = result if err is None else (False, f"Login failed: {err}")
+
+        online = self.group.is_member(name) or name in self.remote_users
+        if success and online != True:
+            #move socket from new clients list to logged clients
+            if sock in self.new_clients:
+                self.new_clients.remove(sock)
+            #add into the name to sock mapping
+            self.logged_name2sock[name] = sock
+            self.logged_sock2name[sock] = name
+            #chat history of that user: their <name>.seg and the spans of the
+            #shared stores they saw, loaded by the first search that needs them
+            if name not in self.indices.keys():
+                self.indices[name] = self.open_history(name)
+            # Initialize chat history for AI context
+            if name not in self.chat_history:
+                self.chat_history[name] = deque(maxlen=20)
+            print(name + ' logged in')
+            self.group.join(name)
+            for room in self.rooms.rooms_of(name):
+                self.room_online(room, name, sock)
+            self.send(sock, json.dumps({"action":"login", "status":"ok"}))
+            self.presence_event("join", name, grp.S_ALONE)
+        elif success and online:
+            self.send(sock, json.dumps({"action":"login", "status":"duplicate"}))
+            print(name + ' duplicate login attempt')
+        else:
+            self.send(sock, json.dumps({"action":"login", "status":"error", "message":message}))
+            print(f'Login failed for {name}: {message}')
+
     def logout(self, sock):
         #remove sock from all lists
+        if sock not in self.logged_sock2name: #already gone
+            self.close(sock)
+            return
         name = self.logged_sock2name[sock]
-        pkl.dump(self.indices[name], open(name + '.idx','wb'))
-        del self.indices[name]
         del self.logged_name2sock[name]
         del self.logged_sock2name[sock]
-        self.all_sockets.remove(sock)
+        for room in self.rooms.rooms_of(name):
+            self.room_offline(room, sock)
+        self.presence_subs.discard(name)
+        peers = self.group.list_me(name)[1:]
+        before = self.presence_before(peers)
         self.group.leave(name)
-        sock.close()
+        self.group_history([name] + peers)
+        self.close_history(name)
+        self.close(sock)
+        self.presence_event("leave", name)
+        self.presence_changed(before)
+
+    def compact(self, name):
+        #fold the user's message log into the history segment, in the background
+        if name in self.compacting or not segment.rotate_log(name):
+            return
+        done = lambda added, err: self.compact_done(name, added, err)
+        if self.compact_pool.submit(name, done, segment.compact, name):
+            self.compacting.add(name)
+
+    def compact_done(self, name, added, err):
+        self.compacting.discard(name)
+        if err is not None:
+            print(f'compaction of {name} failed, its log is kept: {err}')
+        elif added is None:
+            pass #another server process is compacting it
+        elif history.is_store(name) and name not in self.own_stores:
+            pass #a store given up meanwhile: a room store's log is its new writer's
+        elif self.index_cache.peek(name) is None:
+            self.compact(name) #opened and closed again meanwhile
+
+    def load_index(self, name):
+        #index cache miss: a user's <name>.seg, mapped, see segment.py, or a store
+        if history.is_store(name):
+            #only this process writes to its own stores
+            return segment.SegmentIndex(name, live=name in self.own_stores)
+        return segment.open_index(name)
+
+    def store_idle(self, name):
+        #a store only read for spans that are closed: nobody here sees its new messages
+        return history.is_store(name) and name not in self.own_stores
+
+    def index_evicted(self, name, idx):
+        #closed by the index cache: nothing is queued for it
+        idx.close()
+        if not history.is_store(name) or name in self.own_stores:
+            self.compact(name)
+
+#==============================================================================
+# shared history: a room (in this process) or a group keeps its messages in
+# one store; a user sees spans of the stores, from coming online in the room
+# or joining the group to going offline or leaving, see history.py
+#==============================================================================
+    def open_history(self, name):
+        view = history.HistoryView(name, self.index_cache.get)
+        for rid, sid, start, stop in self.db.get_history_ranges(name):
+            if not os.path.exists(segment.seg_path(sid)):
+                print(f'{sid}: shared store is missing, skipped')
+                continue
+            if stop is None: #the server died while the user was online
+                stop = self.store_size(sid)
+                self.db.update_history_range(rid, stop)
+            else:
+                self.store_size(sid, stop)
+            #one row per stretch of the store: empty ones go, one that
+            #starts where the last one stopped is merged into it
+            last = view.last_span(sid)
+            if start == stop:
+                self.db.delete_history_range(rid)
+            elif last is not None and last.stop == start:
+                last.stop = stop
+                self.db.update_history_range(last.rid, stop)
+                self.db.delete_history_range(rid)
+            else:
+                view.add_span(sid, start, stop, rid)
+        return view
+
+    def close_history(self, name):
+        #the user's own index is closed too: their next login may be on
+        #another server process, which then writes to their log
+        del self.indices[name]
+        self.index_queue.flush(name)
+        self.index_cache.close(name)
+        self.compact(name) #also a log left by a crash, when the index was never loaded
+
+    def history_open(self, name, sid):
+        view = self.indices[name]
+        span = view.open_span(sid, self.store_size(sid))
+        if span.rid is None:
+            span.rid = self.db.add_history_range(name, sid, span.start)
+        else:
+            self.db.update_history_range(span.rid, None)
+
+    def history_close(self, name, sid):
+        view = self.indices[name]
+        if sid in view.live:
+            span = view.close_span(sid, self.store_size(sid))
+            if span.start == span.stop:
+                self.db.delete_history_range(span.rid)
+            else:
+                self.db.update_history_range(span.rid, span.stop)
+
+    def store_size(self, sid, at_least=None):
+        #messages in the store. Spans start and stop between indexed messages.
+        #at_least: only check a loaded store has them, or it is reloaded.
+        #A store that is not loaded is counted on disk, and stays closed
+        self.index_queue.flush(sid)
+        idx = self.index_cache.peek(sid)
+        if at_least is not None:
+            if idx is not None and idx.get_msg_size() < at_least:
+                #a snapshot of another process's store, from before it grew
+                self.index_cache.close(sid)
+            return at_least
+        if idx is not None:
+            return idx.get_msg_size()
+        return segment.msg_count(sid)
+
+    def group_history(self, names):
+        #after a connect, disconnect or leave: each user's open group span
+        #follows the group they are in now
+        gone = set()
+        for name in names:
+            key = self.group.member_grp.get(name)
+            old = self.user_group.get(name)
+            if key == old or name not in self.indices:
+                continue
+            if old is not None:
+                self.history_close(name, self.group_stores[old])
+                del self.user_group[name]
+                gone.add(old)
+            if key is not None:
+                if key not in self.group_stores:
+                    self.group_stores[key] = self.new_store()
+                self.history_open(name, self.group_stores[key])
+                self.user_group[name] = key
+        for key in gone:
+            if key not in self.group.chat_grps:
+                self.drop_store(self.group_stores.pop(key))
+
+    def new_store(self):
+        sid = history.new_store()
+        self.own_stores.add(sid)
+        return sid
+
+    def room_store(self, room):
+        #a store of the room from before, so its history stays in one store
+        #across restarts, unless another server process writes to it; or a new one
+        for sid in self.db.get_room_stores(room):
+            if not os.path.exists(segment.seg_path(sid)):
+                continue
+            lock = history.claim_store(sid)
+            if lock is not None:
+                self.index_cache.close(sid) #a snapshot from when another process wrote to it
+                self.store_locks[sid] = lock
+                self.own_stores.add(sid)
+                return sid
+        sid = self.new_store()
+        self.store_locks[sid] = history.claim_store(sid)
+        self.db.add_room_store(room, sid)
+        return sid
+
+    def drop_store(self, sid):
+        #nobody here is in the store's conversation any more: it is closed
+        #(and compacted), and deleted if nothing was said in it
+        self.index_queue.flush(sid)
+        self.index_cache.close(sid)
+        if sid not in self.compacting and segment.msg_count(sid) == 0:
+            history.delete_store(sid)
+            self.db.remove_room_store(sid)
+        #no longer written to here: a room store may be claimed by another process
+        self.own_stores.discard(sid)
+        lock = self.store_locks.pop(sid, None)
+        if lock is not None:
+            segment.unlock(lock)
+
+    def index_later(self, name, said2):
+        #the relay path only queues the message for the index (a user's own,
+        #or a store: one message, indexed once for everybody in the
+        #conversation), see run() for when it is indexed
+        self.index_queue.put(name, said2)
+
+#==============================================================================
+# search: AND/OR/NOT and "phrase" queries, see query.py, best matches first
+# or newest first; misspelled words are retried as word~ when nothing is
+# found. One page per request, or, with "stream", all of them in chunks: the
+# first goes out at once, the others one per loop round while the client
+# keeps up
+#==============================================================================
+    def search(self, sock, msg):
+        term = str(msg.get("target", ""))
+        from_name = self.logged_sock2name[sock]
+        print('search for ' + from_name + ' for ' + term)
+        offset, limit = client_int(msg.get("offset")), client_int(msg.get("limit"))
+        if offset is None or limit is None:
+            self.send(sock, json.dumps({"action":"search", "results":"",
+                                        "error":"offset and limit must be whole numbers"}))
+            return
+        offset = min(max(offset, 0), SEARCH_MAX_RESULTS)
+        stream = bool(msg.get("stream"))
+        newest = msg.get("order") == "newest"
+        if stream:
+            limit = limit or SEARCH_MAX_RESULTS
+        else:
+            limit = min(max(limit or SEARCH_LIMIT, 1), SEARCH_MAX_LIMIT)
+        limit = min(max(limit, 1), SEARCH_MAX_RESULTS - offset)
+        #read-your-writes: what is still queued for this user's history first
+        view = self.indices[from_name]
+        for name in [from_name] + view.store_names():
+            self.index_queue.flush(name)
+        #a new search ends the one streamed before
+        self.search_streams.pop(sock, None)
+        try:
+            if stream:
+                found = view.query_iter(term, respell=True, offset=offset, newest=newest)
+            else:
+                found = view.query(term, limit + 1, respell=True, offset=offset, newest=newest) if limit else []
+        except QueryError as e:
+            self.send(sock, json.dumps({"action":"search", "results":"", "error":str(e)}))
+            return
+        if stream:
+            self.search_streams[sock] = {"found":found, "head":next(found, None),
+                                         "offset":offset, "left":limit}
+            self.search_chunk(sock)
+            return
+        search_rslt = '\n'.join([x[-1] for x in found[:limit]])
+        print('server side search: ' + search_rslt)
+        reply = {"action":"search", "results":search_rslt}
+        if len(found) > limit and offset + limit < SEARCH_MAX_RESULTS:
+            reply["next"] = offset + limit
+        self.send(sock, json.dumps(reply))
+
+    def search_chunk(self, sock):
+        #the next SEARCH_CHUNK matches of the search streamed to sock
+        st = self.search_streams[sock]
+        lines = []
+        try:
+            while st["head"] is not None and st["left"] and len(lines) < SEARCH_CHUNK:
+                lines.append(st["head"][1])
+                st["left"] -= 1
+                st["offset"] += 1
+                st["head"] = next(st["found"], None)
+        except Exception as e:
+            print(f'search stream error: {e}')
+            st["head"] = None
+        done = st["head"] is None or not st["left"]
+        reply = {"action":"search", "results":'\n'.join(lines), "more":not done}
+        if done:
+            del self.search_streams[sock]
+            if st["head"] is not None and st["offset"] < SEARCH_MAX_RESULTS:
+                reply["next"] = st["offset"]
+        self.send(sock, json.dumps(reply))
+
+    def search_round(self):
+        #a chunk more of every streamed search whose client has read the last
+        #ones; True when some can go on right away
+        ready = False
+        for sock in list(self.search_streams):
+            if self.outq[sock].buffered < SEARCH_STREAM_BUFFER:
+                self.search_chunk(sock)
+                ready = ready or sock in self.search_streams
+        return ready
 
 #==============================================================================
 # main command switchboard
 #==============================================================================
     def handle_msg(self, from_sock):
         #read msg code
-        msg = myrecv(from_sock)
+        for kind, frame, body in self.recv_frames(from_sock):
+            self.handle_frame(from_sock, kind, frame, body)
+
+    def dispatch(self, from_sock, msg):
         if len(msg) > 0:
 #==============================================================================
 # handle connect request
@@ -141,25 +657,33 @@ class Server:
                 # connect to the peer
                 elif self.group.is_member(to_name):
                     to_sock = self.logged_name2sock[to_name]
+                    before = self.presence_before(self.group.list_me(from_name) + [to_name])
                     self.group.connect(from_name, to_name)
+                    self.group_history(before)
+                    self.presence_changed(before)
                     the_guys = self.group.list_me(from_name)
                     msg = json.dumps({"action":"connect", "status":"success"})
                     # Notify all connected users about the new connection
-                    for g in the_guys[1:]:
-                        to_sock = self.logged_name2sock[g]
-                        mysend(to_sock, json.dumps({"action":"connect", "status":"request", "from":from_name}))
+                    self.broadcast(the_guys[1:], {"action":"connect", "status":"request", "from":from_name})
                 else:
                     msg = json.dumps({"action":"connect", "status":"no-user"})
-                mysend(from_sock, msg)
+                self.send(from_sock, msg)
 #==============================================================================
 # handle messeage exchange: one peer for now. will need multicast later
 #==============================================================================
+            elif msg["action"] == "exchange" and "room" in msg:
+                self.room_exchange(from_sock, msg)
             elif msg["action"] == "exchange":
                 from_name = self.logged_sock2name[from_sock]
                 the_guys = self.group.list_me(from_name)
                 #said = msg["from"]+msg["message"]
                 said2 = text_proc(msg["message"], from_name)
-                self.indices[from_name].add_msg_and_index(said2)
+                #once in the group's store; talking to nobody, in the sender's own index
+                key = self.user_group.get(from_name)
+                if key is None:
+                    self.index_later(from_name, said2)
+                else:
+                    self.index_later(self.group_stores[key], said2)
                 # Add to chat history for AI context
                 message_text = msg["message"]
                 if from_name in self.chat_history:
@@ -167,12 +691,10 @@ class Server:
                 # Add timestamp for consistent formatting
                 ctime = time.strftime('%d.%m.%y,%H:%M', time.localtime())
                 for g in the_guys[1:]:
-                    to_sock = self.logged_name2sock[g]
-                    self.indices[g].add_msg_and_index(said2)
                     # Add to their chat history too
                     if g in self.chat_history:
                         self.chat_history[g].append(f"{from_name}: {message_text}")
-                    mysend(to_sock, json.dumps({"action":"exchange", "from":msg["from"], "message":msg["message"], "time":ctime}))
+                self.broadcast(the_guys[1:], {"action":"exchange", "from":msg["from"], "message":msg["message"], "time":ctime})
 #==============================================================================
 # handle image exchange
 #==============================================================================
@@ -180,16 +702,80 @@ class Server:
                  from_name = self.logged_sock2name[from_sock]
                  the_guys = self.group.list_me(from_name)
                  # We don't index images in text search for now
-                 for g in the_guys[1:]:
-                     to_sock = self.logged_name2sock[g]
-                     mysend(to_sock, json.dumps({"action":"image", "from":msg["from"], "data":msg["data"]}))
+                 try:
+                     data = base64.b64decode(msg["data"])
+                 except ValueError:
+                     data = None
+                 if data:
+                     self.post_image(the_guys[1:], msg["from"], data=data, b64=msg["data"])
+#==============================================================================
+# image offered by hash: only uploaded when the store does not have it yet
+#==============================================================================
+            elif msg["action"] == "image_offer":
+                from_name = self.logged_sock2name[from_sock]
+                digest = str(msg["hash"])
+                if self.attachments.offered(digest):
+                    the_guys = self.group.list_me(from_name)
+                    self.post_image(the_guys[1:], from_name, digest=digest)
+                    self.send(from_sock, json.dumps({"action":"image_offer", "hash":digest, "status":"stored"}))
+                else:
+                    self.send(from_sock, json.dumps({"action":"image_offer", "hash":digest, "status":"send"}))
+#==============================================================================
+# client cache miss on an image_ref
+#==============================================================================
+            elif msg["action"] == "fetch":
+                self.send_attachment(from_sock, str(msg["hash"]), msg.get("from", ""))
+#==============================================================================
+# binary upload announced: chunk frames follow, see relay_chunk
+#==============================================================================
+            elif msg["action"] == "upload_begin":
+                from_name = self.logged_sock2name[from_sock]
+                upload_id = client_int(msg.get("upload"), None)
+                size = client_int(msg.get("size"))
+                if upload_id is None or not 0 <= upload_id < 2 ** 64 or upload_id in self.uploads \
+                        or size is None or not 0 <= size <= MAX_UPLOAD_SIZE \
+                        or self.framing.get(from_sock) != FRAMING_V1:
+                    self.send(from_sock, json.dumps({"action":"upload_begin", "upload":msg.get("upload"),
+                                                     "status":"error"}))
+                else:
+                    the_guys = self.group.list_me(from_name)
+                    self.begin_upload(from_sock, from_name, upload_id, msg.get("kind", "image"), size,
+                                      the_guys[1:], msg.get("hash"))
 #==============================================================================
 #                 listing available peers
 #==============================================================================
             elif msg["action"] == "list":
                 from_name = self.logged_sock2name[from_sock]
                 msg = self.group.list_all()
-                mysend(from_sock, json.dumps({"action":"list", "results":msg}))
+                self.send(from_sock, json.dumps({"action":"list", "results":msg}), key="list")
+#==============================================================================
+#                 named rooms
+#==============================================================================
+            elif msg["action"] == "room_join":
+                self.room_join(from_sock, str(msg.get("room", "")).strip())
+            elif msg["action"] == "room_leave":
+                self.room_leave(from_sock, str(msg.get("room", "")).strip())
+            elif msg["action"] == "room_list":
+                from_name = self.logged_sock2name[from_sock]
+                mine = self.rooms.rooms_of(from_name)
+                results = [{"room":room, "members":n, "online":self.room_online_count(room), "joined":room in mine}
+                           for room, n in sorted(self.rooms.list_all().items())]
+                self.send(from_sock, json.dumps({"action":"room_list", "results":results}))
+#==============================================================================
+#                 presence: snapshot now, deltas as they happen
+#==============================================================================
+            elif msg["action"] == "presence_subscribe":
+                from_name = self.logged_sock2name[from_sock]
+                self.presence_subs.add(from_name)
+                self.send(from_sock, json.dumps({"action":"presence", "event":"snapshot",
+                                                 "seq":self.presence_seq, "users":self.presence_snapshot()}))
+            elif msg["action"] == "presence_unsubscribe":
+                self.presence_subs.discard(self.logged_sock2name[from_sock])
+#==============================================================================
+#                 server counters
+#==============================================================================
+            elif msg["action"] == "stats":
+                self.send(from_sock, json.dumps({"action":"stats", "results":self.stats()}))
 #==============================================================================
 #             retrieve a sonnet
 #==============================================================================
@@ -200,92 +786,394 @@ class Server:
                 poem = self.sonnet.get_poem(poem_indx)
                 poem = '\n'.join(poem).strip()
                 print('here:\n', poem)
-                mysend(from_sock, json.dumps({"action":"poem", "results":poem}))
+                self.send(from_sock, json.dumps({"action":"poem", "results":poem}))
 #==============================================================================
 #                 time
 #==============================================================================
             elif msg["action"] == "time":
                 ctime = time.strftime('%d.%m.%y,%H:%M', time.localtime())
-                mysend(from_sock, json.dumps({"action":"time", "results":ctime}))
+                self.send(from_sock, json.dumps({"action":"time", "results":ctime}))
 #==============================================================================
 #                 search
 #==============================================================================
             elif msg["action"] == "search":
-                term = msg["target"]
-                from_name = self.logged_sock2name[from_sock]
-                print('search for ' + from_name + ' for ' + term)
-                # search_rslt = (self.indices[from_name].search(term))
-                search_rslt = '\n'.join([x[-1] for x in self.indices[from_name].search(term)])
-                print('server side search: ' + search_rslt)
-                mysend(from_sock, json.dumps({"action":"search", "results":search_rslt}))
+                self.search(from_sock, msg)
 #==============================================================================
 # the "from" guy has had enough (talking to "to")!
 #==============================================================================
             elif msg["action"] == "disconnect":
                 from_name = self.logged_sock2name[from_sock]
                 the_guys = self.group.list_me(from_name)
+                before = self.presence_before(the_guys)
                 self.group.disconnect(from_name)
+                self.group_history(before)
+                self.presence_changed(before)
                 the_guys.remove(from_name)
                 if len(the_guys) == 1:  # only one left
                     g = the_guys.pop()
                     to_sock = self.logged_name2sock[g]
-                    mysend(to_sock, json.dumps({"action":"disconnect"}))
+                    self.send(to_sock, json.dumps({"action":"disconnect"}))
 #==============================================================================
 #                 the "from" guy really, really has had enough
 #==============================================================================
             elif msg["action"] == "ai_query":
                 from_name = self.logged_sock2name[from_sock]
                 query = msg["query"]
-                the_guys = self.group.list_me(from_name)
                 
                 # Get chat history for context
                 history = list(self.chat_history.get(from_name, []))
                 
-                # Get AI response with user context
-                ai_response = self.ai.get_chat_response(history, query, from_name)
-                
-                # Broadcast AI response to all in room
-                ctime = time.strftime('%d.%m.%y,%H:%M', time.localtime())
-                ai_message = f"🤖 AI (responding to {from_name}): {ai_response}"
-                
-                for g in the_guys:
-                    to_sock = self.logged_name2sock[g]
-                    mysend(to_sock, json.dumps({"action":"exchange", "from":"[AI Assistant]", "message":ai_message, "time":ctime}))
-                    # Add to chat history
-                    if g in self.chat_history:
-                        self.chat_history[g].append(f"AI: {ai_response}")
+                # Get AI response with user context, on the worker pool
+                done = lambda ai_response, err: self.ai_query_done(from_name, ai_response, err)
+                if not self.ai_pool.submit(from_name, done, self.ai.get_chat_response, history, query, from_name):
+                    self.ai_busy(from_sock)
 #==============================================================================
 # AI Image Generation
 #==============================================================================
             elif msg["action"] == "ai_image":
                 from_name = self.logged_sock2name[from_sock]
                 prompt = msg["prompt"]
-                the_guys = self.group.list_me(from_name)
                 
-                # Generate image
-                image_data = self.ai.generate_image(prompt)
-                
-                if image_data and not image_data.startswith("Error") and not image_data.startswith("Image Gen Error"):
-                    # Broadcast image to all in room
-                    for g in the_guys:
-                        to_sock = self.logged_name2sock[g]
-                        mysend(to_sock, json.dumps({"action":"image", "from":f"[AI Image by {from_name}]", "data":image_data}))
-                else:
-                    # Send error back to requester
-                    mysend(from_sock, json.dumps({"action":"exchange", "from":"[System]", "message":f"Image generation failed: {image_data}"}))
+                # Generate image on the worker pool
+                done = lambda image_data, err: self.ai_image_done(from_name, image_data, err)
+                if not self.ai_pool.submit(from_name, done, self.ai.generate_image, prompt):
+                    self.ai_busy(from_sock)
 #==============================================================================
 
         else:
             #client died unexpectedly
             self.logout(from_sock)
 
+#==============================================================================
+# binary uploads: v1 members get the chunk frames exactly as they came in,
+# the payload is never parsed. Legacy members cannot take chunks, for them
+# the data is collected and sent as one base64 "image" message at the end.
+# An upload with a "hash" goes to the attachment store instead of the room,
+# the room gets an image_ref once it is complete.
+#==============================================================================
+    def split_framing(self, names):
+        v1, legacy = [], []
+        for g in names:
+            if self.framing.get(self.logged_name2sock[g], FRAMING_LEGACY) == FRAMING_V1:
+                v1.append(g)
+            else:
+                legacy.append(g)
+        return v1, legacy
+
+    def begin_upload(self, sock, from_name, upload_id, kind, size, names, digest=None):
+        if digest is not None:
+            self.uploads[upload_id] = {"sender":sock, "from":from_name, "kind":kind, "got":0,
+                                       "relay":[], "legacy":[], "names":names,
+                                       "hash":str(digest), "data":bytearray()}
+            return
+        relay, legacy = self.split_framing(names)
+        self.uploads[upload_id] = {"sender":sock, "from":from_name, "kind":kind, "got":0,
+                                   "relay":relay, "legacy":legacy,
+                                   "data":bytearray() if legacy else None}
+        self.broadcast(relay, {"action":"upload_begin", "upload":upload_id, "from":from_name, "kind":kind, "size":size})
+
+    def relay_chunk(self, sock, frame, body):
+        if len(body) < CHUNK_HEADER.size:
+            return
+        upload_id, seq, flags = CHUNK_HEADER.unpack_from(body)
+        up = self.uploads.get(upload_id)
+        if up is None or up["sender"] is not sock:
+            return
+        up["got"] += len(body) - CHUNK_HEADER.size
+        if up["got"] > MAX_UPLOAD_SIZE:
+            print(f'upload {upload_id} from {up["from"]} too big, dropped')
+            del self.uploads[upload_id]
+            return
+        for g in up["relay"]:
+            to_sock = self.logged_name2sock.get(g)
+            if to_sock is not None:
+                self.push(to_sock, frame)
+        if up["data"] is not None:
+            up["data"] += body[CHUNK_HEADER.size:]
+        if flags & CHUNK_LAST:
+            del self.uploads[upload_id]
+            if "hash" in up:
+                self.store_upload(up)
+            elif up["legacy"]:
+                data = base64.b64encode(up["data"]).decode()
+                self.broadcast(up["legacy"], {"action":"image", "from":up["from"], "data":data})
+
+    def store_upload(self, up):
+        digest = digest_of(up["data"])
+        if digest != up["hash"]:
+            print(f'upload from {up["from"]}: hash mismatch, stored as {digest}')
+        self.attachments.put(up["data"], digest)
+        names = [g for g in up["names"] if g in self.logged_name2sock]
+        self.post_image(names, up["from"], digest=digest)
+
+#==============================================================================
+# attachments: v1 members get a reference and fetch on a cache miss,
+# legacy members still get the whole image inline
+#==============================================================================
+    def post_image(self, names, from_label, data=None, b64=None, digest=None):
+        if data is not None:
+            digest = self.attachments.put(data)
+        v1, legacy = self.split_framing(names)
+        self.broadcast(v1, {"action":"image_ref", "hash":digest,
+                            "size":self.attachments.size_of(digest), "from":from_label})
+        if legacy and b64 is None:
+            data = data if data is not None else self.attachments.get(digest)
+            if data is None:
+                return
+            b64 = base64.b64encode(data).decode()
+        self.broadcast(legacy, {"action":"image", "from":from_label, "data":b64})
+
+    def send_attachment(self, sock, digest, from_label):
+        data = self.attachments.get(digest)
+        if data is None:
+            self.send(sock, json.dumps({"action":"fetch", "hash":digest, "status":"missing"}))
+        elif self.framing.get(sock) == FRAMING_V1:
+            upload_id = new_upload_id()
+            self.send(sock, json.dumps({"action":"upload_begin", "upload":upload_id, "from":from_label,
+                                        "kind":"image", "size":len(data), "hash":digest}))
+            for frame in upload_frames(upload_id, data):
+                if not self.push(sock, frame):
+                    return
+        else:
+            self.send(sock, json.dumps({"action":"image", "from":from_label,
+                                        "data":base64.b64encode(data).decode()}))
+
+#==============================================================================
+# named rooms: every room keeps the sockets of its members online, split by
+# framing, so a room message is framed once per framing and pushed to each
+# socket with no membership or name lookups, however big the room is.
+#==============================================================================
+    def room_online(self, room, name, sock):
+        if room not in self.room_socks:
+            self.bus.subscribe("room:" + room)
+        version = self.framing.get(sock, FRAMING_LEGACY)
+        self.room_socks.setdefault(room, {}).setdefault(version, {})[sock] = name
+        if room not in self.room_stores:
+            self.room_stores[room] = self.room_store(room)
+        self.history_open(name, self.room_stores[room])
+
+    def room_offline(self, room, sock):
+        by_version = self.room_socks.get(room, {})
+        for socks in by_version.values():
+            if sock in socks:
+                self.history_close(socks.pop(sock), self.room_stores[room])
+        if room in self.room_socks and not any(by_version.values()):
+            del self.room_socks[room]
+            self.bus.unsubscribe("room:" + room)
+            self.drop_store(self.room_stores.pop(room))
+
+    def room_online_count(self, room):
+        # members online here or on another server process
+        return sum(1 for name in self.rooms.members(room)
+                   if name in self.logged_name2sock or name in self.remote_users)
+
+    def room_event(self, room, event, name):
+        msg = {"action":"room_event", "room":room, "event":event, "name":name}
+        self.room_broadcast(room, msg)
+        self.bus.publish("room:" + room, {"kind":"event", "msg":msg})
+
+    def room_broadcast(self, room, msg, skip=None):
+        payload = json.dumps(msg).encode()
+        for version, socks in self.room_socks.get(room, {}).items():
+            if not socks:
+                continue
+            try:
+                frame = encode_frame(payload, version)
+            except FrameError as e:
+                print(f'send error: {e}')
+                continue
+            for sock in socks:
+                if sock is not skip:
+                    self.push(sock, frame)
+
+    def room_join(self, sock, room):
+        name = self.logged_sock2name[sock]
+        if not room or len(room) > grp.MAX_ROOM_NAME:
+            self.send(sock, json.dumps({"action":"room_join", "room":room, "status":"bad-name"}))
+        elif not self.rooms.join(room, name):
+            self.send(sock, json.dumps({"action":"room_join", "room":room, "status":"already"}))
+        else:
+            self.db.add_room_member(room, name)
+            self.bus.publish("rooms", {"op":"join", "room":room, "name":name})
+            self.room_event(room, "join", name)
+            self.room_online(room, name, sock)
+            self.send(sock, json.dumps({"action":"room_join", "room":room, "status":"ok",
+                                        "members":len(self.rooms.members(room))}))
+
+    def room_leave(self, sock, room):
+        name = self.logged_sock2name[sock]
+        if not self.rooms.leave(room, name):
+            self.send(sock, json.dumps({"action":"room_leave", "room":room, "status":"not-in"}))
+            return
+        self.db.remove_room_member(room, name)
+        self.bus.publish("rooms", {"op":"leave", "room":room, "name":name})
+        self.room_offline(room, sock)
+        self.room_event(room, "leave", name)
+        self.send(sock, json.dumps({"action":"room_leave", "room":room, "status":"ok"}))
+
+    def room_exchange(self, sock, msg):
+        from_name = self.logged_sock2name[sock]
+        room = str(msg.get("room", "")).strip()
+        if not room or len(room) > grp.MAX_ROOM_NAME:
+            self.send(sock, json.dumps({"action":"exchange", "from":"[System]", "room":room,
+                                        "message":"Bad room name"}))
+            return
+        if not self.rooms.is_in(room, from_name):
+            self.send(sock, json.dumps({"action":"exchange", "from":"[System]", "room":room,
+                                        "message":f"You are not in room {room}"}))
+            return
+        said2 = text_proc(msg["message"], from_name)
+        ctime = time.strftime('%d.%m.%y,%H:%M', time.localtime())
+        out = {"action":"exchange", "room":room, "from":msg["from"], "message":msg["message"], "time":ctime}
+        self.room_deliver(room, out, said2, from_name, skip=sock)
+        self.bus.publish("room:" + room, {"kind":"exchange", "msg":out, "said":said2, "sender":from_name})
+
+    def room_deliver(self, room, out, said2, from_name, skip=None):
+        # members online in this process: the room's store, AI history, fan-out
+        if room in self.room_socks:
+            self.index_later(self.room_stores[room], said2)
+        for socks in self.room_socks.get(room, {}).values():
+            for name in socks.values():
+                if name in self.chat_history:
+                    self.chat_history[name].append(f"{from_name}: {out['message']}")
+        self.room_broadcast(room, out, skip=skip)
+
+#==============================================================================
+# presence deltas: every change is serialized once for all subscribers.
+# "seq" goes up by one per delta, a client that sees a gap (e.g. a delta
+# dropped by the slow consumer policy) subscribes again for a new snapshot.
+#==============================================================================
+    def presence_local(self):
+        return {name: grp.STATE_NAMES[state] for name, state in self.group.members.items()}
+
+    def presence_snapshot(self):
+        users = {name: state for name, (node, state) in self.remote_users.items()}
+        users.update(self.presence_local())
+        return users
+
+    def presence_event(self, event, name, state=None):
+        state = grp.STATE_NAMES[state] if state is not None else None
+        self.presence_push(event, name, state)
+        self.bus.publish("presence", {"event":event, "node":self.node, "name":name, "state":state})
+
+    def presence_push(self, event, name, state=None):
+        self.presence_seq += 1
+        msg = {"action":"presence", "event":event, "seq":self.presence_seq, "name":name}
+        if state is not None:
+            msg["state"] = state
+        self.broadcast(self.presence_subs, msg)
+
+    def presence_before(self, names):
+        return {name: self.group.members.get(name) for name in names}
+
+    def presence_changed(self, before):
+        for name, state in before.items():
+            now = self.group.members.get(name)
+            if now is not None and now != state:
+                self.presence_event("state", name, now)
+
+#==============================================================================
+# messages from the other server processes, on the loop thread
+#==============================================================================
+    def on_bus(self, topic, msg):
+        if topic == "presence":
+            self.bus_presence(msg)
+        elif topic == "rooms":
+            if msg["op"] == "join":
+                self.rooms.join(msg["room"], msg["name"])
+            else:
+                self.rooms.leave(msg["room"], msg["name"])
+        elif topic.startswith("room:"):
+            room = topic[len("room:"):]
+            if msg["kind"] == "exchange":
+                self.room_deliver(room, msg["msg"], msg["said"], msg["sender"])
+            else:
+                self.room_broadcast(room, msg["msg"])
+
+    def bus_presence(self, msg):
+        event, node = msg["event"], msg["node"]
+        if event == "sync":
+            # a new process wants to know who is here
+            self.bus.publish("presence", {"event":"users", "node":self.node, "users":self.presence_local()})
+        elif event == "users":
+            for name, state in msg["users"].items():
+                if name not in self.remote_users:
+                    self.remote_users[name] = (node, state)
+                    self.presence_push("join", name, state)
+        elif event in ("join", "state"):
+            self.remote_users[msg["name"]] = (node, msg["state"])
+            self.presence_push(event, msg["name"], msg["state"])
+        elif event == "leave":
+            if self.remote_users.pop(msg["name"], None) is not None:
+                self.presence_push("leave", msg["name"])
+        elif event == "node_down":
+            for name, (where, state) in list(self.remote_users.items()):
+                if where == node:
+                    del self.remote_users[name]
+                    self.presence_push("leave", name)
+
+#==============================================================================
+# AI results, back on the loop thread
+#==============================================================================
+    def ai_busy(self, sock):
+        self.send(sock, json.dumps({"action":"exchange", "from":"[System]", "message":"AI is busy with your previous request, please try again in a moment"}))
+
+    def ai_query_done(self, from_name, ai_response, err):
+        if err is not None:
+            ai_response = f"AI Error: {err}"
+        if not self.group.is_member(from_name): #asked and left
+            return
+        the_guys = self.group.list_me(from_name)
+
+        # Broadcast AI response to all in room
+        ctime = time.strftime('%d.%m.%y,%H:%M', time.localtime())
+        ai_message = f"🤖 AI (responding to {from_name}): {ai_response}"
+
+        self.broadcast(the_guys, {"action":"exchange", "from":"[AI Assistant]", "message":ai_message, "time":ctime})
+        for g in the_guys:
+            # Add to chat history
+            if g in self.chat_history:
+                self.chat_history[g].append(f"AI: {ai_response}")
+
+    def ai_image_done(self, from_name, image_data, err):
+        if err is not None:
+            image_data = f"Image Gen Error: {err}"
+        if not self.group.is_member(from_name):
+            return
+        the_guys = self.group.list_me(from_name)
+
+        if image_data and not image_data.startswith("Error") and not image_data.startswith("Image Gen Error"):
+            # Store the image once, the room gets a reference to it
+            self.post_image(the_guys, f"[AI Image by {from_name}]", data=base64.b64decode(image_data), b64=image_data)
+        else:
+            # Send error back to requester
+            from_sock = self.logged_name2sock[from_name]
+            self.send(from_sock, json.dumps({"action":"exchange", "from":"[System]", "message":f"Image generation failed: {image_data}"}))
+
 #==============================================================================
 # main loop, loops *forever*
 #==============================================================================
     def run(self):
         print ('starting server...')
+        streaming = False
         while(1):
-           read,write,error=select.select(self.all_sockets,[],[])
+           writers = [s for s in self.outq if self.outq[s].pending()]
+           #messages left to index or search results to stream: look at the
+           #sockets, don't wait on them; and don't sleep past the next look
+           #at the index cache budget
+           timeout = 0 if self.index_queue.count or streaming else self.index_cache.due()
+           read,write,error=select.select(self.all_sockets,writers,[],timeout)
+           read = set(read)
+           if self.wakeup_r in read:
+               try:
+                   while self.wakeup_r.recv(4096):
+                       pass
+               except (BlockingIOError, InterruptedError):
+                   pass
+               self.run_callbacks()
+           for s in write:
+               if s in self.outq:
+                   self.flush(s)
            print('checking logged clients..')
            for logc in list(self.logged_name2sock.values()):
                if logc in read:
@@ -299,9 +1187,118 @@ class Server:
                #new client request
                sock, address=self.server.accept()
                self.new_client(sock)
+           for s in list(self.to_drop):
+               self.drop(s)
+           self.to_drop.clear()
+           #this round's messages are sent: a few ms of indexing them, then
+           #the coldest indices are closed if they take too much memory
+           self.index_queue.drain()
+           self.index_cache.trim(self.index_queue.pending)
+           streaming = self.search_round()
+
+def compact_stores():
+    #no other server process is up yet: nobody else writes to the shared stores
+    db = database.Database()
+    added, deleted = history.compact_stores(db.get_history_stores())
+    for sid in deleted:
+        db.remove_room_store(sid)
+    if added:
+        print(f'{added} messages left in shared store logs compacted')
+    if deleted:
+        print(f'{len(deleted)} shared stores no history refers to deleted')
+
+def run_workers(args):
+    #the same command line minus --workers, once per process, all on one port
+    import subprocess
+    import signal
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))  # take the workers down too
+    argv, skip = [], False
+    for a in sys.argv[1:]:
+        if skip or a.startswith('--workers='):
+            skip = False
+        elif a == '--workers':
+            skip = True
+        else:
+            argv.append(a)
+    here = os.path.dirname(os.path.abspath(__file__))
+    procs = []
+    bus = args.bus
+    if not bus:
+        compact_stores()
+        procs.append(subprocess.Popen([sys.executable, os.path.join(here, 'chat_bus.py')]))
+        bus = f'tcp://{CHAT_IP}:{chat_bus.BUS_PORT}'
+        for i in range(50):
+            try:
+                socket.create_connection((CHAT_IP, chat_bus.BUS_PORT)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+    for i in range(args.workers):
+        procs.append(subprocess.Popen([sys.executable, os.path.join(here, 'chat_server.py')] + argv +
+                                      ['--reuse-port', '--bus', bus]))
+    try:
+        for p in procs:
+            p.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
 
 def main():
-    server=Server()
+    import argparse
+    parser = argparse.ArgumentParser(description='chat server argument')
+    parser.add_argument('--engine', choices=['select', 'asyncio'], default='select',
+                        help='network engine: select loop or one asyncio task per connection')
+    parser.add_argument('--outq-limit', type=int, default=OUTQ_LIMIT,
+                        help='max bytes buffered for one slow connection')
+    parser.add_argument('--slow-policy', choices=POLICIES, default=POLICY_DROP_OLDEST,
+                        help='what to do when a connection exceeds --outq-limit')
+    parser.add_argument('--ai', choices=['openai', 'fake'], default='openai',
+                        help='AI backend; "fake" answers locally, for testing')
+    parser.add_argument('--ai-workers', type=int, default=4, help='threads running AI calls')
+    parser.add_argument('--ai-per-user', type=int, default=1, help='AI requests in flight per user')
+    parser.add_argument('--ai-max-pending', type=int, default=32, help='AI requests in flight in total')
+    parser.add_argument('--auth-workers', type=int, default=None, help='processes checking passwords (default: one per core)')
+    parser.add_argument('--auth-max-pending', type=int, default=256, help='logins/signups waiting for a password check')
+    parser.add_argument('--max-frame', type=int, default=MAX_FRAME_SIZE, help='largest frame accepted from a v1 client, in bytes')
+    parser.add_argument('--bus', default=None,
+                        help='message bus shared with other server processes: local:// (default) or tcp://host:port')
+    parser.add_argument('--reuse-port', action='store_true', help='let several server processes listen on the same port')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='start this many server processes on one port, with a bus broker if --bus is not given')
+    parser.add_argument('--compact-workers', type=int, default=1,
+                        help='processes folding message logs into history segments')
+    parser.add_argument('--index-budget', type=int, default=history.INDEX_BUDGET // (1024 * 1024),
+                        help='MB of loaded chat indices, least recently used ones are closed first')
+    parser.add_argument('--index-max-loaded', type=int, default=history.INDEX_MAX_LOADED,
+                        help='chat indices kept loaded (each holds open files), the same way')
+    parser.add_argument('--attach-dir', default=ATTACH_DIR, help='directory of the attachment store')
+    parser.add_argument('--attach-max-bytes', type=int, default=ATTACH_MAX_BYTES,
+                        help='attachment store size, least recently used images are evicted first')
+    args = parser.parse_args()
+    if args.workers > 1:
+        run_workers(args)
+        return
+    if not args.bus:
+        compact_stores()
+
+    options = dict(outq_limit=args.outq_limit, slow_policy=args.slow_policy,
+                   ai_backend=args.ai, ai_workers=args.ai_workers,
+                   ai_per_user=args.ai_per_user, ai_max_pending=args.ai_max_pending,
+                   auth_workers=args.auth_workers, auth_max_pending=args.auth_max_pending,
+                   max_frame=args.max_frame, attach_dir=args.attach_dir,
+                   attach_max_bytes=args.attach_max_bytes,
+                   bus=args.bus, reuse_port=args.reuse_port,
+                   compact_workers=args.compact_workers,
+                   index_budget=args.index_budget * 1024 * 1024,
+                   index_max_loaded=args.index_max_loaded)
+    if args.engine == 'asyncio':
+        import chat_server_aio
+        server = chat_server_aio.AsyncServer(**options)
+    else:
+        server = Server(**options)
     server.run()
 
-main()
+if __name__ == "__main__":
+    main()
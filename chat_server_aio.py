@@ -0,0 +1,176 @@
+"""
+asyncio engine for the chat server
+
+Same protocol and the same action switchboard as chat_server.Server, but
+instead of one select() over every socket, each connection gets its own
+coroutine that waits on its own stream. A wakeup only touches the
+connection that has data, no matter how many users are online.
+
+Start it with:  python chat_server.py --engine asyncio
+
+Outgoing frames go through the connection's OutQueue (chat_outqueue.py);
+a pump task moves them into the transport and waits for drain(), so the
+transport buffer stays small and the slow consumer policy decides the rest.
+"""
+
+import asyncio
+from chat_utils import *
+from chat_outqueue import OutQueue
+import chat_server
+import history
+
+STREAM_WAIT = 0.05  # seconds before looking again at a stream its client is behind on
+
+#==============================================================================
+# AioConn: stands in for the socket of one connection.
+# The server keeps using it as the key of logged_name2sock / logged_sock2name,
+# exactly like a socket in the select engine.
+#==============================================================================
+class AioConn:
+    def __init__(self, reader, writer, outq, max_frame=MAX_FRAME_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.outq = outq
+        self.max_frame = max_frame
+        self.version = None  # framing of the first frame from the peer
+        self.ready = asyncio.Event()
+        self.pump_task = asyncio.ensure_future(self.pump())
+
+    async def recv(self):
+        #same framing as myrecv: header first, then the message
+        #returns (kind, frame, payload) like FrameDecoder, kind None when the peer is gone
+        try:
+            head = await self.reader.readexactly(HEADER_SIZE)
+            version, kind, size = parse_header(head, self.max_frame)
+            if self.version is None:
+                self.version = version
+            body = await self.reader.readexactly(size)
+            frame = head + body if kind == KIND_CHUNK else None  # only chunks get relayed as is
+            return kind, frame, body
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print('disconnected')
+        except Exception as e:
+            print(f'recv error: {e}')
+        return None, None, None
+
+    def push(self, frame, key=None):
+        # False: the slow consumer policy wants this connection gone
+        if not self.outq.push(frame, key):
+            return False
+        self.ready.set()
+        return True
+
+    async def pump(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.outq.pending():
+                    self.writer.write(self.outq.pop())
+                    await self.writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f'send error: {e}')
+
+    def close(self):
+        self.pump_task.cancel()
+        self.writer.close()
+
+    def __repr__(self):
+        return f'AioConn({self.peer})'
+
+
+class AsyncServer(chat_server.Server):
+    def listen(self):
+        #the listening socket is opened by asyncio.start_server in run()
+        self.server = None
+        self.loop = None
+        self.indexing = False  # an index_round is scheduled
+        self.streaming = False # a stream_round is scheduled
+
+    def wake(self):
+        #called from worker threads; before the loop runs, serve() picks the work up
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.run_callbacks)
+
+    def index_later(self, name, said2):
+        super().index_later(name, said2)
+        if not self.indexing:
+            self.indexing = True
+            self.loop.call_soon(self.index_round)
+
+    def index_round(self):
+        #a few ms of indexing, then the connections get their turn again
+        if self.index_queue.drain():
+            self.loop.call_soon(self.index_round)
+        else:
+            self.indexing = False
+
+    def search(self, sock, msg):
+        super().search(sock, msg)
+        if self.search_streams and not self.streaming:
+            self.streaming = True
+            self.loop.call_soon(self.stream_round)
+
+    def stream_round(self):
+        #a chunk more of each streamed search, then the connections get their turn again
+        if self.search_round():
+            self.loop.call_soon(self.stream_round)
+        elif self.search_streams:
+            self.loop.call_later(STREAM_WAIT, self.stream_round)
+        else:
+            self.streaming = False
+
+    def trim_round(self):
+        #the coldest indices are closed if they take too much memory
+        self.index_cache.trim(self.index_queue.pending)
+        self.loop.call_later(history.TRIM_INTERVAL, self.trim_round)
+
+    def push(self, sock, frame, key=None):
+        if not sock.push(frame, key):
+            print('slow consumer', self.logged_sock2name.get(sock, sock), 'dropped')
+            self.kick(sock)
+            return False
+        return True
+
+    def kick(self, sock):
+        # never drop a connection in the middle of a fan-out
+        asyncio.get_running_loop().call_soon(self.drop, sock)
+
+    def close(self, sock):
+        self.forget(sock)
+        sock.close()
+
+    async def handle_conn(self, reader, writer):
+        conn = AioConn(reader, writer, OutQueue(self.outq_limit, self.slow_policy), self.max_frame)
+        self.outq[conn] = conn.outq
+        print('new client...', conn)
+        while True:
+            kind, frame, body = await conn.recv()
+            if conn.version is not None and conn in self.outq:
+                self.framing[conn] = conn.version
+            try:
+                self.handle_frame(conn, kind, frame, body)   # kind None: logout/close
+            except Exception as e:
+                print(f'error handling {conn}: {e}')
+            if kind is None:
+                break
+        # connection already closed by logout/close above, let the writer finish
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.call_soon(self.run_callbacks)
+        self.loop.call_later(history.TRIM_INTERVAL, self.trim_round)
+        self.server = await asyncio.start_server(self.handle_conn, *SERVER, reuse_port=self.reuse_port or None)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def run(self):
+        print ('starting server (asyncio)...')
+        asyncio.run(self.serve())
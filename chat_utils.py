@@ -1,5 +1,10 @@
 import socket
+import struct
 import time
+import weakref
+import threading
+import random
+import json
 
 # use local loop back address by default
 # CHAT_IP = '127.0.0.1'
@@ -14,7 +19,10 @@ menu = "\n++++ Choose one of the following commands\n \
         /who: to find out who else are there\n \
         /connect <user>: to connect to the user and chat\n \
         /search <term>: to search your chat logs where <term> appears\n \
+        /more: the next page of results of the last search\n \
         /poem <#>: to get sonnet number <#>\n \
+        /rooms, /join <room>, /leave <room>: named rooms\n \
+        #<room> <message>: say something in a room\n \
         /quit: to leave the chat system\n \
         @ai <query>: ask AI assistant\n \
         @<user>: mention a user\n\n"
@@ -28,6 +36,19 @@ SIZE_SPEC = 7  # Support up to 9,999,999 bytes (~10MB) for images
 
 CHAT_WAIT = 0.2
 
+# search replies: the best SEARCH_LIMIT matches unless the request asks for
+# another "limit", never more than SEARCH_MAX_LIMIT, after the best "offset"
+# ones; "order": "newest" skips the ranking, newest first by the time each
+# message came in, whichever history it is in. "next" in the reply is the
+# offset of the next page. With "stream" the matches come SEARCH_CHUNK at a
+# time, every frame but the last with "more": true, up to
+# SEARCH_MAX_RESULTS. No page goes deeper than that.
+SEARCH_LIMIT = 50
+SEARCH_MAX_LIMIT = 1000
+SEARCH_CHUNK = 50
+SEARCH_MAX_RESULTS = 10000
+SEARCH_STREAM_BUFFER = 64 * 1024  # a chunk is sent when less is waiting to go out
+
 def print_state(state):
     print('**** State *****::::: ')
     if state == S_OFFLINE:
@@ -41,48 +62,254 @@ def print_state(state):
     else:
         print('Error: wrong state')
 
+#==============================================================================
+# Framing
+#   legacy: SIZE_SPEC ascii digits with the payload size, then the payload
+#   v1:     7 byte binary header (magic, version, kind, 4 byte size), then
+#           the payload
+# The magic byte is never an ascii digit, so the first byte of a frame says
+# which framing the peer speaks. The server answers every connection in the
+# framing of the first frame it got, which lets old clients keep the legacy
+# framing while new clients switch with set_framing(sock, FRAMING_V1).
+#==============================================================================
+FRAMING_LEGACY = 0
+FRAMING_V1 = 1
+
+FRAME_MAGIC = 0xC7
+FRAME_HEADER = struct.Struct('!BBBI')  # magic, version, kind, size
+HEADER_SIZE = FRAME_HEADER.size        # same as SIZE_SPEC, on purpose
+assert HEADER_SIZE == SIZE_SPEC
+
+KIND_JSON = 0  # utf-8 json text
+KIND_CHUNK = 1 # v1 only: one piece of a binary upload, see send_upload
+
+MAX_FRAME_SIZE = 32 * 1024 * 1024  # v1 only, legacy stops at 10**SIZE_SPEC - 1
+
+class FrameError(Exception):
+    pass
+
+_framing = weakref.WeakKeyDictionary() # socket -> framing used by mysend
+_send_locks = weakref.WeakKeyDictionary() # socket -> lock, frames from several threads must not interleave
+_chunk_handlers = weakref.WeakKeyDictionary() # socket -> UploadAssembler fed by myrecv
+
+def set_framing(s, version):
+    _framing[s] = version
+
+def get_framing(s):
+    return _framing.get(s, FRAMING_LEGACY)
+
+def encode_frame(msg, version=FRAMING_LEGACY, kind=KIND_JSON):
+    #header + payload, ready to go on the wire; sizes are in bytes
+    data = msg.encode() if isinstance(msg, str) else msg
+    if version == FRAMING_V1:
+        return FRAME_HEADER.pack(FRAME_MAGIC, FRAMING_V1, kind, len(data)) + data
+    if kind != KIND_JSON or len(data) >= 10 ** SIZE_SPEC:
+        raise FrameError(f'cannot send {len(data)} bytes of kind {kind} with legacy framing')
+    return ('%0*d' % (SIZE_SPEC, len(data))).encode() + data
+
+def parse_header(head, max_size=MAX_FRAME_SIZE):
+    #returns (version, kind, size)
+    if head[0] == FRAME_MAGIC:
+        magic, version, kind, size = FRAME_HEADER.unpack(head)
+        if version != FRAMING_V1:
+            raise FrameError(f'unknown framing version {version}')
+        if size > max_size:
+            raise FrameError(f'frame of {size} bytes is over the {max_size} limit')
+        return version, kind, size
+    head = bytes(head)
+    if not head.isdigit():
+        raise FrameError(f'bad frame header {head!r}')
+    return FRAMING_LEGACY, KIND_JSON, int(head)
+
+def _recv_into(s, view):
+    #fill view from a blocking socket; False if the peer is gone
+    got = 0
+    while got < len(view):
+        n = s.recv_into(view[got:])
+        if n == 0:
+            return False
+        got += n
+    return True
+
+def read_frame(s, max_size=MAX_FRAME_SIZE):
+    #blocking read of one frame: (version, kind, payload bytearray), None on disconnect
+    head = bytearray(HEADER_SIZE)
+    if not _recv_into(s, memoryview(head)):
+        return None
+    version, kind, size = parse_header(head, max_size)
+    body = bytearray(size)
+    if not _recv_into(s, memoryview(body)):
+        return None
+    return version, kind, body
+
+class FrameDecoder:
+    """
+    Incremental frame reader for non-blocking sockets. The header and the
+    payload are read straight into one preallocated buffer; a frame is
+    handed out only when complete, so multi-byte characters split across
+    recv() calls are never decoded half way. The buffer holds the frame as
+    it came off the wire, so it can be relayed without building it again.
+    """
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self.version = None  # framing of the first frame from this peer
+        self.head = bytearray(HEADER_SIZE)
+        self._reset()
+
+    def _reset(self):
+        self.kind = KIND_JSON
+        self.frame = None
+        self.view = memoryview(self.head)
+        self.got = 0
+
+    def recv_from(self, s, max_frames=64):
+        #returns (frames, alive); frames is a list of (kind, frame, payload)
+        #frame is the whole frame as received, payload a memoryview into it
+        frames = []
+        try:
+            while len(frames) < max_frames:
+                n = s.recv_into(self.view[self.got:])
+                if n == 0:
+                    return frames, False
+                self.got += n
+                if self.got < len(self.view):
+                    continue
+                if self.frame is None:
+                    version, self.kind, size = parse_header(self.head, self.max_size)
+                    if self.version is None:
+                        self.version = version
+                    self.frame = bytearray(HEADER_SIZE + size)
+                    self.frame[:HEADER_SIZE] = self.head
+                    self.view = memoryview(self.frame)[HEADER_SIZE:]
+                    self.got = 0
+                    if size > 0:
+                        continue
+                frames.append((self.kind, self.frame, self.view))
+                self._reset()
+        except (BlockingIOError, InterruptedError):
+            pass
+        return frames, True
+
+def _send_frames(s, frames):
+    #blocking send, whole frames only
+    lock = _send_locks.setdefault(s, threading.Lock())
+    with lock:
+        for msg in frames:
+            total_sent = 0
+            while total_sent < len(msg):
+                sent = s.send(msg[total_sent:])
+                if sent == 0:
+                    print('socket connection broken')
+                    return False
+                total_sent += sent
+    return True
+
 def mysend(s, msg):
     #append size to message and send it
     try:
-        msg = ('0' * SIZE_SPEC + str(len(msg)))[-SIZE_SPEC:] + str(msg)
-        msg = msg.encode()
-        total_sent = 0
-        while total_sent < len(msg):
-            sent = s.send(msg[total_sent:])
-            if sent == 0:
-                print('socket connection broken')
-                return False
-            total_sent += sent
-        return True
+        return _send_frames(s, [encode_frame(msg, get_framing(s))])
     except Exception as e:
         print(f'mysend error: {e}')
         return False
 
 def myrecv(s):
-    #receive size first
+    #receive size first, then the message; decoded once it is all in
+    #upload chunks are handed to the socket's UploadAssembler on the way
     try:
-        size = ''
-        while len(size) < SIZE_SPEC:
-            text = s.recv(SIZE_SPEC - len(size)).decode()
-            if not text:
-                print('disconnected')
-                return('')
-            size += text
-        size = int(size)
-        #now receive message
-        msg = ''
-        while len(msg) < size:
-            text = s.recv(size-len(msg)).decode()
-            if text == b'':
+        while True:
+            frame = read_frame(s)
+            if frame is None:
                 print('disconnected')
-                break
-            msg += text
-        #print ('received '+message)
-        return (msg)
+                return ''
+            version, kind, body = frame
+            if kind == KIND_JSON:
+                return body.decode()
+            handler = _chunk_handlers.get(s)
+            if kind == KIND_CHUNK and handler is not None:
+                done = handler.feed(body)
+                if done is not None:
+                    return json.dumps(done)
     except Exception as e:
         print(f'myrecv error: {e}')
         return ''
 
+#==============================================================================
+# Binary uploads (v1 framing only)
+# The sender announces the upload with a json message
+#   {"action": "upload_begin", "upload": <id>, "kind": "image", "size": <bytes>}
+# and then streams KIND_CHUNK frames. A chunk payload starts with
+# CHUNK_HEADER (upload id, sequence number, flags); the rest is raw data.
+# The server relays chunk frames to the room as they are, without looking
+# past the chunk header.
+#==============================================================================
+CHUNK_HEADER = struct.Struct('!QIB')  # upload id, seq, flags
+CHUNK_LAST = 1
+CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_SIZE = 16 * 1024 * 1024
+
+def new_upload_id():
+    return random.getrandbits(63)
+
+def upload_frames(upload_id, data, chunk_size=CHUNK_SIZE):
+    #cut data into v1 chunk frames, the last one is flagged
+    view = memoryview(data)
+    frames = []
+    for seq, start in enumerate(range(0, max(len(view), 1), chunk_size)):
+        piece = view[start:start + chunk_size]
+        flags = CHUNK_LAST if start + chunk_size >= len(view) else 0
+        body = CHUNK_HEADER.pack(upload_id, seq, flags) + piece
+        frames.append(encode_frame(body, FRAMING_V1, KIND_CHUNK))
+    return frames
+
+def send_upload(s, upload_id, data, chunk_size=CHUNK_SIZE):
+    #stream data as chunk frames, the upload_begin message must go first
+    return _send_frames(s, upload_frames(upload_id, data, chunk_size))
+
+def set_chunk_handler(s, handler):
+    _chunk_handlers[s] = handler
+
+class UploadAssembler:
+    """
+    Client side of an upload: chunks are copied into a buffer as they come
+    in. When the last one is there, feed() returns an "upload_done" message
+    and take() hands over the bytes.
+    """
+    def __init__(self, max_size=MAX_UPLOAD_SIZE):
+        self.max_size = max_size
+        self.uploads = {}  # id -> [meta, buffer, bytes so far, next seq]
+        self.done = {}     # id -> (meta, bytes)
+
+    def begin(self, meta):
+        size = min(int(meta.get("size", 0)), self.max_size)
+        self.uploads[meta["upload"]] = [meta, bytearray(size), 0, 0]
+
+    def feed(self, body):
+        upload_id, seq, flags = CHUNK_HEADER.unpack_from(body)
+        data = memoryview(body)[CHUNK_HEADER.size:]
+        if upload_id not in self.uploads: # missed the upload_begin message
+            self.uploads[upload_id] = [{"upload": upload_id}, bytearray(), 0, 0]
+        up = self.uploads[upload_id]
+        meta, buf, got, next_seq = up
+        end = got + len(data)
+        if seq != next_seq or end > self.max_size:
+            print(f'upload {upload_id}: bad chunk, dropped')
+            del self.uploads[upload_id]
+            return None
+        if end > len(buf):
+            buf.extend(bytes(end - len(buf)))
+        buf[got:end] = data
+        up[2], up[3] = end, seq + 1
+        if not flags & CHUNK_LAST:
+            return None
+        del self.uploads[upload_id]
+        del buf[end:]
+        self.done[upload_id] = (meta, buf)
+        return {"action": "upload_done", "upload": upload_id,
+                "from": meta.get("from", "Unknown"), "kind": meta.get("kind", "image")}
+
+    def take(self, upload_id):
+        return self.done.pop(upload_id, (None, None))
+
 def text_proc(text, user):
     ctime = time.strftime('%d.%m.%y,%H:%M', time.localtime())
     return('(' + ctime + ') ' + user + ' : ' + text) # message goes directly to screen
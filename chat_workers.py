@@ -0,0 +1,151 @@
+"""
+Bounded worker pool for slow jobs of the chat server (AI calls, ...)
+
+The server loop must never wait on a slow call. Jobs run on an executor;
+when one finishes, its callback is queued and the loop is woken up through
+notify(). The loop then calls run_callbacks(), so callbacks always run on
+the loop thread and can touch server state and sockets safely.
+
+Limits:
+    - max_pending: jobs queued or running in the whole pool
+    - per_user:    jobs queued or running for one user
+submit() returns False when a limit is hit, the caller tells the user.
+
+IndexQueue is the same idea for work that has to stay on the loop
+thread: indexing chat messages. Relaying a message only queues it; the
+loop indexes the queue between rounds of socket work, a few milliseconds
+at a time, and a search first indexes what is queued for its own indices.
+Messages are queued by index name, the index is loaded when its turn comes.
+"""
+
+import time
+import queue
+
+class WorkerPool:
+    def __init__(self, executor, max_pending=32, per_user=1, notify=None):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.per_user = per_user
+        self.notify = notify         # called from the worker thread, wakes the loop
+        self.done = queue.Queue()    # finished jobs, waiting for the loop
+        self.pending = 0
+        self.user_pending = {}
+        # counters
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    def submit(self, user, on_done, fn, *args):
+        # on_done(result, error) runs on the loop thread when fn(*args) is done
+        if self.pending >= self.max_pending or self.user_pending.get(user, 0) >= self.per_user:
+            self.rejected += 1
+            return False
+        self.pending += 1
+        self.user_pending[user] = self.user_pending.get(user, 0) + 1
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.pending)
+        fut = self.executor.submit(fn, *args)
+        fut.add_done_callback(lambda f: self._finished(user, on_done, f))
+        return True
+
+    def _finished(self, user, on_done, fut):
+        # worker thread: hand the job back to the loop
+        self.done.put((user, on_done, fut))
+        if self.notify is not None:
+            self.notify()
+
+    def run_callbacks(self):
+        # loop thread
+        while True:
+            try:
+                user, on_done, fut = self.done.get_nowait()
+            except queue.Empty:
+                return
+            self.pending -= 1
+            self.completed += 1
+            self.user_pending[user] -= 1
+            if self.user_pending[user] == 0:
+                del self.user_pending[user]
+            try:
+                result, error = fut.result(), None
+            except Exception as e:
+                result, error = None, e
+            try:
+                on_done(result, error)
+            except Exception as e:
+                print(f'worker callback error: {e}')
+
+    def stats(self):
+        return {"depth": self.pending, "max_depth": self.max_depth,
+                "submitted": self.submitted, "completed": self.completed,
+                "rejected": self.rejected, "users": len(self.user_pending)}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+#==============================================================================
+# IndexQueue: messages waiting to be indexed, per index, on the loop thread
+#==============================================================================
+INDEX_BUDGET = 0.005        # seconds of indexing per loop round
+INDEX_MAX_PENDING = 100000  # queued messages before the relay path waits for the indexing
+
+class IndexQueue:
+    def __init__(self, load, budget=INDEX_BUDGET, max_pending=INDEX_MAX_PENDING):
+        self.load = load        # index name -> the index
+        self.budget = budget
+        self.max_pending = max_pending
+        self.pending = {}       # index name -> (message, time it came in) waiting for it, oldest first
+        self.count = 0
+        # counters
+        self.queued = 0
+        self.indexed = 0
+        self.flushed = 0        # indexed early, for a search or a history span
+        self.max_depth = 0
+
+    def put(self, name, m):
+        # the time is taken now: the order messages came in is kept across
+        # indices, however late each one is indexed
+        self.pending.setdefault(name, []).append((m, time.time()))
+        self.count += 1
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self.count)
+        if self.count > self.max_pending:
+            self.drain(everything=True)  # indexing can't keep up: no more queueing
+
+    def flush(self, name):
+        # everything queued for the index, now: read-your-writes
+        msgs = self.pending.pop(name, None)
+        if msgs:
+            self.flushed += len(msgs)
+            self.index(name, msgs)
+
+    def drain(self, everything=False):
+        # about self.budget seconds of indexing; True when messages are left.
+        # Indices take turns.
+        deadline = None if everything else time.perf_counter() + self.budget
+        while self.pending and (deadline is None or time.perf_counter() < deadline):
+            name = next(iter(self.pending))
+            msgs = self.pending.pop(name)
+            done = self.index(name, msgs, deadline)
+            if done < len(msgs):
+                self.pending[name] = msgs[done:]
+                break
+        return self.count > 0
+
+    def index(self, name, msgs, deadline=None):
+        idx = self.load(name)
+        done = 0
+        for m, when in msgs:
+            idx.add_msg_and_index(m, when)
+            done += 1
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+        self.count -= done
+        self.indexed += done
+        return done
+
+    def stats(self):
+        return {"depth": self.count, "max_depth": self.max_depth, "queued": self.queued,
+                "indexed": self.indexed, "flushed": self.flushed, "indices": len(self.pending)}
@@ -5,6 +5,7 @@ Created on Sun Apr  5 00:00:32 2015
 """
 from chat_utils import *
 import json
+from collections import deque
 
 class ClientSM:
     def __init__(self, s):
@@ -13,6 +14,12 @@ class ClientSM:
         self.me = ''
         self.out_msg = ''
         self.s = s
+        # what the server pushed (presence, chat, ...) while we waited for a
+        # reply: the receive loop takes these before reading the socket again
+        self.held = deque()
+        # the last search, and the offset of its next page (None: no more)
+        self.search_term = ''
+        self.search_next = None
 
     def set_state(self, state):
         self.state = state
@@ -26,10 +33,23 @@ class ClientSM:
     def get_myname(self):
         return self.me
 
+    def request(self, msg, is_reply=None):
+        # send msg and wait for the reply: the next message with the same
+        # action (and is_reply(reply), if given); the others are held
+        mysend(self.s, json.dumps(msg))
+        while True:
+            raw = myrecv(self.s)
+            if not raw:
+                raise ConnectionError('server closed the connection')
+            reply = json.loads(raw)
+            if reply.get("action") == msg["action"] and (is_reply is None or is_reply(reply)):
+                return reply
+            self.held.append(raw)
+
     def connect_to(self, peer):
-        msg = json.dumps({"action":"connect", "target":peer})
-        mysend(self.s, msg)
-        response = json.loads(myrecv(self.s))
+        # a connect pushed by someone connecting to us is not our reply
+        response = self.request({"action":"connect", "target":peer},
+                                lambda r: r.get("status") != "request")
         if response["status"] == "success":
             self.peer = peer
             self.out_msg += 'You are connected with '+ self.peer + '\n'
@@ -48,6 +68,56 @@ class ClientSM:
         self.out_msg += 'You are disconnected from ' + self.peer + '\n'
         self.peer = ''
 
+    def room_cmd(self, my_msg):
+        # join <room>, leave <room>, rooms; True if my_msg was one of them
+        if my_msg == 'rooms':
+            rooms = self.request({"action":"room_list"})["results"]
+            self.out_msg += 'Rooms:\n'
+            for r in rooms:
+                mark = '*' if r["joined"] else ' '
+                self.out_msg += f' {mark} #{r["room"]} ({r["online"]}/{r["members"]} online)\n'
+            return True
+        for action in ('join', 'leave'):
+            if my_msg.startswith(action + ' '):
+                room = my_msg[len(action):].strip().lstrip('#')
+                status = self.request({"action":"room_" + action, "room":room})["status"]
+                if status == 'ok':
+                    self.out_msg += 'You ' + ('joined' if action == 'join' else 'left') + ' #' + room + '\n'
+                else:
+                    self.out_msg += 'Cannot ' + action + ' #' + room + ': ' + status + '\n'
+                return True
+        return False
+
+    def search(self, term, offset=0):
+        # one page of the best matches; "?" alone asks for the next one
+        reply = self.request({"action":"search", "target":term, "offset":offset})
+        search_rslt = reply["results"].strip()
+        self.search_term = term
+        self.search_next = reply.get("next")
+        if "error" in reply:
+            self.out_msg += 'Bad search: ' + reply["error"] + '\n\n'
+        elif (len(search_rslt)) > 0:
+            self.out_msg += search_rslt + '\n\n'
+            if self.search_next is not None:
+                self.out_msg += '(more: ? for the next page)\n\n'
+        elif offset:
+            self.out_msg += 'No more results for \'' + term + '\'\n\n'
+        else:
+            self.out_msg += '\'' + term + '\'' + ' not found\n\n'
+
+    def room_say(self, my_msg):
+        # "#room text" goes to a named room
+        room, _, text = my_msg[1:].partition(' ')
+        if room and text:
+            mysend(self.s, json.dumps({"action":"exchange", "room":room, "from":"[" + self.me + "]", "message":text}))
+        else:
+            self.out_msg += 'Usage: #<room> <message>\n'
+
+    def room_text(self, peer_msg):
+        if peer_msg["action"] == "room_event":
+            return '#' + peer_msg["room"] + ': ' + peer_msg["name"] + ' ' + peer_msg["event"] + 's\n'
+        return '(' + peer_msg.get("time", "") + ') #' + peer_msg["room"] + ' ' + peer_msg["from"] + ' : ' + peer_msg["message"]
+
     def proc(self, my_msg, peer_msg):
         self.out_msg = ''
 #==============================================================================
@@ -64,16 +134,20 @@ class ClientSM:
                     self.state = S_OFFLINE
 
                 elif my_msg == 'time':
-                    mysend(self.s, json.dumps({"action":"time"}))
-                    time_in = json.loads(myrecv(self.s))["results"]
+                    time_in = self.request({"action":"time"})["results"]
                     self.out_msg += "Time is: " + time_in
 
                 elif my_msg == 'who':
-                    mysend(self.s, json.dumps({"action":"list"}))
-                    logged_in = json.loads(myrecv(self.s))["results"]
+                    logged_in = self.request({"action":"list"})["results"]
                     self.out_msg += 'Here are all the users in the system:\n'
                     self.out_msg += logged_in
 
+                elif self.room_cmd(my_msg):
+                    pass
+
+                elif my_msg[0] == '#':
+                    self.room_say(my_msg)
+
                 elif my_msg[0] == 'c':
                     peer = my_msg[1:]
                     peer = peer.strip()
@@ -86,17 +160,16 @@ class ClientSM:
 
                 elif my_msg[0] == '?':
                     term = my_msg[1:].strip()
-                    mysend(self.s, json.dumps({"action":"search", "target":term}))
-                    search_rslt = json.loads(myrecv(self.s))["results"].strip()
-                    if (len(search_rslt)) > 0:
-                        self.out_msg += search_rslt + '\n\n'
+                    if term:
+                        self.search(term)
+                    elif self.search_next is not None:
+                        self.search(self.search_term, self.search_next)
                     else:
-                        self.out_msg += '\'' + term + '\'' + ' not found\n\n'
+                        self.out_msg += 'No more results\n\n'
 
                 elif my_msg[0] == 'p' and my_msg[1:].isdigit():
                     poem_idx = my_msg[1:].strip()
-                    mysend(self.s, json.dumps({"action":"poem", "target":poem_idx}))
-                    poem = json.loads(myrecv(self.s))["results"]
+                    poem = self.request({"action":"poem", "target":poem_idx})["results"]
                     # print(poem)
                     if (len(poem) > 0):
                         self.out_msg += poem + '\n\n'
@@ -115,13 +188,17 @@ class ClientSM:
                     self.out_msg += '. Chat away!\n\n'
                     self.out_msg += '------------------------------------\n'
                     self.state = S_CHATTING
+                elif "room" in peer_msg:
+                    self.out_msg += self.room_text(peer_msg)
 
 #==============================================================================
 # Start chatting, 'bye' for quit
 # This is event handling instate "S_CHATTING"
 #==============================================================================
         elif self.state == S_CHATTING:
-            if len(my_msg) > 0:     # my stuff going out
+            if len(my_msg) > 0 and my_msg[0] == '#':    # to a named room
+                self.room_say(my_msg)
+            elif len(my_msg) > 0:     # my stuff going out
                 mysend(self.s, json.dumps({"action":"exchange", "from":"[" + self.me + "]", "message":my_msg}))
                 if my_msg == 'bye':
                     self.disconnect()
@@ -138,6 +215,8 @@ class ClientSM:
                     self.state = S_CHATTING
                 elif peer_msg["action"] == "disconnect":
                     self.state = S_LOGGEDIN
+                elif "room" in peer_msg:
+                    self.out_msg += self.room_text(peer_msg)
                 else:
                     # Format with timestamp if available
                     if "time" in peer_msg:
@@ -15,7 +15,7 @@ class Database:
         self.init_db()
     
     def init_db(self):
-        """Create users table if it doesn't exist"""
+        """Create users, room_members, history_ranges and room_stores tables if they don't exist"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
@@ -28,6 +28,37 @@ class Database:
             )
         ''')
         
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS room_members (
+                room TEXT NOT NULL,
+                username TEXT NOT NULL,
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (room, username)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS history_ranges (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                store TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                stop INTEGER
+            )
+        ''')
+        
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS history_ranges_user ON history_ranges (username)'
+        )
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS room_stores (
+                room TEXT NOT NULL,
+                store TEXT NOT NULL,
+                PRIMARY KEY (room, store)
+            )
+        ''')
+        
         conn.commit()
         conn.close()
     
@@ -50,15 +81,18 @@ class Database:
             password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
             
             conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute(
-                'INSERT INTO users (username, password_hash) VALUES (?, ?)',
-                (username, password_hash)
-            )
-            
-            conn.commit()
-            conn.close()
+            try:
+                cursor = conn.cursor()
+                
+                cursor.execute(
+                    'INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                    (username, password_hash)
+                )
+                
+                conn.commit()
+            finally:
+                # a taken name must not leave the write lock held
+                conn.close()
             
             return True, "Signup successful"
         
@@ -136,3 +170,194 @@ class Database:
         except Exception as e:
             print(f"Error getting users: {e}")
             return []
+    
+    def get_room_members(self):
+        """Get all (room, username) pairs, to restore the rooms at startup"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT room, username FROM room_members ORDER BY joined_at')
+            results = cursor.fetchall()
+            conn.close()
+            
+            return results
+        
+        except Exception as e:
+            print(f"Error getting room members: {e}")
+            return []
+    
+    def add_room_member(self, room, username):
+        """Remember that a user joined a room"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'INSERT OR IGNORE INTO room_members (room, username) VALUES (?, ?)',
+                (room, username)
+            )
+            
+            conn.commit()
+            conn.close()
+        
+        except Exception as e:
+            print(f"Error adding room member: {e}")
+    
+    def remove_room_member(self, room, username):
+        """Forget that a user left a room"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'DELETE FROM room_members WHERE room = ? AND username = ?',
+                (room, username)
+            )
+            
+            conn.commit()
+            conn.close()
+        
+        except Exception as e:
+            print(f"Error removing room member: {e}")
+    
+    def get_history_ranges(self, username):
+        """Get the (id, store, start, stop) ranges of shared history a user sees, oldest first"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT id, store, start, stop FROM history_ranges WHERE username = ? ORDER BY id',
+                (username,)
+            )
+            results = cursor.fetchall()
+            conn.close()
+            
+            return results
+        
+        except Exception as e:
+            print(f"Error getting history ranges: {e}")
+            return []
+    
+    def add_history_range(self, username, store, start):
+        """Remember that a user sees a store from message start on; returns the range id"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'INSERT INTO history_ranges (username, store, start) VALUES (?, ?, ?)',
+                (username, store, start)
+            )
+            range_id = cursor.lastrowid
+            
+            conn.commit()
+            conn.close()
+            
+            return range_id
+        
+        except Exception as e:
+            print(f"Error adding history range: {e}")
+            return None
+    
+    def update_history_range(self, range_id, stop):
+        """Set where a range ends, None while the user still sees new messages"""
+        if range_id is None:
+            return
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'UPDATE history_ranges SET stop = ? WHERE id = ?',
+                (stop, range_id)
+            )
+            
+            conn.commit()
+            conn.close()
+        
+        except Exception as e:
+            print(f"Error updating history range: {e}")
+    
+    def delete_history_range(self, range_id):
+        """Forget a range, e.g. one with no message in it"""
+        if range_id is None:
+            return
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM history_ranges WHERE id = ?', (range_id,))
+            
+            conn.commit()
+            conn.close()
+        
+        except Exception as e:
+            print(f"Error deleting history range: {e}")
+    
+    def get_history_stores(self):
+        """Get the set of stores some range refers to"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT DISTINCT store FROM history_ranges')
+            results = cursor.fetchall()
+            conn.close()
+            
+            return {row[0] for row in results}
+        
+        except Exception as e:
+            print(f"Error getting history stores: {e}")
+            return None
+    
+    def get_room_stores(self, room):
+        """Get the stores a room kept its messages in, oldest first"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT store FROM room_stores WHERE room = ? ORDER BY rowid',
+                (room,)
+            )
+            results = cursor.fetchall()
+            conn.close()
+            
+            return [row[0] for row in results]
+        
+        except Exception as e:
+            print(f"Error getting room stores: {e}")
+            return []
+    
+    def add_room_store(self, room, store):
+        """Remember a store a room keeps its messages in"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'INSERT OR IGNORE INTO room_stores (room, store) VALUES (?, ?)',
+                (room, store)
+            )
+            
+            conn.commit()
+            conn.close()
+        
+        except Exception as e:
+            print(f"Error adding room store: {e}")
+    
+    def remove_room_store(self, store):
+        """Forget a store, e.g. one that was deleted"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM room_stores WHERE store = ?', (store,))
+            
+            conn.commit()
+            conn.close()
+        
+        except Exception as e:
+            print(f"Error removing room store: {e}")
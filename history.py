@@ -0,0 +1,425 @@
+"""
+A user's chat history as one index over shared conversation stores
+
+A room or group message is stored and indexed once, in the store of its
+conversation: a segment with its log (see segment.py) under shared/, one
+per group and one per room per server process, the same one across
+restarts (the process holds a lock on it, see claim_store). Nobody gets a
+copy. A user's history is a HistoryView of
+    their own index     <name>.seg: what they had before, and what they
+                        said while talking to nobody
+    spans of stores     from the message the store was at when they came
+                        online in the room or joined the group, to the one
+                        it was at when they went offline or left
+The spans are kept in the database (Database.get_history_ranges), empty
+ones dropped and adjacent ones merged.
+
+The view numbers the messages one after the other, the own index first
+and then the spans in the order they were opened, and has the index
+methods query.py uses (postings, doc_freq, doc_count, doc_len,
+avg_doc_len, expand, fuzzy) over just those messages. So a search sees
+the messages a copy per user would have had, ranks them on the same
+counts, and finds the same matches; only ties between equal scores can
+come out in another order. Newest first does not go by that numbering but
+by the time each message came in (msg_time), merged across the parts.
+
+The view holds names, not indices: it gets them from an IndexCache when
+a search needs them. The cache keeps the indices loaded by the server,
+own indices and stores alike, least recently used first, and closes the
+coldest ones when their memory() goes over its budget or there are more
+than it may keep open, the stores of closed spans first. So memory and
+open files do not grow with the history of everybody online, only with
+what is in use.
+"""
+
+import os
+import time
+import uuid
+import heapq
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+import indexer
+import segment
+import query
+from query import unique
+
+SHARED_DIR = 'shared'
+INDEX_BUDGET = 256 * 1024 * 1024  # bytes of loaded indices, see IndexCache
+INDEX_MAX_LOADED = 128            # loaded indices: each holds a file or two open
+TRIM_INTERVAL = 0.5               # seconds between two looks at the budget
+
+def new_store():
+    # a new, empty store; its name is never used again, not even after a restart
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    sid = SHARED_DIR + '/' + uuid.uuid4().hex
+    segment.save_segment(segment.seg_path(sid), indexer.Index(sid))
+    return sid
+
+def claim_store(sid):
+    # the lock that makes this process the one writing to the store, held
+    # until segment.unlock(); None if another process writes to it
+    return segment.try_lock(sid + '.lock')
+
+def delete_store(sid):
+    for path in (segment.seg_path(sid), segment.wal_path(sid), segment.old_wal_path(sid),
+                 segment.lock_path(sid), sid + '.lock'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def compact_stores(keep=None):
+    # fold in the logs a server left in its stores when it died, or was stopped
+    # with users online: a store is only compacted by the process writing to it.
+    # keep: the stores some span refers to, the others are deleted (their
+    # messages were seen by nobody). Only while no server process is running
+    # on shared/. Returns (messages compacted, stores deleted).
+    if not os.path.isdir(SHARED_DIR):
+        return 0, []
+    done, deleted = 0, []
+    for fn in sorted(os.listdir(SHARED_DIR)):
+        if fn.endswith('.seg'):
+            sid = SHARED_DIR + '/' + fn[:-len('.seg')]
+            if keep is not None and sid not in keep:
+                delete_store(sid)
+                deleted.append(sid)
+                continue
+            while segment.rotate_log(sid):
+                added = segment.compact(sid)
+                if added is None:
+                    break  # another process is compacting it after all
+                done += added
+    return done, deleted
+
+def is_store(name):
+    return name.startswith(SHARED_DIR + '/')
+
+class IndexCache:
+    """
+    The loaded indices, by name, least recently used first. get() loads one
+    on a miss, through opener(name). trim() closes the coldest ones, through
+    on_evict(name, index), until their memory() adds up to the budget and
+    there are at most max_loaded of them; those for which idle(name) is
+    true (e.g. stores nobody sees new messages of) go first. It is called
+    between rounds of the server loop, never during a search.
+    """
+    def __init__(self, opener, on_evict, budget=INDEX_BUDGET, max_loaded=INDEX_MAX_LOADED,
+                 idle=None):
+        self.opener = opener
+        self.on_evict = on_evict
+        self.budget = budget
+        self.max_loaded = max_loaded
+        self.idle = idle
+        self.lru = OrderedDict()    # name -> index, least recently used first
+        self.total = 0              # memory() of them all, at the last trim
+        self.next_trim = 0.0
+        self.changed = False        # an index was used since the last trim
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name):
+        self.changed = True
+        idx = self.lru.get(name)
+        if idx is None:
+            self.misses += 1
+            idx = self.lru[name] = self.opener(name)
+        else:
+            self.hits += 1
+            self.lru.move_to_end(name)
+        return idx
+
+    def peek(self, name):
+        # the index if it is loaded, without loading it or making it recent
+        return self.lru.get(name)
+
+    def close(self, name):
+        idx = self.lru.pop(name, None)
+        if idx is not None:
+            self.on_evict(name, idx)
+
+    def due(self):
+        # seconds until trim() has work to do, None when nothing changed
+        if not self.changed:
+            return None
+        return max(self.next_trim - time.monotonic(), 0)
+
+    def trim(self, keep=()):
+        # keep: names that must stay loaded, e.g. with messages queued for them
+        now = time.monotonic()
+        if not self.changed or now < self.next_trim:
+            return
+        self.next_trim = now + TRIM_INTERVAL
+        sizes = {name: idx.memory() for name, idx in self.lru.items()}
+        self.total = sum(sizes.values())
+        order = list(self.lru)
+        if self.idle is not None:
+            order = [n for n in order if self.idle(n)] + [n for n in order if not self.idle(n)]
+        for name in order:
+            if not self.over():
+                break
+            if name not in keep:
+                self.evictions += 1
+                self.total -= sizes[name]
+                self.close(name)
+        self.changed = self.over()  # what had to stay, once more later
+
+    def over(self):
+        return self.total > self.budget or len(self.lru) > self.max_loaded
+
+    def stats(self):
+        return {"loaded": len(self.lru), "max_loaded": self.max_loaded, "bytes": self.total,
+                "budget": self.budget, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+class Span:
+    """messages start..stop-1 of a store, seen by one user; stop is None while open"""
+    def __init__(self, sid, start, stop=None, rid=None):
+        self.sid = sid
+        self.start = start
+        self.stop = stop
+        self.rid = rid          # its row in the database
+        self.words = 0          # terms in messages start..counted-1
+        self.counted = start
+
+    def end(self, idx):
+        # idx: the store's index
+        size = idx.get_msg_size()
+        return size if self.stop is None else min(self.stop, size)
+
+    def word_count(self, idx):
+        end = self.end(idx)
+        if end > self.counted:
+            self.words += idx.words_between(self.counted, end)
+            self.counted = end
+        return self.words
+
+class HistoryView(indexer.Index):
+    def __init__(self, name, load):
+        super().__init__(name)
+        self.load = load    # name -> its index, e.g. IndexCache.get
+        self.spans = []     # in the order they were opened
+        self.live = {}      # store -> its open span
+        # during a query: term -> postings, and the layout
+        self.memo = None
+        self.parts = None
+
+    def add_span(self, sid, start, stop, rid):
+        # a span from before this login
+        span = Span(sid, start, stop, rid)
+        self.spans.append(span)
+        return span
+
+    def last_span(self, sid):
+        return next((s for s in reversed(self.spans) if s.sid == sid), None)
+
+    def open_span(self, sid, size):
+        # from the store's next message, size, on; a span that ended there
+        # just goes on (a quiet room, seen again)
+        span = self.last_span(sid)
+        if span is not None and span.stop == size:
+            span.stop = None
+        else:
+            span = Span(sid, size)
+            self.spans.append(span)
+        self.live[sid] = span
+        return span
+
+    def close_span(self, sid, size):
+        # a span with no message in it is dropped
+        span = self.live.pop(sid, None)
+        if span is not None:
+            span.stop = size
+            if span.start == span.stop:
+                self.spans.remove(span)
+        return span
+
+    def store_names(self):
+        # the stores of the spans, each once
+        return list(dict.fromkeys(s.sid for s in self.spans))
+
+    #==========================================================================
+    # the index of the messages in view
+    #==========================================================================
+    def layout(self):
+        # ([(index, start, stop, number of start in the view)], those numbers)
+        if self.parts is not None:
+            return self.parts
+        parts, bases = [], []
+        base = 0
+        own = self.load(self.name)
+        items = [(own, 0, own.get_msg_size())]
+        for s in self.spans:
+            idx = self.load(s.sid)
+            items.append((idx, s.start, s.end(idx)))
+        for idx, a, b in items:
+            if b > a:
+                parts.append((idx, a, b, base))
+                bases.append(base)
+                base += b - a
+        if self.memo is not None:
+            self.parts = parts, bases
+        return parts, bases
+
+    def whole(self):
+        # the index, when the view is just all of one index
+        parts = self.layout()[0]
+        if len(parts) == 1:
+            idx, a, b, base = parts[0]
+            if a == 0 and b == idx.get_msg_size():
+                return idx
+        return None
+
+    def locate(self, n):
+        parts, bases = self.layout()
+        idx, a, b, base = parts[bisect_right(bases, n) - 1]
+        return idx, n - base + a
+
+    def postings(self, term):
+        if self.memo is not None and term in self.memo:
+            return self.memo[term]
+        idx = self.whole()
+        if idx is not None:
+            return idx.postings(term)
+        fetched = {}
+        docs, positions = [], []
+        for idx, a, b, base in self.layout()[0]:
+            if id(idx) not in fetched:
+                fetched[id(idx)] = idx.postings(term)
+            d, p = fetched[id(idx)]
+            lo, hi = bisect_left(d, a), bisect_left(d, b)
+            if lo < hi:
+                shift = base - a
+                docs.extend(x + shift for x in d[lo:hi])
+                positions.extend(p[lo:hi])
+        if self.memo is not None:
+            self.memo[term] = docs, positions
+        return docs, positions
+
+    def doc_freq(self, term):
+        idx = self.whole()
+        if idx is not None:
+            return idx.doc_freq(term)
+        return len(unique(self.postings(term)[0]))
+
+    def doc_count(self):
+        parts = self.layout()[0]
+        if not parts:
+            return 0
+        idx, a, b, base = parts[-1]
+        return base + b - a
+
+    def get_msg_size(self):
+        return self.doc_count()
+
+    def get_msg(self, n):
+        idx, i = self.locate(n)
+        return idx.get_msg(i)
+
+    def msg_time(self, n):
+        idx, i = self.locate(n)
+        return idx.msg_time(i)
+
+    def newest_first(self, found):
+        # the parts are numbered one after the other, but their messages came
+        # in at the same time: each part's matches, last first, merged by
+        # the time they came in (ties: the later in the view first)
+        parts = self.layout()[0]
+        if len(parts) < 2:
+            return reversed(found)
+        runs = []
+        lo = 0
+        for idx, a, b, base in parts:
+            hi = bisect_left(found, base + b - a, lo)
+            if hi > lo:
+                shift = a - base
+                runs.append([(idx.msg_time(n + shift), n) for n in reversed(found[lo:hi])])
+            lo = hi
+        return [n for when, n in heapq.merge(*runs, reverse=True)]
+
+    def doc_len(self, n):
+        idx, i = self.locate(n)
+        return idx.doc_len(i)
+
+    def get_total_words(self):
+        return self.load(self.name).get_total_words() + \
+               sum(s.word_count(self.load(s.sid)) for s in self.spans)
+
+    def avg_doc_len(self):
+        return self.get_total_words() / max(self.doc_count(), 1)
+
+    def indexes(self):
+        return [self.load(name) for name in [self.name] + self.store_names()]
+
+    def expand(self, pattern, cap):
+        # matching terms of every index, those with a message in view
+        if not self.spans:
+            return self.load(self.name).expand(pattern, cap)
+        found = []
+        last = None
+        for term in heapq.merge(*(idx.expand(pattern, indexer.EXPAND_SCAN) for idx in self.indexes())):
+            if term != last and self.doc_freq(term):
+                found.append(term)
+                if len(found) == cap:
+                    break
+            last = term
+        return found
+
+    def fuzzy_candidates(self, term, k):
+        if not self.spans:
+            return self.load(self.name).fuzzy_candidates(term, k)
+        found = {}
+        for idx in self.indexes():
+            for d, wd in idx.fuzzy_candidates(term, k):
+                found[wd] = d
+        return [(d, wd) for wd, d in found.items() if self.doc_freq(wd)]
+
+    def iter_terms(self):
+        last = None
+        for term in heapq.merge(*(idx.iter_terms() for idx in self.indexes())):
+            if term != last and self.doc_freq(term):
+                yield term
+            last = term
+
+    def query(self, text, limit=None, respell=False, offset=0, newest=False):
+        # the layout and the postings are worked out once per query
+        self.memo = {}
+        try:
+            self.analyzer = self.load(self.name).analyzer
+            return super().query(text, limit, respell, offset, newest)
+        finally:
+            self.memo = None
+            self.parts = None
+
+    def query_iter(self, text, respell=False, offset=0, newest=False):
+        # the messages are read after the query, while the view may grow and
+        # its indices be closed and loaded again: they are found through the
+        # layout of now, by index name
+        self.memo = {}
+        try:
+            self.analyzer = self.load(self.name).analyzer
+            node, found = self.match(text, respell)
+            order = self.order(node, found, offset, newest)
+            parts, bases = self.layout()
+            parts = [(idx.name, a, base) for idx, a, b, base in parts]
+        finally:
+            self.memo = None
+            self.parts = None
+        return self.read(order, parts, bases)
+
+    def read(self, order, parts, bases):
+        for n in order:
+            name, a, base = parts[bisect_right(bases, n) - 1]
+            yield n, self.load(name).get_msg(n - base + a)
+
+if __name__ == "__main__":
+    loaded = {'me': indexer.Index('me'), 'room': indexer.Index('room')}
+    loaded['me'].add_msg_and_index('said to nobody: summer')
+    for m in ('before I came in: summer', 'hello summer', 'summer love', 'after I left: summer'):
+        loaded['room'].add_msg_and_index(m)
+    cache = IndexCache(loaded.get, lambda name, idx: None)
+    view = HistoryView('me', cache.get)
+    view.add_span('room', 1, 3, None)
+    print(view.query('summer'), view.query('summer', limit=2), view.expand('s*', 10))
+    print(view.query('summer', limit=1, offset=1), list(view.query_iter('summer')))
+    print(cache.stats())
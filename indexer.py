@@ -5,15 +5,138 @@ Created on Sat Jul  5 11:38:58 2014
 @author: zzhang
 """
 import pickle
+import time
+from array import array
+from bisect import bisect_left, insort
+from fnmatch import fnmatchcase
+from collections import Counter
+from itertools import islice
+import query
+from analyzer import Analyzer
+
+EXPAND_SCAN = 100000  # terms looked at for one wildcard pattern
+# rough bytes an Index holds, for memory(): measured with tracemalloc on chat
+# lines, the message texts included
+MSG_BYTES = 68      # per message: its string, list slot, length and time
+WORD_BYTES = 18     # per word: its text, message number and position
+TERM_BYTES = 530    # per term: its string, dict entries, arrays and trigrams
+
+def term_grams(term):
+    # character trigrams, with the word boundaries: love -> $$l $lo lov ove ve$ e$$
+    t = '$$' + term + '$$'
+    return {t[i:i + 3] for i in range(len(t) - 2)}
+
+def edit_distance(a, b, bound):
+    # edits (add, drop or change a letter, swap two neighbours) from a to b,
+    # or bound + 1 as soon as it must be more than bound
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    before = None
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            d = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                d = min(d, before[j - 2] + 1)
+            cur.append(d)
+        # a swap looks two rows back: stop when two rows are over the bound
+        if min(cur) > bound and min(prev) > bound:
+            return bound + 1
+        before, prev = prev, cur
+    return prev[-1]
+
+def fuzzy_candidates(grams, id_terms, term, k):
+    # (distance, term) of the terms within edit distance k.
+    # grams: trigram -> term ids, id_terms: term id -> term.
+    # One edit changes at most 4 trigrams (a swap), so a candidate shares
+    # at least len(grams) - 4k of the term's trigrams; only terms sharing
+    # one are counted, the vocabulary is never scanned. Short words with
+    # k = 2 can share none and be missed.
+    tgrams = term_grams(term)
+    shared = Counter()
+    for g in tgrams:
+        shared.update(grams.get(g, ()))
+    need = max(len(tgrams) - 4 * k, 1)
+    found = []
+    for tid, n in shared.items():
+        if n >= need:
+            wd = id_terms[tid]
+            d = edit_distance(term, wd, k)
+            if d <= k:
+                found.append((d, wd))
+    return found
+
+def expand_sorted(terms, pattern, cap):
+    # terms matching a wildcard pattern, alphabetically, at most cap of them.
+    # terms: any sorted sequence. Only the terms starting with the pattern's
+    # literal prefix are looked at, and not more than EXPAND_SCAN of those.
+    cut = min((pattern.find(c) for c in '*?[' if c in pattern), default=len(pattern))
+    prefix = pattern[:cut]
+    prefix_only = pattern == prefix + '*'
+    found = []
+    start = bisect_left(terms, prefix)
+    for i in range(start, min(start + EXPAND_SCAN, len(terms))):
+        term = terms[i]
+        if not term.startswith(prefix):
+            break
+        if prefix_only or fnmatchcase(term, pattern):
+            found.append(term)
+            if len(found) == cap:
+                break
+    return found
 
 class Index:
-    def __init__(self, name):
+    def __init__(self, name, analyzer=None):
         self.name = name
         self.msgs = [];
-        self.index = {}
+        # text -> terms, the same for messages and queries, see analyzer.py
+        self.analyzer = analyzer or Analyzer()
+        # every term is interned once as a small id, the rest is per id
+        self.terms = {}             # term -> term id
+        self.id_terms = []          # term id -> term
+        self.sorted_terms = []      # the terms in order, for prefix and wildcard queries
+        self.grams = {}             # trigram -> ids of the terms with it, for fuzzy queries
+        self.index = []             # term id -> message numbers, one per occurrence
+        self.positions = []         # term id -> word positions, parallel to self.index
+        self.doc_freqs = array('I') # term id -> number of messages with the term
+        self.doc_lens = array('I')  # message -> number of terms, for ranking
+        self.doc_times = array('d') # message -> when it came in (time.time()), for newest first
         self.total_msgs = 0
         self.total_words = 0
         
+    def __setstate__(self, state):
+        # .idx files from before the analyzer keep a dict of raw words:
+        # index the messages again
+        self.__dict__.update(state)
+        if 'doc_times' not in state:
+            # no times kept: older than anything that has them
+            self.doc_times = array('d', bytes(8 * len(self.msgs)))
+        if 'analyzer' not in state:
+            self.analyzer = Analyzer()
+            self.reindex()
+            return
+        if 'sorted_terms' not in state:
+            self.sorted_terms = sorted(self.terms)
+        if 'grams' not in state:
+            self.id_terms = sorted(self.terms, key=self.terms.get)
+            self.grams = {}
+            for tid, wd in enumerate(self.id_terms):
+                self.add_grams(wd, tid)
+
+    def reindex(self):
+        self.terms = {}
+        self.id_terms = []
+        self.sorted_terms = []
+        self.grams = {}
+        self.index = []
+        self.positions = []
+        self.doc_freqs = array('I')
+        self.doc_lens = array('I')
+        self.total_words = 0
+        for l, m in enumerate(self.msgs):
+            self.indexing(m, l)
+
     def get_total_words(self):
         return self.total_words
         
@@ -23,31 +146,144 @@ class Index:
     def get_msg(self, n):
         return self.msgs[n]
         
-    def add_msg(self, m):
+    def msg_time(self, n):
+        return self.doc_times[n]
+
+    def add_msg(self, m, when=None):
+        # when: the time the message came in, now if not given
         self.msgs.append(m)
+        self.doc_times.append(time.time() if when is None else when)
         self.total_msgs += 1
         
-    def add_msg_and_index(self, m):
-        self.add_msg(m)
+    def add_msg_and_index(self, m, when=None):
+        self.add_msg(m, when)
         line_at = self.total_msgs - 1
         self.indexing(m, line_at)
  
     def indexing(self, m, l):
-        words = m.split()
+        words = self.analyzer.analyze(m)
         self.total_words += len(words)
-        for wd in words:
-            if wd not in self.index:
-                self.index[wd] = [l,]
+        self.doc_lens.append(len(words))
+        terms, index, positions, doc_freqs = self.terms, self.index, self.positions, self.doc_freqs
+        for pos, wd in words:
+            # postings grow in place: one 4-byte slot per occurrence, no copying
+            tid = terms.get(wd)
+            if tid is None:
+                terms[wd] = len(index)
+                self.id_terms.append(wd)
+                insort(self.sorted_terms, wd)
+                self.add_grams(wd, len(index))
+                index.append(array('I', (l,)))
+                positions.append(array('I', (pos,)))
+                doc_freqs.append(1)
             else:
-                self.index[wd].append(l)
+                postings = index[tid]
+                if postings[-1] != l:
+                    doc_freqs[tid] += 1
+                postings.append(l)
+                positions[tid].append(pos)
                                      
     def search(self, term):
+        # lines with the word, once per occurrence
         msgs = []
-        if (term in self.index.keys()):
-            indices = self.index[term]
-            msgs = [(i, self.msgs[i]) for i in indices]
+        words = self.analyzer.terms(term)
+        if len(words) == 1:
+            indices = self.postings(words[0])[0]
+            msgs = [(i, self.get_msg(i)) for i in indices]
         return msgs
 
+    def postings(self, term):
+        # (message numbers, word positions) of every occurrence, for query.py
+        tid = self.terms.get(term)
+        if tid is None:
+            return (), ()
+        return self.index[tid], self.positions[tid]
+
+    def add_grams(self, wd, tid):
+        for g in term_grams(wd):
+            ids = self.grams.get(g)
+            if ids is None:
+                self.grams[g] = array('I', (tid,))
+            else:
+                ids.append(tid)
+
+    def fuzzy_candidates(self, term, k):
+        return fuzzy_candidates(self.grams, self.id_terms, term, k)
+
+    def fuzzy(self, term, k, cap):
+        # terms within edit distance k, closest and then most used first
+        found = sorted((d, -self.doc_freq(wd), wd) for d, wd in self.fuzzy_candidates(term, k))
+        return [wd for d, f, wd in found[:cap]]
+
+    def expand(self, pattern, cap):
+        return expand_sorted(self.sorted_terms, pattern, cap)
+
+    def iter_terms(self):
+        # every term, in order
+        return iter(self.sorted_terms)
+
+    def doc_freq(self, term):
+        tid = self.terms.get(term)
+        return 0 if tid is None else self.doc_freqs[tid]
+
+    def doc_count(self):
+        return self.total_msgs
+
+    def doc_len(self, n):
+        return self.doc_lens[n]
+
+    def avg_doc_len(self):
+        return self.total_words / max(self.total_msgs, 1)
+
+    def words_between(self, a, b):
+        # number of terms in messages a..b-1
+        return sum(self.doc_lens[a:b])
+
+    def memory(self):
+        # about how many bytes of RAM the index holds
+        return self.total_msgs * MSG_BYTES + self.total_words * WORD_BYTES + len(self.terms) * TERM_BYTES
+
+    def query(self, text, limit=None, respell=False, offset=0, newest=False):
+        # AND/OR/NOT and "phrase" queries, see query.py; raises query.QueryError
+        # every match in message order, or the best `limit` of them by BM25
+        # (newest: the last `limit`, newest first), after the first `offset`
+        # ones: a page of the ranking.
+        # respell: when nothing is found, try the unknown words as word~
+        node, found = self.match(text, respell)
+        if newest:
+            found = list(islice(self.newest_first(found), None if limit is None else offset + limit))
+        elif limit is not None:
+            found = query.top_k(self, node, found, offset + limit)
+        return [(i, self.get_msg(i)) for i in found[offset:]]
+
+    def query_iter(self, text, respell=False, offset=0, newest=False):
+        # every match after the first `offset` ones, one at a time, each
+        # message read when its turn comes
+        node, found = self.match(text, respell)
+        return ((i, self.get_msg(i)) for i in self.order(node, found, offset, newest))
+
+    def order(self, node, found, offset=0, newest=False):
+        # the matches after the first `offset` ones, lazily: newest first, or
+        # best first by BM25, which scores them all here
+        if newest:
+            return islice(self.newest_first(found), offset, None)
+        return query.pop_ranked(query.ranked(self, node, found), offset)
+
+    def newest_first(self, found):
+        # the matches, the last to come in first: here, by message number
+        return reversed(found)
+
+    def match(self, text, respell=False):
+        # (the parsed query, the matching messages in message order)
+        node = query.parse(text, self.analyzer)
+        found = query.evaluate(node, self)
+        if not found and respell:
+            fuzzy = query.respell(node, self)
+            if fuzzy is not None:
+                node = fuzzy
+                found = query.evaluate(node, self)
+        return node, found
+
 class PIndex(Index):
     def __init__(self, name):
         super().__init__(name)
@@ -58,17 +294,21 @@ class PIndex(Index):
         
         # load poems
     def load_poems(self):
+        # poem headers ("III.") are not words for the analyzer, keep their lines
+        headers = set(r + '.' for r in self.int2roman.values())
+        self.headers = {}
         lines = open(self.name, 'r').readlines()
         for l in lines:
-            self.add_msg_and_index(l.rstrip())
+            l = l.rstrip()
+            if l in headers:
+                self.headers.setdefault(l, self.total_msgs)
+            self.add_msg_and_index(l)
     
     def get_poem(self, p):
         p_str = self.int2roman[p] + '.'
         p_next_str = self.int2roman[p + 1] + '.'
-        temp = self.search(p_str)
-        if temp:
-            [(go_line, m)] = temp
-        else:
+        go_line = self.headers.get(p_str)
+        if go_line is None:
             return []
         # in case of wrong number
         poem = []
@@ -88,3 +328,7 @@ if __name__ == "__main__":
     print(p3)
     s_love = sonnets.search("love")
     print(s_love)
+    print(sonnets.query('"thy self" OR (Love NOT hate)')[:5])
+    print(sonnets.query('love beauty', limit=3))
+    print(sonnets.expand('lov*', 10), sonnets.query('be?uty', limit=2))
+    print(sonnets.fuzzy('beuaty', 2, 5), sonnets.query('sumer', limit=2, respell=True))
@@ -0,0 +1,369 @@
+"""
+Boolean and phrase queries over an inverted index
+
+Query syntax:
+    love summer         both words (AND is implied)
+    love AND summer     the same
+    love OR beauty      either word
+    love NOT summer     love, but not summer (also: love -summer)
+    "summer's day"      the words next to each other, in this order
+    lov*  l?ve          any word matching the wildcards (* any letters,
+                        ? one letter); it must start with a letter
+    lvoe~  lvoe~2       any word within a few typing mistakes (a letter
+                        added, dropped or changed, two letters swapped):
+                        1 for words up to 5 letters, 2 for longer ones,
+                        or the given number, at most 2
+    (love OR beauty) NOT "thy self"
+
+The index only needs four methods:
+    postings(term) -> (docs, positions)  message numbers, one per occurrence,
+                                         in increasing order, and the word
+                                         position of each occurrence
+    doc_count()    -> number of messages (for a query that starts with NOT)
+    expand(pattern, cap) -> at most cap terms matching a wildcard pattern
+    fuzzy(term, k, cap)  -> at most cap terms within edit distance k, closest first
+and three more for ranking (top_k):
+    doc_freq(term), doc_len(n), avg_doc_len()
+
+Words in the query go through the index's analyzer (parse(text, analyzer)),
+the same one its messages went through. A word the analyzer drops (a
+stopword, punctuation) is left out of the query.
+
+Message lists are intersected by galloping: walk the shorter list and
+jump through the longer one with exponential then binary search, so
+"rare AND common" costs about len(rare) * log(len(common)).
+
+top_k ranks the matches with BM25 and keeps the best k on a heap, so
+what is sorted and sent back grows with k, not with the number of hits.
+"""
+
+import re
+import heapq
+import math
+from bisect import bisect_left, bisect_right
+from analyzer import Analyzer
+
+TOKEN = re.compile(r'"[^"]*"?|\(|\)|[^\s()"]+')
+
+WILDCARDS = '*?'
+WILDCARD_MAX_TERMS = 100  # a pattern stands for at most this many terms
+FUZZY = re.compile(r'^(.+)~(\d)?$')
+FUZZY_MAX_DISTANCE = 2
+FUZZY_MAX_TERMS = 50
+
+BM25_K1 = 1.2   # how fast repeating a word stops adding to the score
+BM25_B = 0.75   # how much long messages are penalized
+
+class QueryError(ValueError):
+    pass
+
+#==============================================================================
+# parser: OR < AND < NOT, parentheses and quoted phrases
+#==============================================================================
+# what parse() uses when the index has no analyzer: whitespace-split words
+SPLIT = Analyzer(casefold=False, strip_punct=False, chat_prefix=False)
+
+def fuzzy_distance(term):
+    # word~ without a number
+    return 0 if len(term) < 3 else 1 if len(term) <= 5 else 2
+
+def words_node(words):
+    # analyzed (position, term) pairs -> term, phrase or nothing
+    if not words:
+        return None
+    if len(words) == 1:
+        return ('term', words[0][1])
+    first = words[0][0]
+    return ('phrase', [(pos - first, wd) for pos, wd in words])
+
+def parse(text, analyzer=SPLIT):
+    # query tree; None when every word was dropped by the analyzer
+    tokens = TOKEN.findall(text)
+    if not tokens:
+        raise QueryError('empty query')
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def combine(kind, parts):
+        parts = [p for p in parts if p is not None]
+        if not parts:
+            return None
+        return parts[0] if len(parts) == 1 else (kind, parts)
+
+    def parse_or():
+        parts = [parse_and()]
+        while peek() == 'OR':
+            take()
+            parts.append(parse_and())
+        return combine('or', parts)
+
+    def parse_and():
+        parts = [parse_not()]
+        while peek() is not None and peek() not in ('OR', ')'):
+            if peek() == 'AND':
+                take()
+            parts.append(parse_not())
+        return combine('and', parts)
+
+    def parse_not():
+        tok = peek()
+        if tok == 'NOT':
+            take()
+            node = parse_not()
+            return None if node is None else ('not', node)
+        if tok is not None and tok.startswith('-') and len(tok) > 1:
+            tokens[pos] = tok[1:]
+            node = parse_not()
+            return None if node is None else ('not', node)
+        return parse_atom()
+
+    def parse_atom():
+        tok = peek()
+        if tok is None or tok == ')' or tok in ('AND', 'OR'):
+            raise QueryError(f'term expected at {tok or "end of query"}')
+        take()
+        if tok == '(':
+            node = parse_or()
+            if peek() != ')':
+                raise QueryError('missing )')
+            take()
+            return node
+        if tok.startswith('"'):
+            if not tok.strip('"').strip():
+                raise QueryError('empty phrase')
+            return words_node(analyzer.analyze(tok.strip('"')))
+        m = FUZZY.match(tok)
+        if m:
+            words = analyzer.analyze(m.group(1))
+            k = int(m.group(2)) if m.group(2) else None
+            if k is not None and k > FUZZY_MAX_DISTANCE:
+                raise QueryError(f'{tok}: at most ~{FUZZY_MAX_DISTANCE}')
+            if len(words) == 1:
+                term = words[0][1]
+                return ('fuzzy', term, fuzzy_distance(term) if k is None else k)
+            return words_node(words)
+        if any(c in tok for c in WILDCARDS):
+            pattern = analyzer.pattern(tok)
+            if pattern[:1] in ('', '*', '?'):
+                raise QueryError(f'{tok}: a wildcard word must start with a letter')
+            return ('wild', pattern)
+        # one query word can be several terms ("e-mail"): a phrase
+        return words_node(analyzer.analyze(tok))
+
+    node = parse_or()
+    if peek() is not None:
+        raise QueryError(f'unexpected {peek()}')
+    return node
+
+#==============================================================================
+# sorted message lists
+#==============================================================================
+def unique(docs):
+    # postings have one entry per occurrence, a message can repeat
+    out = []
+    last = -1
+    for d in docs:
+        if d != last:
+            out.append(d)
+            last = d
+    return out
+
+def gallop(a, x, lo=0):
+    # first index >= lo with a[index] >= x
+    step = 1
+    hi = lo
+    while hi < len(a) and a[hi] < x:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(a, x, lo, min(hi, len(a)))
+
+def intersect(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    out = []
+    j = 0
+    for x in a:
+        j = gallop(b, x, j)
+        if j == len(b):
+            break
+        if b[j] == x:
+            out.append(x)
+    return out
+
+def union(lists):
+    out = []
+    last = -1
+    for d in heapq.merge(*lists):
+        if d != last:
+            out.append(d)
+            last = d
+    return out
+
+def difference(a, b):
+    out = []
+    j = 0
+    for x in a:
+        j = gallop(b, x, j)
+        if j == len(b) or b[j] != x:
+            out.append(x)
+    return out
+
+#==============================================================================
+# evaluation
+#==============================================================================
+def phrase_docs(idx, words):
+    # words: (offset in the phrase, term)
+    offsets = [k for k, w in words]
+    lists = [idx.postings(w) for k, w in words]
+    if any(len(docs) == 0 for docs, positions in lists):
+        return []
+    candidates = unique(lists[0][0])
+    for docs, positions in lists[1:]:
+        candidates = intersect(candidates, unique(docs))
+    out = []
+    for d in candidates:
+        # positions of each word in message d, the first word's shifted along
+        starts = None
+        for k, (docs, positions) in zip(offsets, lists):
+            lo, hi = bisect_left(docs, d), bisect_right(docs, d)
+            here = {positions[i] - k for i in range(lo, hi)}
+            starts = here if starts is None else starts & here
+            if not starts:
+                break
+        if starts:
+            out.append(d)
+    return out
+
+def evaluate(node, idx):
+    # sorted list of matching message numbers
+    if node is None:
+        return []
+    kind = node[0]
+    if kind == 'term':
+        return unique(idx.postings(node[1])[0])
+    if kind == 'phrase':
+        return phrase_docs(idx, node[1])
+    if kind == 'wild':
+        return union([unique(idx.postings(t)[0]) for t in idx.expand(node[1], WILDCARD_MAX_TERMS)])
+    if kind == 'fuzzy':
+        return union([unique(idx.postings(t)[0]) for t in idx.fuzzy(node[1], node[2], FUZZY_MAX_TERMS)])
+    if kind == 'or':
+        return union([evaluate(n, idx) for n in node[1]])
+    if kind == 'and':
+        positive = [n for n in node[1] if n[0] != 'not']
+        negative = [n[1] for n in node[1] if n[0] == 'not']
+        if positive:
+            lists = sorted((evaluate(n, idx) for n in positive), key=len)
+            docs = lists[0]
+            for other in lists[1:]:
+                if not docs:
+                    break
+                docs = intersect(docs, other)
+        else:
+            docs = range(idx.doc_count())
+        for n in negative:
+            docs = difference(docs, evaluate(n, idx))
+        return list(docs)
+    if kind == 'not':
+        return difference(range(idx.doc_count()), evaluate(node[1], idx))
+    raise QueryError(f'unknown node {kind}')
+
+def search(idx, text):
+    return evaluate(parse(text), idx)
+
+def respell(node, idx):
+    # the query again with every word the index does not know made fuzzy,
+    # None when there is no such word
+    if node is None:
+        return None
+    kind = node[0]
+    if kind == 'term':
+        if idx.doc_freq(node[1]) or not fuzzy_distance(node[1]):
+            return None
+        return ('fuzzy', node[1], fuzzy_distance(node[1]))
+    if kind in ('and', 'or'):
+        parts = [respell(n, idx) for n in node[1]]
+        if all(p is None for p in parts):
+            return None
+        return (kind, [n if p is None else p for n, p in zip(node[1], parts)])
+    if kind == 'not':
+        inner = respell(node[1], idx)
+        return None if inner is None else ('not', inner)
+    return None
+
+#==============================================================================
+# ranking
+#==============================================================================
+def scoring_terms(node, idx, out=None):
+    # the words a match is scored on: everything but what is under a NOT
+    out = [] if out is None else out
+    if node is None:
+        return out
+    kind = node[0]
+    if kind == 'term':
+        out.append(node[1])
+    elif kind == 'phrase':
+        out.extend(w for k, w in node[1])
+    elif kind == 'wild':
+        out.extend(idx.expand(node[1], WILDCARD_MAX_TERMS))
+    elif kind == 'fuzzy':
+        out.extend(idx.fuzzy(node[1], node[2], FUZZY_MAX_TERMS))
+    elif kind in ('and', 'or'):
+        for n in node[1]:
+            scoring_terms(n, idx, out)
+    return out
+
+def scorer(idx, node):
+    # BM25 of a matching message d, as (score, d): ties go to the newest
+    n = idx.doc_count()
+    avg = idx.avg_doc_len() or 1
+    weighted = []
+    for term in dict.fromkeys(scoring_terms(node, idx)):
+        postings = idx.postings(term)[0]
+        if len(postings):
+            df = idx.doc_freq(term)
+            weighted.append((postings, math.log(1 + (n - df + 0.5) / (df + 0.5))))
+
+    def score(d):
+        s = 0.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * idx.doc_len(d) / avg)
+        for postings, idf in weighted:
+            # occurrences of the word in message d: a run in the postings
+            tf = bisect_right(postings, d) - bisect_left(postings, d)
+            if tf:
+                s += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return s, d
+
+    return score
+
+def top_k(idx, node, docs, k):
+    # the k best of the matching messages, best first; ties go to the newest
+    return heapq.nlargest(k, docs, key=scorer(idx, node))
+
+def ranked(idx, node, docs):
+    # all of the matching messages as a heap, for pop_ranked: the scoring is
+    # done here, each message popped then costs log(len(docs))
+    heap = [(-s, -d) for s, d in map(scorer(idx, node), docs)]
+    heapq.heapify(heap)
+    return heap
+
+def pop_ranked(heap, skip=0):
+    # the messages of a ranked() heap, best first, as top_k would order them
+    while heap:
+        d = -heapq.heappop(heap)[1]
+        if skip:
+            skip -= 1
+        else:
+            yield d
+
+if __name__ == "__main__":
+    print(parse('(love OR beauty) NOT "thy self" summ*'))
+    print(intersect([1, 5, 9, 200, 300], list(range(0, 1000, 5))))
@@ -0,0 +1,591 @@
+"""
+On-disk segments for the per-user chat indices
+
+A user's history is kept in <name>.seg, a file written in one go and then
+only read, through mmap. Opening it reads a fixed-size header, so login
+costs the same with ten messages or ten million. A search reads the pages
+of the terms it looks up and of the messages it returns; the rest of the
+file is never touched and never copied into the process.
+
+Layout. The header is little endian. The arrays are in the machine's byte
+order, and each section starts on 8 bytes:
+    header      SEG_HEADER: magic, version, counts, (offset, size) of each
+                section below
+    analyzer    json, Analyzer.settings() of the index that was written
+    terms       the utf-8 terms, sorted, back to back
+    term_offs   Q x (terms + 1), where each term starts in terms
+    post_offs   Q x (terms + 1), where each term's postings start
+    doc_freqs   I x terms, number of messages with the term
+    postings    per term, per occurrence, two varints: the message number
+                minus the previous one (the first one minus -1), then the
+                word position, or its distance from the previous position
+                when the message is the same
+    msg_offs    Q x (messages + 1), where each message starts in msgs
+    msgs        the utf-8 messages back to back
+    doc_lens    I x messages, number of terms of each message
+    doc_times   d x messages, when each message came in (time.time()); not
+                in version 1 segments, whose messages count as from 0.0
+
+SegmentIndex puts the segment together with an indexer.Index for the
+messages since, and searches both as one index.
+
+Every message is also appended to <name>.wal as it is indexed, one
+WAL_RECORD (size, crc32, message number, time) plus the utf-8 text, after
+the WAL_MAGIC the file starts with, flushed to the OS right away: a server
+that dies loses nothing, and a message costs one small write, not a
+rewrite of the history. At logout the log is
+renamed to <name>.wal.1 and compact() folds it into a new segment, on a
+worker, while the server goes on. Opening replays <name>.wal.1, then
+<name>.wal; records the segment already has (by message number) are
+skipped, so a crash at any point of a compaction loses and repeats
+nothing. A torn record at the end of a log is cut off. Several server
+processes can share these files: a compaction first takes a lock on
+<name>.wal.lock, released by the OS if its process dies, and the one that
+does not get it, or finds the .wal.1 gone, leaves it to the other.
+"""
+
+import os
+import sys
+import json
+import mmap
+import heapq
+import zlib
+import time
+import struct
+import pickle
+import itertools
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import indexer
+from analyzer import Analyzer
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+MAGIC = b'CSEG'
+VERSION = 2
+SECTIONS = ('analyzer', 'terms', 'term_offs', 'post_offs', 'doc_freqs', 'postings',
+            'msg_offs', 'msgs', 'doc_lens', 'doc_times')
+VERSION_SECTIONS = {1: SECTIONS[:-1], VERSION: SECTIONS}  # the versions that can be read
+SEG_HEAD = struct.Struct('<4sIIIQ')  # magic, version, messages, terms, words
+SEG_HEADER = struct.Struct(SEG_HEAD.format + 'QQ' * len(SECTIONS))
+POSTINGS_CACHE = 256  # decoded postings kept per segment, by term
+CACHED_BYTES = 300    # for memory(): a cached postings list, plus 8 per entry
+GRAM_BYTES = 220      # for memory(): a trigram, plus 4 per term with it
+WAL_MAGIC = b'CWAL\x02\0\0\0'      # starts a log; logs without it have OLD_WAL_RECORDs
+WAL_RECORD = struct.Struct('<IIId') # text size, crc32 of time and text, message number, time
+OLD_WAL_RECORD = struct.Struct('<III')  # the same without the time
+WAL_TIME = struct.Struct('<d')
+TMP_IDS = itertools.count()         # segments being written by this process
+
+#==============================================================================
+# varint postings
+#==============================================================================
+def put_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def encode_postings(out, docs, positions):
+    prev_doc = -1
+    prev_pos = 0
+    for doc, pos in zip(docs, positions):
+        put_varint(out, doc - prev_doc)
+        put_varint(out, pos - prev_pos if doc == prev_doc else pos)
+        prev_doc, prev_pos = doc, pos
+
+def decode_postings(data):
+    docs = array('I')
+    positions = array('I')
+    doc = -1
+    pos = delta = val = shift = 0
+    is_doc = True
+    for b in data:
+        val |= (b & 0x7F) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        if is_doc:
+            delta = val
+        else:
+            if delta:
+                doc += delta
+                pos = val
+            else:
+                pos += val
+            docs.append(doc)
+            positions.append(pos)
+        is_doc = not is_doc
+        val = shift = 0
+    return docs, positions
+
+#==============================================================================
+# writing
+#==============================================================================
+def write_segment(path, idx):
+    # idx: an indexer.Index or a SegmentIndex. Written next to path, under a
+    # name of its own, then renamed over it, so a crash never leaves half a
+    # segment behind and two writers never write to the same file.
+    sections = {}
+    sections['analyzer'] = json.dumps(idx.analyzer.settings()).encode()
+    blob = bytearray()
+    term_offs = array('Q', (0,))
+    postings = bytearray()
+    post_offs = array('Q', (0,))
+    doc_freqs = array('I')
+    n_terms = 0
+    for term in idx.iter_terms():
+        blob += term.encode('utf-8')
+        term_offs.append(len(blob))
+        encode_postings(postings, *idx.postings(term))
+        post_offs.append(len(postings))
+        doc_freqs.append(idx.doc_freq(term))
+        n_terms += 1
+    msgs = bytearray()
+    msg_offs = array('Q', (0,))
+    doc_lens = array('I')
+    doc_times = array('d')
+    n_msgs = idx.get_msg_size()
+    for n in range(n_msgs):
+        msgs += idx.get_msg(n).encode('utf-8', 'surrogatepass')
+        msg_offs.append(len(msgs))
+        doc_lens.append(idx.doc_len(n))
+        doc_times.append(idx.msg_time(n))
+    sections.update(terms=blob, term_offs=term_offs.tobytes(), post_offs=post_offs.tobytes(),
+                    doc_freqs=doc_freqs.tobytes(), postings=postings, msg_offs=msg_offs.tobytes(),
+                    msgs=msgs, doc_lens=doc_lens.tobytes(), doc_times=doc_times.tobytes())
+
+    places = []
+    at = SEG_HEADER.size
+    for name in SECTIONS:
+        at += -at % 8
+        places += [at, len(sections[name])]
+        at += len(sections[name])
+    tmp = f'{path}.{os.getpid()}.{next(TMP_IDS)}.tmp'
+    with open(tmp, 'xb') as f:
+        f.write(SEG_HEADER.pack(MAGIC, VERSION, n_msgs, n_terms, idx.get_total_words(), *places))
+        for name in SECTIONS:
+            f.write(b'\0' * (-f.tell() % 8))
+            f.write(sections[name])
+        f.flush()
+        os.fsync(f.fileno())
+    return tmp
+
+def save_segment(path, idx):
+    os.replace(write_segment(path, idx), path)
+
+#==============================================================================
+# reading
+#==============================================================================
+class SegmentTerms:
+    """the sorted terms of a segment, as a sequence bisect can search"""
+    def __init__(self, seg):
+        self.seg = seg
+
+    def __len__(self):
+        return self.seg.n_terms
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.seg.n_terms:
+            raise IndexError(i)
+        offs = self.seg.term_offs
+        return str(self.seg.term_blob[offs[i]:offs[i + 1]], 'utf-8')
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            # the mapping keeps a descriptor of its own
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = [memoryview(self.mm)]
+        self.cache = OrderedDict()  # term id -> decoded (docs, positions)
+        self.cache_bytes = 0
+        self.grams = None           # trigram -> term ids, built by the first fuzzy query
+        self.grams_bytes = 0
+        magic, version, self.n_msgs, self.n_terms, self.total_words = SEG_HEAD.unpack_from(self.mm, 0)
+        sections = VERSION_SECTIONS.get(version) if magic == MAGIC else None
+        if sections is None:
+            self.close()
+            raise ValueError(f'{path}: not a version {VERSION} segment')
+        table = struct.unpack_from('<' + 'QQ' * len(sections), self.mm, SEG_HEAD.size)
+        place = dict(zip(sections, zip(table[0::2], table[1::2])))
+        self.analyzer = Analyzer(**json.loads(bytes(self.view(place['analyzer']))))
+        self.term_blob = self.view(place['terms'])
+        self.term_offs = self.view(place['term_offs'], 'Q')
+        self.post_offs = self.view(place['post_offs'], 'Q')
+        self.doc_freqs = self.view(place['doc_freqs'], 'I')
+        self.postings_blob = self.view(place['postings'])
+        self.msg_offs = self.view(place['msg_offs'], 'Q')
+        self.msgs = self.view(place['msgs'])
+        self.doc_lens = self.view(place['doc_lens'], 'I')
+        self.doc_times = self.view(place['doc_times'], 'd') if 'doc_times' in place else None
+        self.terms = SegmentTerms(self)
+
+    def view(self, place, fmt=None):
+        offset, size = place
+        v = self.views[0][offset:offset + size]
+        if fmt is not None:
+            v = v.cast(fmt)
+        self.views.append(v)
+        return v
+
+    def term_id(self, term):
+        i = bisect_left(self.terms, term)
+        if i < self.n_terms and self.terms[i] == term:
+            return i
+        return None
+
+    def postings(self, term):
+        tid = self.term_id(term)
+        if tid is None:
+            return (), ()
+        found = self.cache.get(tid)
+        if found is None:
+            found = decode_postings(self.postings_blob[self.post_offs[tid]:self.post_offs[tid + 1]].tobytes())
+            self.cache[tid] = found
+            self.cache_bytes += CACHED_BYTES + 8 * len(found[0])
+            if len(self.cache) > POSTINGS_CACHE:
+                old = self.cache.popitem(last=False)[1]
+                self.cache_bytes -= CACHED_BYTES + 8 * len(old[0])
+        else:
+            self.cache.move_to_end(tid)
+        return found
+
+    def doc_freq(self, term):
+        tid = self.term_id(term)
+        return 0 if tid is None else self.doc_freqs[tid]
+
+    def msg_time(self, n):
+        return 0.0 if self.doc_times is None else self.doc_times[n]
+
+    def get_msg(self, n):
+        return str(self.msgs[self.msg_offs[n]:self.msg_offs[n + 1]], 'utf-8', 'surrogatepass')
+
+    def fuzzy_candidates(self, term, k):
+        if self.grams is None:
+            self.grams = {}
+            for tid, wd in enumerate(self.terms):
+                for g in indexer.term_grams(wd):
+                    ids = self.grams.get(g)
+                    if ids is None:
+                        self.grams[g] = array('I', (tid,))
+                    else:
+                        ids.append(tid)
+            self.grams_bytes = sum(GRAM_BYTES + 4 * len(ids) for ids in self.grams.values())
+        return indexer.fuzzy_candidates(self.grams, self.terms, term, k)
+
+    def memory(self):
+        # the mapped file, as if all of it was read in, and what was decoded
+        return len(self.mm) + self.cache_bytes + self.grams_bytes
+
+    def close(self):
+        self.cache.clear()
+        self.cache_bytes = 0
+        for v in reversed(self.views):
+            v.release()
+        self.views = []
+        self.mm.close()
+
+
+#==============================================================================
+# message logs
+#==============================================================================
+def read_wal(path, repair=True):
+    # (message number, text, time) of every record, in order. repair: cut
+    # off a torn record at the end, only for a log no other process writes to
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    records = []
+    if data.startswith(WAL_MAGIC):
+        record, at = WAL_RECORD, len(WAL_MAGIC)
+    elif WAL_MAGIC.startswith(data):
+        record, at = WAL_RECORD, 0  # empty, or died writing the magic
+    else:
+        record, at = OLD_WAL_RECORD, 0
+    # the crc covers what follows the message number: the time and the text
+    covered = OLD_WAL_RECORD.size
+    while at + record.size <= len(data):
+        size, crc, n = OLD_WAL_RECORD.unpack_from(data, at)
+        checked = data[at + covered:at + record.size + size]
+        if len(checked) < record.size - covered + size or zlib.crc32(checked, n) != crc:
+            break
+        when = record.unpack_from(data, at)[3] if record is WAL_RECORD else 0.0
+        body = checked[record.size - covered:]
+        records.append((n, body.decode('utf-8', 'surrogatepass'), when))
+        at += record.size + size
+    if at < len(data) and repair:
+        # written in part when the server died: cut it off
+        print(f'{path}: dropping {len(data) - at} bytes of a torn record')
+        with open(path, 'r+b') as f:
+            f.truncate(at)
+    return records
+
+
+class Wal:
+    """append-only log of the messages indexed since the segment was written"""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(WAL_MAGIC)
+            self.file.flush()
+        elif not self.has_magic():
+            self.upgrade()
+
+    def has_magic(self):
+        with open(self.path, 'rb') as f:
+            return f.read(len(WAL_MAGIC)) == WAL_MAGIC
+
+    def upgrade(self):
+        # a log from before the times, read (and repaired) just now: written
+        # again in this format, next to it, then renamed over it
+        records = read_wal(self.path)
+        self.file.close()
+        tmp = f'{self.path}.{os.getpid()}.{next(TMP_IDS)}.tmp'
+        self.file = open(tmp, 'wb')
+        self.file.write(WAL_MAGIC)
+        for n, text, when in records:
+            self.append(n, text, when)
+        self.file.close()
+        os.replace(tmp, self.path)
+        self.file = open(self.path, 'ab')
+
+    def append(self, n, text, when):
+        body = WAL_TIME.pack(when) + text.encode('utf-8', 'surrogatepass')
+        self.file.write(OLD_WAL_RECORD.pack(len(body) - WAL_TIME.size, zlib.crc32(body, n), n) + body)
+        self.file.flush()
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class SegmentIndex(indexer.Index):
+    """
+    A user's chat index: <name>.seg plus, in this indexer.Index, the
+    messages of the logs. Their message numbers go on from the segment's,
+    so postings of the two just follow each other.
+    logs: the logs to replay; live: append new messages to <name>.wal
+    """
+    def __init__(self, name, logs=None, live=True):
+        if logs is None:
+            logs = (old_wal_path(name), wal_path(name))
+        # the logs before the segment: a compaction finishing in between
+        # then leaves a newer segment, with what they had, not a lost log
+        records = [(path, read_wal(path, repair=live)) for path in logs]
+        self.seg = Segment(seg_path(name))
+        super().__init__(name, self.seg.analyzer)
+        self.base = self.seg.n_msgs
+        self.wal = None
+        for path, found in records:
+            for n, m, when in found:
+                if n == self.get_msg_size():
+                    self.add_msg_and_index(m, when)
+                elif n > self.get_msg_size():
+                    print(f'{path}: message {n} missing, log ignored from there')
+                    break
+        if live:
+            self.wal = Wal(wal_path(name))
+
+    def add_msg_and_index(self, m, when=None):
+        if when is None:
+            when = time.time()
+        if self.wal is not None:
+            self.wal.append(self.get_msg_size(), m, when)
+        self.add_msg(m, when)
+        self.indexing(m, self.base + self.total_msgs - 1)
+
+    def get_msg(self, n):
+        if n < self.base:
+            return self.seg.get_msg(n)
+        return self.msgs[n - self.base]
+
+    def msg_time(self, n):
+        if n < self.base:
+            return self.seg.msg_time(n)
+        return self.doc_times[n - self.base]
+
+    def get_msg_size(self):
+        return self.base + self.total_msgs
+
+    def get_total_words(self):
+        return self.seg.total_words + self.total_words
+
+    def postings(self, term):
+        docs, positions = self.seg.postings(term)
+        new_docs, new_positions = super().postings(term)
+        if not len(new_docs):
+            return docs, positions
+        if not len(docs):
+            return new_docs, new_positions
+        return docs + new_docs, positions + new_positions
+
+    def doc_freq(self, term):
+        return self.seg.doc_freq(term) + super().doc_freq(term)
+
+    def doc_count(self):
+        return self.base + self.total_msgs
+
+    def doc_len(self, n):
+        if n < self.base:
+            return self.seg.doc_lens[n]
+        return self.doc_lens[n - self.base]
+
+    def avg_doc_len(self):
+        return self.get_total_words() / max(self.doc_count(), 1)
+
+    def words_between(self, a, b):
+        base = self.base
+        words = sum(self.seg.doc_lens[min(a, base):min(b, base)])
+        return words + super().words_between(max(a - base, 0), max(b - base, 0))
+
+    def expand(self, pattern, cap):
+        found = set(indexer.expand_sorted(self.seg.terms, pattern, cap))
+        found.update(super().expand(pattern, cap))
+        return sorted(found)[:cap]
+
+    def fuzzy_candidates(self, term, k):
+        found = dict((wd, d) for d, wd in self.seg.fuzzy_candidates(term, k))
+        for d, wd in super().fuzzy_candidates(term, k):
+            found[wd] = d
+        return [(d, wd) for wd, d in found.items()]
+
+    def iter_terms(self):
+        last = None
+        for term in heapq.merge(self.seg.terms, self.sorted_terms):
+            if term != last:
+                yield term
+                last = term
+
+    def memory(self):
+        return self.seg.memory() + super().memory()
+
+    def close(self):
+        if self.wal is not None:
+            self.wal.close()
+        self.seg.close()
+
+#==============================================================================
+# the server's side: open_index at login, close() and rotate_log at logout,
+# compact on a worker
+#==============================================================================
+def seg_path(name):
+    return name + '.seg'
+
+def wal_path(name):
+    return name + '.wal'
+
+def old_wal_path(name):
+    return name + '.wal.1'
+
+def lock_path(name):
+    return name + '.wal.lock'
+
+def try_lock(path):
+    # the open lock file if this process now holds the lock on path, None
+    # if another process does. The OS releases it if the process dies.
+    f = open(path, 'a+b')
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def unlock(f):
+    # closing the file releases the lock; the file stays, another process
+    # may be about to lock it
+    if fcntl is None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    f.close()
+
+def migrate(name):
+    # <name>.idx, a pickled indexer.Index, -> <name>.seg
+    with open(name + '.idx', 'rb') as f:
+        idx = pickle.load(f)
+    save_segment(seg_path(name), idx)
+    return idx.get_msg_size()
+
+def open_index(name):
+    path = seg_path(name)
+    if not os.path.exists(path):
+        if os.path.exists(name + '.idx'):
+            migrate(name)
+        else:
+            save_segment(path, indexer.Index(name))
+    return SegmentIndex(name)
+
+def msg_count(name):
+    # messages of <name>.seg and its logs, from the segment's header and
+    # the records: nothing is mapped or left open
+    with open(seg_path(name), 'rb') as f:
+        head = f.read(SEG_HEAD.size)
+    magic, version, n = SEG_HEAD.unpack_from(head)[:3]
+    if magic != MAGIC or version not in VERSION_SECTIONS:
+        raise ValueError(f'{name}: not a version {VERSION} segment')
+    for path in (old_wal_path(name), wal_path(name)):
+        for k, m, when in read_wal(path, repair=False):
+            if k == n:
+                n += 1
+    return n
+
+def rotate_log(name):
+    # <name>.wal -> <name>.wal.1, unless a .wal.1 is still waiting for its
+    # compaction. True when there is a .wal.1 to compact.
+    live, old = wal_path(name), old_wal_path(name)
+    if os.path.exists(old):
+        return True
+    if not os.path.exists(live):
+        return False
+    if os.path.getsize(live) <= len(WAL_MAGIC):
+        os.remove(live)  # no record in it
+        return False
+    os.replace(live, old)
+    return True
+
+def compact(name):
+    # worker: fold <name>.wal.1 into <name>.seg, then drop the log.
+    # <name>.wal, where a new login may be writing, is not touched.
+    # None when another process holds the lock: that one compacts it.
+    lock = try_lock(lock_path(name))
+    if lock is None:
+        return None
+    try:
+        if not os.path.exists(old_wal_path(name)):
+            return 0  # compacted by another process in the meantime
+        idx = SegmentIndex(name, logs=(old_wal_path(name),), live=False)
+        try:
+            added = idx.total_msgs
+            tmp = write_segment(seg_path(name), idx) if added else None
+        finally:
+            idx.close()  # no mapping may be left on the file it replaces (Windows)
+        if tmp is not None:
+            os.replace(tmp, seg_path(name))
+        os.remove(old_wal_path(name))
+        return added
+    finally:
+        unlock(lock)
+
+if __name__ == "__main__":
+    # one-shot migration of the pickled indices: python segment.py [dir] [--remove]
+    folder = next((a for a in sys.argv[1:] if not a.startswith('--')), '.')
+    os.chdir(folder)
+    for fn in sorted(os.listdir('.')):
+        if fn.endswith('.idx'):
+            name = fn[:-len('.idx')]
+            print(f'{fn} -> {seg_path(name)}: {migrate(name)} messages')
+            if '--remove' in sys.argv:
+                os.remove(fn)